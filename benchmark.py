@@ -0,0 +1,198 @@
+"""Executable script running performance benchmarks of path tracing renderer
+   module."""
+
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+from ptrace.core import SCENES
+from ptrace.oop.image_output import AccumulableImage
+from ptrace.oop.oop_primitives import spawn_offset
+from ptrace.oop.oop_renderer import DEFAULT_RENDERER_PARAMS
+from ptrace.oop.utils import derive_seed
+
+
+# root mean squared error which caustics benchmark reports time to reach
+_TARGET_ERROR = 0.2
+# number of seeds renders of caustics benchmark are averaged over
+_ERROR_SEEDS = 4
+# number of photons traced by photon map renders of caustics benchmark per
+# pixel of the image (so that tracing them is cheap compared to sampling)
+_PHOTONS_PER_PIXEL = 50
+
+
+def _trace_frame(renderer, output, batch_size, dtype):
+    """Traces primary rays and one diffuse bounce for every pixel of a frame
+       using batched kernels, accumulating albedo-weighted secondary hit
+       distances into given output image. Returns number of rays cast."""
+    width, height = output.width, output.height
+    px_x, px_y = np.divmod(np.arange(width * height), height)
+    rng = np.random.default_rng(0)
+    ray_count = 0
+    for beg in range(0, width * height, batch_size):
+        end = min(beg + batch_size, width * height)
+        rays = renderer.camera.get_rays(px_x[beg:end], px_y[beg:end], dtype=dtype)
+        hits = renderer.scene.hit_batch(rays)
+        hit_mask = hits.hit_mask()
+
+        directions = rng.normal(size=(end - beg, 3)).astype(dtype)
+        directions /= np.linalg.norm(directions, axis=1)[:, np.newaxis]
+        directions *= np.sign(np.einsum('ij,ij->i', directions, hits.normals))[:, np.newaxis]
+        secondary = hits.spawn_rays(directions, spawn_offset(dtype))[hit_mask]
+        distances = renderer.scene.intersect_batch_ex(secondary)[0]
+        ray_count += len(rays) + len(secondary)
+
+        colours = np.zeros((3, end - beg), dtype=dtype)
+        colours[:, hit_mask] = np.exp(-distances)
+        counts = np.ones(end - beg, dtype='int')
+        np.add.at(output.image, (slice(None), px_x[beg:end], px_y[beg:end]), colours)
+        np.add.at(output.sample_counts, (px_x[beg:end], px_y[beg:end]), counts)
+    return ray_count
+
+
+def bench_precision(width, height, repeats):
+    """Compares throughput and memory footprint of batched kernels and
+       accumulation buffers in double and single precision."""
+    params = dict(DEFAULT_RENDERER_PARAMS, width=width, height=height)
+    renderer = SCENES['spheres'](params)
+    batch_size = 1 << 16
+
+    print("Precision benchmark ({}x{}, batch size {}):".format(width, height, batch_size))
+    for dtype in ['double', 'single']:
+        tracemalloc.start()
+        output = AccumulableImage(width, height, dtype)
+        _, peak_before = tracemalloc.get_traced_memory()
+        timings = []
+        for _ in range(repeats):
+            start_time = time.time()
+            ray_count = _trace_frame(renderer, output, batch_size, dtype)
+            timings.append(time.time() - start_time)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        best = min(timings)
+        print("  {:6}: {:8.3f} s/frame, {:6.2f} Mrays/s, accumulation buffers {:7.1f} MB,"
+              " peak traced memory {:7.1f} MB".format( \
+                  dtype, best, ray_count / best / 1e6,
+                  (output.image.nbytes + output.sample_counts.nbytes) / 2 ** 20,
+                  max(peak, peak_before) / 2 ** 20))
+
+
+def _render_colours(scene_name, params):
+    """Renders scene with given parameters, returning its colours and time
+       taken (including building of the renderer)."""
+    start_time = time.time()
+    renderer = SCENES[scene_name](params)
+    colours = renderer.render().colours()
+    return colours, time.time() - start_time
+
+def _squared_error(colours, references):
+    """Returns unbiased estimate of mean squared error of colours against
+       (unknown) exact image, given two independent unbiased renders of it.
+       As errors of colours and of both references are independent, the
+       expected product of differences from both references is the squared
+       error of colours alone, unaffected by noise of the references."""
+    return np.mean((colours - references[0]) * (colours - references[1]))
+
+def _time_to_error(samples, squared_errors, timings, target_error):
+    """Returns time and number of samples per pixel needed to reach given
+       root mean squared error, or None if it is out of reach, by fitting
+       squared errors measured for given sample counts with bias squared
+       plus variance over samples (weighted by samples, so that less noisy
+       renders of more samples dominate) and timings with fixed plus per
+       sample cost."""
+    samples = np.array(samples, dtype='double')
+    (bias, variance), *_ = np.linalg.lstsq(np.stack([samples, np.ones_like(samples)], axis=1),
+                                           samples * np.array(squared_errors), rcond=None)
+    bias = max(0.0, bias)
+    if target_error ** 2 <= bias or variance <= 0.0:
+        return None
+    needed = variance / (target_error ** 2 - bias)
+    per_sample, fixed = np.polyfit(samples, timings, 1)
+    return fixed + per_sample * needed, needed
+
+def bench_caustics(width, height, repeats, target_error=_TARGET_ERROR):
+    """Compares time to quality of rendering scene with caustics by plain path
+       tracing and with caustic photon map, for 1 to 2 ** repeats samples per
+       pixel. Reports root mean squared error (estimated against two
+       independent plain path traced references of 8 times more samples than
+       the most used by compared renders, averaged over renders of a few
+       seeds), which falls with more samples until it reaches bias of the
+       photon map, and time to reach given error (fitted to measurements),
+       with ratio of times of both methods.
+
+       Photon map replaces only light of caustic paths, while paths reaching
+       the light directly after diffuse bounces are as noisy as in plain path
+       tracing (there is no sampling of lights), so the photon map pays off
+       only if caustics dominate the error."""
+    params = dict(DEFAULT_RENDERER_PARAMS, width=width, height=height,
+                  first_bounce_u_samples=1, first_bounce_v_samples=1)
+    photons = {'photon_count': _PHOTONS_PER_PIXEL * width * height}
+    max_samples = 2 ** repeats
+    sample_counts = [2 ** index for index in range(repeats + 1)]
+
+    print("Caustics benchmark ({}x{}, {} photons, radius {}, {} seeds):".format( \
+        width, height, photons['photon_count'], params['photon_radius'], _ERROR_SEEDS))
+    start_time = time.time()
+    references = [_render_colours('caustics', dict( \
+        params, samples_per_pixel=8 * max_samples, seed=derive_seed('reference', index)))[0]
+                  for index in range(2)]
+    print("  references: {:.1f} s".format(time.time() - start_time))
+
+    results = {'plain': ([], []), 'photon map': ([], [])}
+    for samples in sample_counts:
+        row = []
+        for name, extra in [('plain', {}), ('photon map', photons)]:
+            errors = []
+            timings = []
+            for index in range(_ERROR_SEEDS):
+                colours, elapsed = _render_colours('caustics', dict( \
+                    params, samples_per_pixel=samples, seed=derive_seed(samples, index), **extra))
+                errors.append(_squared_error(colours, references))
+                timings.append(elapsed)
+            results[name][0].append(np.mean(errors))
+            results[name][1].append(np.mean(timings))
+            row.extend([np.mean(timings), np.sqrt(max(0.0, np.mean(errors)))])
+        print("    {:5} spp: plain {:8.2f} s, error {:.4f}; photon map {:8.2f} s,"
+              " error {:.4f}".format(samples, *row))
+    reach_times = {}
+    for name, (errors, timings) in results.items():
+        reached = _time_to_error(sample_counts, errors, timings, target_error)
+        if reached is None:
+            print("  {:10} does not reach error {}".format(name, target_error))
+        else:
+            print("  {:10} reaches error {} in {:.2f} s ({:.0f} spp)".format( \
+                name, target_error, *reached))
+            reach_times[name] = reached[0]
+    if len(reach_times) == 2:
+        print("  photon map takes {:.2f} times the time of plain path tracing".format( \
+            reach_times['photon map'] / reach_times['plain']))
+
+
+BENCHMARKS = { \
+    'precision': bench_precision,
+    'caustics': bench_caustics}
+
+
+if __name__ == '__main__':
+    bench_name = 'precision'
+    bench_width = 1920
+    bench_height = 1080
+    bench_repeats = 3
+
+    if len(sys.argv) > 1:
+        bench_name = sys.argv[1]
+        for arg in sys.argv[2:]:
+            if arg.startswith('-w'):
+                bench_width = int(arg.strip().split('=', 1)[1])
+            elif arg.startswith('-h'):
+                bench_height = int(arg.strip().split('=', 1)[1])
+            elif arg.startswith('-r'):
+                bench_repeats = int(arg.strip().split('=', 1)[1])
+            else:
+                assert False, 'Unknown command line argument.'
+
+    assert bench_name in BENCHMARKS, "Unknown benchmark name"
+    BENCHMARKS[bench_name](bench_width, bench_height, bench_repeats)
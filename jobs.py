@@ -0,0 +1,108 @@
+"""Executable script managing persistent queue of render jobs.
+
+   Usage:
+     jobs.py submit <scene> [-p=params.json] [-o=output.png] [-q=queue.db]
+     jobs.py work [-n=processes] [-l=lease_seconds] [-q=queue.db] [-v]
+     jobs.py status [-q=queue.db]
+     jobs.py collect <job_id> [-o=output.png] [-q=queue.db]
+     jobs.py reset [-q=queue.db]"""
+
+import random
+import sys
+from multiprocessing import Process
+
+import numpy as np
+
+from ptrace.core import create_renderer
+from ptrace.oop.job_queue import JobQueue, DEFAULT_LEASE_TIME, run_queue_worker
+
+
+def _renderer_factory(scene_name, params):
+    """Creates renderer of job with given scene and parameters."""
+    return create_renderer(scene_name, None, params)
+
+def _work(queue_path, lease_time, verbose):
+    """Runs queue worker in current process."""
+    random.seed()
+    np.random.seed()
+    queue = JobQueue(queue_path, lease_time)
+    run_queue_worker(queue, _renderer_factory, verbose=verbose)
+    queue.close()
+
+
+if __name__ == '__main__':
+    assert len(sys.argv) > 1, 'Missing command.'
+    command = sys.argv[1]
+    positional = [arg for arg in sys.argv[2:] if not arg.startswith('-')]
+    queue_path = './render_jobs.db'
+    params_path = None
+    output_path = None
+    processes = 1
+    lease = DEFAULT_LEASE_TIME
+    verbose = False
+
+    for arg in sys.argv[2:]:
+        if not arg.startswith('-'):
+            continue
+        if arg.startswith('-q'):
+            queue_path = arg.strip().split('=', 1)[1]
+        elif arg.startswith('-p'):
+            params_path = arg.strip().split('=', 1)[1]
+        elif arg.startswith('-o'):
+            output_path = arg.strip().split('=', 1)[1]
+        elif arg.startswith('-n'):
+            processes = int(arg.strip().split('=', 1)[1])
+        elif arg.startswith('-l'):
+            lease = float(arg.strip().split('=', 1)[1])
+        elif arg.startswith('-v'):
+            verbose = True
+        else:
+            assert False, 'Unknown command line argument.'
+
+    job_queue = JobQueue(queue_path, lease)
+
+    if command == 'submit':
+        assert positional, 'Missing scene name.'
+        scene_name = positional[0]
+        if not output_path:
+            output_path = './' + scene_name + '.png'
+        job_id = job_queue.submit(scene_name, create_renderer(scene_name, params_path),
+                                  output_path)
+        print("Submitted job {} rendering scene '{}' to: {}".format(job_id, scene_name,
+                                                                   output_path))
+
+    elif command == 'work':
+        workers = [Process(target=_work, args=(queue_path, lease, verbose))
+                   for _ in range(processes)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+    elif command == 'status':
+        for job in job_queue.jobs():
+            print("Job {id:4}: {scene:12} {status:8} tiles done {tiles_done:6}/{tiles:6} "
+                  "(claimed {tiles_claimed}), output: {output_path}".format(**job))
+
+    elif command == 'collect':
+        assert positional, 'Missing job id.'
+        job_id = int(positional[0])
+        job = job_queue.job(job_id)
+        assert job is not None, 'Unknown job id.'
+        output = job_queue.result(job_id)
+        output_path = output_path or job['output_path']
+        if output_path.endswith('.npy'):
+            output.save_as_npy(output_path)
+        else:
+            output.save_as_png(output_path)
+        print("Job {} ({}, {}/{} tiles) saved as '{}'.".format(job_id, job['status'],
+                                                              job['tiles_done'], job['tiles'],
+                                                              output_path))
+
+    elif command == 'reset':
+        print("Released {} claimed tiles.".format(job_queue.release_all()))
+
+    else:
+        assert False, 'Unknown command.'
+
+    job_queue.close()
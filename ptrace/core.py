@@ -1,11 +1,23 @@
 """Executable script for path tracing renderer module."""
 
+import json
+import os
+import time
+
 from .oop.vector import Vec3
 from .oop.utils import load_params
 from .oop.scene_settings import MaterialData
 from .oop.oop_renderer import Renderer, DEFAULT_RENDERER_PARAMS
 from .oop.camera import Camera
 from .oop.oop_scene import SceneBuilder
+from .oop.image_output import AccumulableImage
+from .oop.denoise import denoise_image
+from .oop.scene_file import is_scene_file, load_scene_file
+from .oop.scene_generators import sphere_grid, sphere_field, tessellated_sphere, \
+    instanced_spheres, caustic_cup
+from .oop.batch import load_manifest, run_batch, print_batch_summary
+from .oop.animation import Animation, render_sequence
+from .oop.autotune import DEFAULT_TUNING_PATH, TuningCache, apply_tuning, scene_class
 
 
 def create_sphere_scene(params):
@@ -75,23 +87,184 @@ def create_spheres_scene(params):
 
     return Renderer(scb.scene, cam, params)
 
+def _scene_size(params, default):
+    """Returns size of generated scene given in parameters (or default)."""
+    return params['scene_size'] if params and params.get('scene_size') is not None else default
+
+def create_sphere_grid_scene(params):
+    """Creates renderer for a scene with grid of scene_size x scene_size
+       (default 8 x 8) spheres."""
+    return sphere_grid(_scene_size(params, 8)).create_renderer(params)
+
+def create_sphere_field_scene(params):
+    """Creates renderer for a scene with scene_size (default 100) random
+       spheres generated from scene_seed."""
+    seed = params.get('scene_seed', 0) if params else 0
+    return sphere_field(_scene_size(params, 100), seed).create_renderer(params)
+
+def create_sphere_mesh_scene(params):
+    """Creates renderer for a scene with sphere tessellated into about
+       scene_size (default 2000) triangles."""
+    return tessellated_sphere(_scene_size(params, 2000)).create_renderer(params)
+
+def create_sphere_instances_scene(params):
+    """Creates renderer for a scene with scene_size (default 100) randomly
+       placed instances of single tessellated sphere mesh."""
+    seed = params.get('scene_seed', 0) if params else 0
+    return instanced_spheres(_scene_size(params, 100), seed).create_renderer(params)
+
+def create_caustics_scene(params):
+    """Creates renderer for a scene with concave mirror and glass-like sphere
+       casting caustics onto the ground."""
+    return caustic_cup().create_renderer(params)
+
+
+# minimal interval (in seconds) between saving partial results
+_PROGRESS_INTERVAL = 1.0
+
 
 SCENES = { \
     'sphere' : create_sphere_scene,
-    'spheres' : create_spheres_scene}
+    'spheres' : create_spheres_scene,
+    'sphere_grid' : create_sphere_grid_scene,
+    'sphere_field' : create_sphere_field_scene,
+    'sphere_mesh' : create_sphere_mesh_scene,
+    'sphere_instances' : create_sphere_instances_scene,
+    'caustics' : create_caustics_scene}
 
 
-def create_renderer(scene_name, params_path=None):
-    """Creates renderer from given scene_name and optional path to parameters
-       json file."""
-    assert scene_name in SCENES, "Unknown scene name"
+def create_renderer(scene_name, params_path=None, overrides=None,
+                    tuning_path=DEFAULT_TUNING_PATH):
+    """Creates renderer from given scene_name (or path to json or binary scene
+       file) and optional path to parameters json file (with values optionally
+       overridden by given dictionary). Performance parameters not given
+       explicitly (in parameters file or overrides) are taken from tuning
+       file at given path (unless it is None) if they were tuned for class of
+       the scene on this host."""
+    assert scene_name in SCENES or is_scene_file(scene_name), "Unknown scene name"
     params = load_params(params_path) if params_path else None
-    return SCENES[scene_name](params)
+    explicit = set(params or ()) | set(overrides or ())
+    if overrides:
+        params = dict(params if params is not None else DEFAULT_RENDERER_PARAMS, **overrides)
+    if scene_name not in SCENES:
+        renderer = load_scene_file(scene_name, params)
+    else:
+        renderer = SCENES[scene_name](params)
+    if tuning_path:
+        apply_tuning(renderer, scene_class(scene_name, renderer), explicit,
+                     TuningCache(tuning_path))
+    return renderer
+
+def _save_image(image, path):
+    """Saves given accumulable image as npy file (if given path has such
+       extension) or png image."""
+    if path.endswith('.npy'):
+        image.save_as_npy(path)
+    else:
+        image.save_as_png(path)
+
+#pylint: disable=too-many-arguments
 
-def render_to_png(renderer, output_path, verbose):
+def render_to_png(renderer, output_path, verbose, progress_path=None, coordinator=None,
+                  cache=None):
     """Uses given renderer to render its scene and save it to given destination
-       path as png file."""
-    output = renderer.render(verbose)
-    output.save_as_png(output_path)
+       path as png file.
+
+       If progress path is given, partial results are periodically saved there
+       while rendering. In progressive mode ('progressive' parameter) reduced
+       resolution previews are saved next to the output and progress path
+       defaults to the one with '_progress' suffix. If 'denoise' parameter is
+       set, denoised image is saved next to the output too (with '_denoised'
+       suffix). If distributed rendering coordinator is given, tiles are
+       rendered by workers connected to it instead. If render cache is given,
+       cached image is returned (or resumed) if available."""
+    base_path = os.path.splitext(output_path)[0]
+    if renderer.params['progressive'] and not progress_path:
+        progress_path = base_path + '_progress.png'
+
+    update = None
+    if progress_path:
+        last_saved = [0.0]
+        def save_progress(output, _):
+            if time.time() - last_saved[0] >= _PROGRESS_INTERVAL:
+                output.save_as_png(progress_path)
+                last_saved[0] = time.time()
+        update = save_progress
+
+    if coordinator is not None:
+        output = coordinator.run(verbose, update)
+    elif renderer.params['progressive']:
+        def emit(image, label):
+            if label == 'progress':
+                update(image, None)
+            else:
+                image.save_as_png('{}_{}.png'.format(base_path, label))
+        output = renderer.render_progressive(emit, verbose)
+    elif cache is not None:
+        output = cache.render(renderer, verbose, update)
+    else:
+        output = renderer.render(verbose, update)
+
+    _save_image(output, output_path)
     if verbose:
         print("Renderes image saved as '{}'.".format(output_path))
+
+    if renderer.params['denoise']:
+        denoised_path = '{}_denoised{}'.format(*os.path.splitext(output_path))
+        denoised = AccumulableImage.from_colours( \
+            denoise_image(output, renderer.render_aov_buffers()))
+        _save_image(denoised, denoised_path)
+        if verbose:
+            print("Denoised image saved as '{}'.".format(denoised_path))
+
+#pylint: enable=too-many-arguments
+
+def save_aovs(renderer, output_path, verbose):
+    """Renders AOV buffers (albedo, normal, depth and primitive index) of the
+       renderer's scene and saves them to a single npz file (if given path has
+       such extension) or separate png images with buffer name suffixes."""
+    buffers = renderer.render_aov_buffers()
+    if output_path.endswith('.npz'):
+        buffers.save_as_npz(output_path)
+    else:
+        buffers.save_as_pngs(os.path.splitext(output_path)[0])
+    if verbose:
+        print("AOV buffers saved as '{}'.".format(output_path))
+
+def _batch_renderer_factory(scene_name, params):
+    """Creates renderer of given scene with given parameters."""
+    return create_renderer(scene_name, None, params)
+
+def render_batch(manifest_path, summary_path, verbose):
+    """Renders all jobs of given batch manifest to png (or npy) files in a
+       single process and saves json summary of their timings to given
+       path."""
+    def render_job(renderer, output_path):
+        render_to_png(renderer, output_path, False)
+
+    summary = run_batch(load_manifest(manifest_path), _batch_renderer_factory, render_job,
+                        verbose)
+    with open(summary_path, 'w', encoding='utf-8') as jsonfile:
+        json.dump(summary, jsonfile, indent=2)
+    if verbose:
+        print_batch_summary(summary)
+        print("Batch summary saved as '{}'.".format(summary_path))
+
+def render_animation(renderer, animation_path, output_path, verbose):
+    """Renders all frames of animation loaded from given json file, saving
+       them as png (or npy) files named by given output path with frame
+       numbers (formatted with it if it contains '{}' field, appended to its
+       base name otherwise)."""
+    if '{' not in output_path:
+        output_path = '{}_{{:04d}}{}'.format(*os.path.splitext(output_path))
+
+    def save_frame(frame, output):
+        frame_path = output_path.format(frame)
+        if frame_path.endswith('.npy'):
+            output.save_as_npy(frame_path)
+        else:
+            output.save_as_png(frame_path)
+
+    render_sequence(renderer, Animation.load(animation_path), save_frame, verbose=verbose)
+    if verbose:
+        print("Frames saved as '{}'.".format(output_path))
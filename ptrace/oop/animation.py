@@ -0,0 +1,269 @@
+"""Keyframed animation of camera and scene primitives, and rendering of frame
+   sequences on a pool of worker processes.
+
+   Animation is described by json file:
+     {"frames": count,
+      "camera": {"eye": keys, "look_at": keys, "up": keys, "vertical_fov": keys,
+                 "orbit": keys},
+      "objects": [{"primitives": [index, ...] or "range": [begin, end],
+                   "translate": keys, "rotate": keys,
+                   "pivot": [x, y, z], "axis": [x, y, z]}]}
+   where keys are lists of [frame, value] pairs, interpolated linearly between
+   frames (and held before the first and after the last key). Camera values
+   default to the ones of the scene camera; 'orbit' rotates the eye by given
+   angle (in degrees) around 'up' direction through the point looked at.
+   Objects (groups of primitives given by indices) are rotated by 'rotate'
+   angle (in degrees) around given axis (y by default) through given pivot
+   (origin by default), then translated by 'translate' vector."""
+
+import json
+import math
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import numpy as np
+
+from .vector import Vec3, rotation_matrix
+from .camera import Camera
+from .oop_primitives import Sphere, Triangle
+from .image_output import AccumulableImage
+from .tile_scheduler import make_tile
+from .bvh import BvhCache
+from .utils import derive_seed
+
+
+#pylint: disable=too-few-public-methods
+
+class Keyframes():
+    """Values (numbers or vectors) given at key frames, linearly interpolated
+       between them."""
+
+    frames = None
+    values = None
+
+    def __init__(self, keys):
+        """Creates keyframes from given list of (frame, value) pairs."""
+        assert keys, "Empty list of keys"
+        keys = sorted(keys, key=lambda key: key[0])
+        self.frames = np.array([frame for frame, _ in keys], dtype='double')
+        self.values = np.array([value for _, value in keys], dtype='double')
+
+    def at(self, frame):
+        """Returns value at given frame."""
+        if self.values.ndim == 1:
+            return float(np.interp(frame, self.frames, self.values))
+        return np.array([np.interp(frame, self.frames, self.values[:, axis])
+                         for axis in range(self.values.shape[1])])
+
+#pylint: enable=too-few-public-methods
+
+
+class Animation():
+    """Description of keyframed camera and object transforms."""
+
+    frame_count = None
+    camera = None
+    objects = None
+
+    def __init__(self, frame_count, camera=None, objects=None):
+        """Creates animation of given number of frames with given camera
+           keyframes (by name) and objects (dictionaries with primitive
+           indices, transform keyframes, pivot and rotation axis)."""
+        assert frame_count > 0
+        self.frame_count = frame_count
+        self.camera = camera if camera is not None else {}
+        self.objects = objects if objects is not None else []
+
+    @staticmethod
+    def from_dict(desc):
+        """Creates animation from its json description."""
+        camera = {name: Keyframes(keys) for name, keys in desc.get('camera', {}).items()}
+        assert set(camera) <= {'eye', 'look_at', 'up', 'vertical_fov', 'orbit'}, \
+            "Unknown camera keyframes"
+        objects = []
+        for obj in desc.get('objects', []):
+            indices = obj['primitives'] if 'primitives' in obj else range(*obj['range'])
+            objects.append({ \
+                'primitives': list(indices),
+                'translate': Keyframes(obj['translate']) if 'translate' in obj else None,
+                'rotate': Keyframes(obj['rotate']) if 'rotate' in obj else None,
+                'pivot': np.array(obj.get('pivot', [0.0, 0.0, 0.0]), dtype='double'),
+                'axis': np.array(obj.get('axis', [0.0, 1.0, 0.0]), dtype='double')})
+        return Animation(desc['frames'], camera, objects)
+
+    @staticmethod
+    def load(path):
+        """Loads animation from json file."""
+        with open(path, 'r', encoding='utf-8') as jsonfile:
+            return Animation.from_dict(json.load(jsonfile))
+
+
+#pylint: disable=too-few-public-methods
+
+class SceneAnimator():
+    """Poses scene and camera of a renderer for frames of an animation,
+       reusing its scene (and refitting its bounding volume hierarchy,
+       retracing its photon map and dropping its cached primary hits).
+       Seeded renderers get seed derived from their 'seed' parameter and
+       the frame, so that noise differs between frames."""
+
+    renderer = None
+    animation = None
+    frame = None
+    _rest_seed = None
+    _rest_camera = None
+    _rest_primitives = None
+
+    def __init__(self, renderer, animation):
+        """Creates animator of given renderer, capturing its current camera
+           and scene as rest pose."""
+        self.renderer = renderer
+        self.animation = animation
+        self._rest_seed = renderer.params['seed']
+        camera = renderer.camera
+        self._rest_camera = { \
+            'eye': camera.position.data().astype('double'),
+            'look_at': camera.look_at.data().astype('double'),
+            'up': camera.basis.y_axis.data().astype('double'),
+            'vertical_fov': math.degrees(2.0 * math.atan(1.0 / camera.camera_plane_dist))}
+        self._rest_primitives = {}
+        for obj in animation.objects:
+            for index in obj['primitives']:
+                prim = renderer.scene.primitives[index]
+                if isinstance(prim, Sphere):
+                    self._rest_primitives[index] = prim.centre.data().astype('double')
+                else:
+                    assert isinstance(prim, Triangle), "Only spheres and triangles can move"
+                    self._rest_primitives[index] = ( \
+                        np.array([vertex.data() for vertex in prim.vertices], dtype='double'),
+                        np.array([normal.data() for normal in prim.normals], dtype='double'))
+
+    def set_frame(self, frame):
+        """Poses camera and primitives for given frame."""
+        if frame == self.frame:
+            return
+        self.frame = frame
+        if self._rest_seed is not None:
+            self.renderer.params = dict(self.renderer.params,
+                                        seed=derive_seed(self._rest_seed, frame))
+        self._pose_camera(frame)
+        if self.renderer.primary_hits is not None:
+            self.renderer.primary_hits = {}
+        scene = self.renderer.scene
+        for obj in self.animation.objects:
+            rotation = rotation_matrix(obj['axis'], obj['rotate'].at(frame)) \
+                       if obj['rotate'] is not None else np.eye(3)
+            offset = obj['translate'].at(frame) if obj['translate'] is not None \
+                     else np.zeros(3)
+            for index in obj['primitives']:
+                prim = scene.primitives[index]
+                if isinstance(prim, Sphere):
+                    centre = (self._rest_primitives[index] - obj['pivot']) @ rotation.T + \
+                             obj['pivot'] + offset
+                    prim.centre = Vec3(arr=centre)
+                else:
+                    vertices, normals = self._rest_primitives[index]
+                    vertices = (vertices - obj['pivot']) @ rotation.T + obj['pivot'] + offset
+                    prim.vertices = [Vec3(arr=vertex) for vertex in vertices]
+                    prim.normals = [Vec3(arr=normal) for normal in normals @ rotation.T]
+        if self.animation.objects and scene.has_bvh():
+            cache_path = self.renderer.params['bvh_cache_path']
+            scene.refit_bvh(BvhCache(cache_path) if cache_path else None)
+        if self.animation.objects and self.renderer.photon_map is not None:
+            self.renderer.trace_photons()
+
+    def _pose_camera(self, frame):
+        """Sets up renderer's camera for given frame."""
+        tracks = self.animation.camera
+        pose = {name: tracks[name].at(frame) if name in tracks else value
+                for name, value in self._rest_camera.items()}
+        if 'orbit' in tracks:
+            pose['eye'] = (pose['eye'] - pose['look_at']) @ \
+                          rotation_matrix(pose['up'], tracks['orbit'].at(frame)).T + \
+                          pose['look_at']
+        old = self.renderer.camera
+        camera = Camera(Vec3(arr=pose['eye']), Vec3(arr=pose['look_at']),
+                        Vec3(arr=pose['up']).normalised(), self.renderer.params['width'],
+                        self.renderer.params['height'], pose['vertical_fov'])
+        camera.aperture_radius = old.aperture_radius
+        camera.focal_distance = old.focal_distance
+        self.renderer.camera = camera
+
+#pylint: enable=too-few-public-methods
+
+
+_WORKER_ANIMATOR = None
+
+def _init_sequence_worker(renderer, animation):
+    """Initializes worker process with given renderer and animation
+       (reseeding random generators of unseeded renderers, as workers would
+       otherwise share state of the parent process)."""
+    global _WORKER_ANIMATOR #pylint: disable=global-statement
+    _WORKER_ANIMATOR = SceneAnimator(renderer, animation)
+    if renderer.params['seed'] is None:
+        random.seed()
+        np.random.seed()
+
+def _render_frame_tile_job(frame, tile):
+    """Renders given tile of given frame in worker process."""
+    _WORKER_ANIMATOR.set_frame(frame)
+    return _WORKER_ANIMATOR.renderer.render_tile(tile)
+
+
+#pylint: disable=too-many-locals
+
+def render_sequence(renderer, animation, save_frame, frames=None, verbose=False):
+    """Renders given frames (all by default) of animation of renderer's scene,
+       calling save function with frame index and its image once each frame
+       is done.
+
+       With single cpu ('max_cpus' parameter) frames are rendered in turn as
+       regular images. Otherwise frames are distributed across pool of worker
+       processes (each keeping its own posed copy of the scene), split into
+       tiles if there are fewer frames than workers."""
+    frames = list(frames) if frames is not None else list(range(animation.frame_count))
+    workers = max(1, renderer.params['max_cpus'])
+    start_time = time.time()
+
+    if workers == 1:
+        animator = SceneAnimator(renderer, animation)
+        for frame in frames:
+            animator.set_frame(frame)
+            save_frame(frame, renderer.render())
+            if verbose:
+                print("Frame {} done ({:.2f} s elapsed).".format(frame, time.time() - start_time))
+        return
+
+    width = renderer.params['width']
+    height = renderer.params['height']
+    samples = renderer.params['samples_per_pixel']
+    if len(frames) >= workers:
+        tiles = [make_tile((0, width), (0, height), samples, 0, width, height)]
+    else:
+        tiles = renderer.generate_tiles(renderer.params['tile_size'], renderer.params['tile_size'],
+                                        samples, renderer.params['samples_per_tile'])
+
+    outputs = {}
+    remaining = {frame: len(tiles) for frame in frames}
+    with ProcessPoolExecutor(workers, initializer=_init_sequence_worker,
+                             initargs=(renderer, animation)) as pool:
+        running = {pool.submit(_render_frame_tile_job, frame, tile): (frame, tile)
+                   for frame in frames for tile in tiles}
+        while running:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                frame, tile = running.pop(future)
+                if frame not in outputs:
+                    outputs[frame] = AccumulableImage(width, height, renderer.params['precision'],
+                                                      renderer.needs_variance())
+                outputs[frame].add_image_block(tile['x_range'][0], tile['y_range'][0],
+                                               future.result())
+                remaining[frame] -= 1
+                if remaining[frame] == 0:
+                    save_frame(frame, outputs.pop(frame))
+                    if verbose:
+                        print("Frame {} done ({:.2f} s elapsed).".format( \
+                            frame, time.time() - start_time))
+
+#pylint: enable=too-many-locals
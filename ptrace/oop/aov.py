@@ -0,0 +1,117 @@
+"""Vectorized first-hit renderer of arbitrary output variables (AOVs), i.e.
+   albedo, shading normal, depth and primitive index buffers."""
+
+import numpy as np
+from PIL import Image
+
+from .utils import colours2bytes
+
+
+AOV_NAMES = ('albedo', 'normal', 'depth', 'primitive_id')
+
+
+class AovBuffers():
+    """Stores per-pixel AOV buffers of an image, i.e. albedo and normal arrays
+       of shape (width, height, 3), as well as depth (infinite for pixels
+       where nothing was hit) and primitive index (-1 for misses) arrays of
+       shape (width, height)."""
+
+    width = None
+    height = None
+    albedo = None
+    normal = None
+    depth = None
+    primitive_id = None
+
+    def __init__(self, width, height, dtype='double'):
+        """Initializes empty buffers for image of given dimensions."""
+        self.width = width
+        self.height = height
+        self.albedo = np.zeros((width, height, 3), dtype=dtype)
+        self.normal = np.zeros((width, height, 3), dtype=dtype)
+        self.depth = np.full((width, height), np.inf, dtype=dtype)
+        self.primitive_id = np.full((width, height), -1, dtype='int32')
+
+    def save_as_npz(self, output_path):
+        """Saves all buffers to a single multi-channel npz file."""
+        np.savez_compressed(output_path, **{name: getattr(self, name) for name in AOV_NAMES})
+
+    @staticmethod
+    def load_npz(path):
+        """Loads buffers previously saved to npz file."""
+        with np.load(path) as data:
+            depth = np.asarray(data['depth'])
+            result = AovBuffers(depth.shape[0], depth.shape[1], depth.dtype)
+            for name in AOV_NAMES:
+                setattr(result, name, data[name])
+        return result
+
+    def save_as_pngs(self, base_path):
+        """Saves buffers as separate png images with paths made of given base
+           path and buffer name suffixes (e.g. 'base_albedo.png').
+
+           Normals are mapped from [-1, 1] to [0, 1] range, depth is normalized
+           (closer is brighter) and primitive indices get arbitrary distinct
+           colours."""
+        hit_mask = self.primitive_id >= 0
+        depth = np.zeros((self.width, self.height))
+        if np.any(hit_mask):
+            finite = self.depth[hit_mask]
+            span = max(float(finite.max() - finite.min()), 1e-12)
+            depth[hit_mask] = 1.0 - (finite - finite.min()) / span * 0.9
+
+        rng = np.random.default_rng(0)
+        palette = rng.random((int(self.primitive_id.max()) + 2, 3))
+        palette[0] = 0.0
+
+        images = { \
+            'albedo': colours2bytes(self.albedo),
+            'normal': np.floor(np.clip(self.normal * 0.5 + 0.5, 0.0, 1.0) * 255.0).astype('uint8'),
+            'depth': np.floor(depth * 255.0).astype('uint8'),
+            'primitive_id': np.floor(palette[self.primitive_id + 1] * 255.0).astype('uint8')}
+        for name, data in images.items():
+            Image.fromarray(data).save('{}_{}.png'.format(base_path, name))
+
+
+#pylint: disable=too-many-arguments
+#pylint: disable=too-many-locals
+
+def render_aovs(scene, camera, width, height, batch_size=65536, dtype='double', jitter=False):
+    """Casts camera rays through all pixels (their centres unless jitter is
+       enabled) of image of given dimensions in batches of given size and
+       returns AOV buffers of first hits. Albedo of primitives without
+       single material (instances of meshes of many materials) is resolved
+       per hit."""
+    buffers = AovBuffers(width, height, dtype)
+    albedo = _albedo_table(scene, dtype)
+    per_hit = np.array([prim.material is None for prim in scene.primitives] + [False])
+    px_x, px_y = np.divmod(np.arange(width * height), height)
+
+    for beg in range(0, width * height, batch_size):
+        end = min(beg + batch_size, width * height)
+        pixels = (px_x[beg:end], px_y[beg:end])
+        rays = camera.get_rays(pixels[0], pixels[1], jitter, dtype)
+        hits = scene.hit_batch(rays)
+        buffers.albedo[pixels] = albedo[hits.primitive_ids]
+        for index in np.flatnonzero(per_hit[hits.primitive_ids]).tolist():
+            hit = scene.primitives[hits.primitive_ids[index]].intersect_ex( \
+                rays[index:index + 1].astype('double')[0])
+            if hit is not None and hit['material'] is not None:
+                buffers.albedo[pixels[0][index], pixels[1][index]] = \
+                    hit['material'].preview_colour().data()
+        buffers.normal[pixels] = hits.normals
+        buffers.depth[pixels] = hits.distances
+        buffers.primitive_id[pixels] = hits.primitive_ids
+    return buffers
+
+#pylint: enable=too-many-locals
+#pylint: enable=too-many-arguments
+
+def _albedo_table(scene, dtype):
+    """Returns array of preview colours of scene primitives (black for ones
+       without single material, with environment colour appended at the end,
+       so that it is indexed by -1)."""
+    colours = [prim.material.preview_colour().data() if prim.material is not None
+               else np.zeros(3) for prim in scene.primitives]
+    colours.append(scene.environment_colour.data())
+    return np.array(colours, dtype=dtype)
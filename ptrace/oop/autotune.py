@@ -0,0 +1,207 @@
+"""Auto-tuning of performance parameters (ray batch size, tile size and number
+   of worker processes) by timing short calibration renders, and json file
+   storing tuned parameters by host name and class of scene.
+
+   Scene class is the scene name (or base name of scene file) with order of
+   magnitude of number of its primitives, e.g. 'sphere_field:1e2'. Tuned
+   values replace defaults of renders of scenes of the same class on the
+   same host, but never parameters given explicitly."""
+
+import json
+import math
+import os
+import socket
+import tempfile
+import time
+import warnings
+
+import numpy as np
+
+from .image_output import AccumulableImage
+from .tile_scheduler import TileScheduler, make_tile, run_scheduler, start_tile_pool
+
+
+DEFAULT_TUNING_PATH = os.path.join(os.path.expanduser('~'), '.ptrace', 'tuning.json')
+
+TUNED_PARAMS = ('ray_batch_size', 'tile_size', 'max_cpus')
+
+BATCH_SIZES = (1024, 4096, 16384, 65536)
+TILE_SIZES = (8, 16, 32, 64)
+
+# side of central region of the image whose camera rays calibrate batch sizes
+_BATCH_REGION = 256
+# number of tiles (of the largest size) per worker in region calibrating tiles
+_TILES_PER_WORKER = 2
+
+
+def host_name():
+    """Returns name of the host tuned parameters are stored under."""
+    return socket.gethostname()
+
+def scene_class(scene_name, renderer):
+    """Returns class of scene of given name (or path to scene file) rendered
+       by given renderer."""
+    count = max(1, len(renderer.scene.primitives))
+    return '{}:1e{}'.format(os.path.splitext(os.path.basename(scene_name))[0],
+                            int(math.log10(count)))
+
+def default_worker_counts():
+    """Returns worker counts tried by default: powers of two below number of
+       CPUs of the host and that number itself."""
+    cpus = os.cpu_count() or 1
+    return sorted({1 << exp for exp in range(cpus.bit_length()) if 1 << exp < cpus} | {cpus})
+
+def _central_range(size, extent):
+    """Returns range of (at most) given extent in the middle of given size."""
+    beg = max(0, (size - extent) // 2)
+    return beg, min(size, beg + extent)
+
+def time_batches(renderer, batch_size, region=_BATCH_REGION):
+    """Returns time of intersecting camera rays of central region of the image
+       (of given side) with the scene in batches of given size."""
+    x_beg, x_end = _central_range(renderer.params['width'], region)
+    y_beg, y_end = _central_range(renderer.params['height'], region)
+    px_x, px_y = np.divmod(np.arange((x_end - x_beg) * (y_end - y_beg)), y_end - y_beg)
+    rays = renderer.camera.get_rays(px_x + x_beg, px_y + y_beg,
+                                    dtype=renderer.params['precision'])
+    start_time = time.time()
+    for beg in range(0, len(rays), batch_size):
+        renderer.scene.hit_batch(rays[beg:beg + batch_size])
+    return time.time() - start_time
+
+def time_tiles(renderer, tile_size, workers, region, submit_tile=None):
+    """Returns time of rendering single sample of central region of the image
+       (of given side) in tiles of given size by given number of worker
+       processes, as in tiled rendering (on pool of workers given by tile
+       submitting function, if given, so that starting it is not timed)."""
+    width, height = renderer.params['width'], renderer.params['height']
+    x_beg, x_end = _central_range(width, region)
+    y_beg, y_end = _central_range(height, region)
+    tiles = [make_tile((x_pos, min(x_pos + tile_size, x_end)),
+                       (y_pos, min(y_pos + tile_size, y_end)), 1, 0, width, height)
+             for x_pos in range(x_beg, x_end, tile_size)
+             for y_pos in range(y_beg, y_end, tile_size)]
+    scheduler = TileScheduler(tiles, width, height, workers, renderer.params['target_tile_time'],
+                              order=renderer.params['tile_order'])
+    output = AccumulableImage(x_end, y_end, renderer.params['precision'],
+                              renderer.needs_variance())
+    start_time = time.time()
+    run_scheduler(renderer, scheduler, output, workers, submit_tile=submit_tile)
+    return time.time() - start_time
+
+#pylint: disable=too-many-arguments
+
+def _fastest(candidates, timer, repeats, name, verbose):
+    """Returns candidate value with the lowest time (best of given number of
+       repeats) measured by given function (the only one is not timed)."""
+    if len(candidates) == 1:
+        return candidates[0]
+    timings = {}
+    for candidate in candidates:
+        timings[candidate] = min(timer(candidate) for _ in range(repeats))
+        if verbose:
+            print("  {:14} {:6}: {:8.3f} s".format(name, candidate, timings[candidate]))
+    return min(candidates, key=timings.get)
+
+def tune(renderer, batch_sizes=BATCH_SIZES, tile_sizes=TILE_SIZES, worker_counts=None,
+         repeats=1, verbose=False):
+    """Times calibration renders of given renderer and returns dictionary of
+       the fastest values of tuned parameters.
+
+       Batch sizes are timed intersecting camera rays of central region of
+       the image. Worker counts (default_worker_counts if not given) are
+       timed rendering single sample of central region large enough to give
+       each worker a few of the largest tiles, in tiles of size closest to
+       'tile_size' parameter; then tile sizes are timed with the fastest
+       worker count, on pools started once per worker count (outside of
+       timed renders). Calibration renders fill caches of the renderer (e.g.
+       learned path guide), so it should not be used for final rendering."""
+    worker_counts = worker_counts if worker_counts is not None else default_worker_counts()
+    tile_size = min(tile_sizes, key=lambda size: abs(size - renderer.params['tile_size']))
+    region = max(tile_sizes) * math.ceil(math.sqrt(_TILES_PER_WORKER * max(worker_counts)))
+
+    # warm up lazily built structures (e.g. cached primary hits)
+    time_tiles(renderer, min(tile_sizes), 1, min(tile_sizes))
+
+    if verbose:
+        print("Tuning ({width}x{height}, calibration region {region}x{region}):".format( \
+            width=renderer.params['width'], height=renderer.params['height'], region=region))
+    batch_size = _fastest(batch_sizes, lambda size: time_batches(renderer, size), repeats,
+                          'ray_batch_size', verbose)
+
+    pools = {}
+    def submitter(count):
+        if count == 1:
+            return None
+        if count not in pools:
+            pools[count] = start_tile_pool(renderer, count)
+        return pools[count][1]
+
+    try:
+        workers = _fastest(worker_counts, lambda count: time_tiles( \
+            renderer, tile_size, count, region, submitter(count)), repeats, 'max_cpus', verbose)
+        tile_size = _fastest(tile_sizes, lambda size: time_tiles( \
+            renderer, size, workers, region, submitter(workers)), repeats, 'tile_size', verbose)
+    finally:
+        for pool, _ in pools.values():
+            pool.shutdown()
+    return {'ray_batch_size': batch_size, 'tile_size': tile_size, 'max_cpus': workers}
+
+#pylint: enable=too-many-arguments
+
+
+class TuningCache():
+    """Stores tuned parameters in a json file, by host name and scene class."""
+
+    path = None
+
+    def __init__(self, path=DEFAULT_TUNING_PATH):
+        """Opens tuning file at given path (created on first update)."""
+        self.path = path
+
+    def _load(self):
+        """Returns contents of the file (empty if it does not exist; also empty,
+           with a warning, if it cannot be read or is not valid)."""
+        try:
+            with open(self.path, 'r', encoding='utf-8') as jsonfile:
+                entries = json.load(jsonfile)
+        except FileNotFoundError:
+            return {}
+        except (ValueError, OSError) as error:
+            warnings.warn("Ignoring unreadable tuning file '{}': {}".format(self.path, error))
+            return {}
+        if not isinstance(entries, dict) or \
+           not all(isinstance(classes, dict) for classes in entries.values()):
+            warnings.warn("Ignoring invalid tuning file '{}'.".format(self.path))
+            return {}
+        return entries
+
+    def get(self, scene_cls, host=None):
+        """Returns parameters tuned for scene class on given host (this host
+           by default), or None if it was not tuned."""
+        return self._load().get(host or host_name(), {}).get(scene_cls)
+
+    def put(self, scene_cls, tuned, host=None):
+        """Stores parameters tuned for scene class on given host (this host by
+           default), replacing file atomically."""
+        entries = self._load()
+        entries.setdefault(host or host_name(), {})[scene_cls] = \
+            {key: tuned[key] for key in TUNED_PARAMS if key in tuned}
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        handle, temp_path = tempfile.mkstemp(suffix='.tmp', dir=directory)
+        with os.fdopen(handle, 'w', encoding='utf-8') as jsonfile:
+            json.dump(entries, jsonfile, indent=2, sort_keys=True)
+        os.replace(temp_path, self.path)
+
+
+def apply_tuning(renderer, scene_cls, explicit=(), cache=None):
+    """Sets parameters of given renderer tuned for given scene class on this
+       host (from given cache, or default tuning file), except for explicitly
+       given ones. Returns dictionary of parameters set."""
+    tuned = (cache if cache is not None else TuningCache()).get(scene_cls) or {}
+    applied = {key: value for key, value in tuned.items()
+               if key in TUNED_PARAMS and key not in explicit}
+    if applied:
+        renderer.params = dict(renderer.params, **applied)
+    return applied
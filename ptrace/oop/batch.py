@@ -0,0 +1,199 @@
+"""Batch rendering of many scenes and parameter sets in a single process,
+   reusing created scenes and a single pool of worker processes.
+
+   Batch manifest is a json file with list of jobs:
+     [{"scene": name, "params": {...} or "params.json", "output": "image.png"}]
+   where parameters are given inline (overriding the defaults) or as path to
+   parameters file. Paths (also of scene files) are relative to the manifest."""
+
+import functools
+import json
+import os
+import random
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from .oop_renderer import Renderer, DEFAULT_RENDERER_PARAMS
+from .utils import load_params, check_params
+
+
+# number of scenes kept by scene caches
+_SCENE_CACHE_SIZE = 8
+
+# parameters affecting geometry of created scenes (the others affect only
+# resolution of their cameras, or the rendering itself)
+_SCENE_PARAMS = ('scene_size', 'scene_seed')
+
+
+def load_manifest(path):
+    """Loads batch manifest from json file. Returns list of jobs with
+       complete parameters and resolved paths."""
+    with open(path, 'r', encoding='utf-8') as jsonfile:
+        jobs = json.load(jsonfile)
+    assert isinstance(jobs, list), "Batch manifest must be a list of jobs"
+
+    base_path = os.path.dirname(path)
+    result = []
+    for job in jobs:
+        assert 'scene' in job and 'output' in job, "Batch job without scene or output"
+        params = job.get('params', {})
+        if isinstance(params, str):
+            params = load_params(os.path.join(base_path, params))
+        params = dict(DEFAULT_RENDERER_PARAMS, **params)
+        check_params(params)
+        scene_path = os.path.join(base_path, job['scene'])
+        result.append({ \
+            'scene': scene_path if os.path.isfile(scene_path) else job['scene'],
+            'params': params,
+            'output': os.path.join(base_path, job['output'])})
+    return result
+
+
+#pylint: disable=too-few-public-methods
+
+class SceneCache():
+    """Keeps least recently used scenes (with their cameras) created by given
+       renderer factory (called with scene name and parameters), so that
+       renderers for other parameters of the same scene are created without
+       building the scene again."""
+
+    renderer_factory = None
+    max_size = None
+    scenes = None
+
+    def __init__(self, renderer_factory, max_size=_SCENE_CACHE_SIZE):
+        """Creates empty cache of scenes created with given factory."""
+        self.renderer_factory = renderer_factory
+        self.max_size = max_size
+        self.scenes = OrderedDict()
+
+    def renderer(self, scene_name, params):
+        """Returns renderer of scene with given name and parameters (with
+           camera set up for their resolution)."""
+        key = (scene_name,) + tuple(params.get(name) for name in _SCENE_PARAMS)
+        if key in self.scenes:
+            self.scenes.move_to_end(key)
+            scene, camera = self.scenes[key]
+            return Renderer(scene, camera.with_resolution(params['width'], params['height']),
+                            params)
+
+        renderer = self.renderer_factory(scene_name, params)
+        self.scenes[key] = (renderer.scene, renderer.camera)
+        if len(self.scenes) > self.max_size:
+            self.scenes.popitem(last=False)
+        return renderer
+
+#pylint: enable=too-few-public-methods
+
+
+_WORKER_SCENES = None
+
+# renderer of the current job of shared pool worker process (with its key of
+# scene name and parameters json string), reused for all tiles of the job
+_WORKER_RENDERER = None
+
+def _init_pool_worker(renderer_factory):
+    """Initializes shared pool worker process with given renderer factory."""
+    global _WORKER_SCENES, _WORKER_RENDERER #pylint: disable=global-statement
+    _WORKER_SCENES = SceneCache(renderer_factory)
+    _WORKER_RENDERER = None
+    random.seed()
+    np.random.seed()
+
+def _render_pool_tile_job(scene_name, params_key, tile):
+    """Renders given tile of scene with given name and parameters (given as
+       json string) in shared pool worker process, returning rendered image
+       block and time elapsed. Renderer (with its photon map, path guide and
+       caches) is created once per job, on its first tile."""
+    global _WORKER_RENDERER #pylint: disable=global-statement
+    start_time = time.time()
+    key = (scene_name, params_key)
+    if _WORKER_RENDERER is None or _WORKER_RENDERER[0] != key:
+        _WORKER_RENDERER = (key, _WORKER_SCENES.renderer(scene_name, json.loads(params_key)))
+    block = _WORKER_RENDERER[1].render_tile(tile)
+    return block, time.time() - start_time
+
+
+class RenderPool():
+    """Pool of worker processes shared by renderers of many jobs. Workers
+       create (and cache) scenes of the jobs with given renderer factory."""
+
+    worker_count = None
+    executor = None
+
+    def __init__(self, renderer_factory, worker_count):
+        """Starts given number of worker processes."""
+        self.worker_count = worker_count
+        self.executor = ProcessPoolExecutor(worker_count, initializer=_init_pool_worker,
+                                            initargs=(renderer_factory,))
+
+    def attach(self, renderer, scene_name):
+        """Makes given renderer (of scene with given name) render its tiles on
+           the pool."""
+        renderer.submit_tile = functools.partial( \
+            self.executor.submit, _render_pool_tile_job, scene_name,
+            json.dumps(renderer.params, sort_keys=True))
+
+    def close(self):
+        """Shuts worker processes down."""
+        self.executor.shutdown()
+
+
+def run_batch(jobs, renderer_factory, render_job, verbose=False):
+    """Runs given batch jobs: renderers are created with given factory (from
+       scene cache) and rendered (and saved) by given function called with
+       renderer and output path. Jobs using more than one cpu render tiles
+       on a single pool shared by all jobs. Failing jobs are reported and
+       skipped. Returns summary of the batch with timings of jobs."""
+    start_time = time.time()
+    scenes = SceneCache(renderer_factory)
+    worker_count = max([job['params']['max_cpus'] for job in jobs] + [1])
+    pool = RenderPool(renderer_factory, worker_count) if worker_count > 1 else None
+    summary = []
+    try:
+        for index, job in enumerate(jobs):
+            if verbose:
+                print("Batch job {}/{}: scene '{}' to: {}".format(index + 1, len(jobs),
+                                                                  job['scene'], job['output']))
+            job_start = time.time()
+            entry = {'scene': job['scene'], 'output': job['output'],
+                     'width': job['params']['width'], 'height': job['params']['height']}
+            try:
+                renderer = scenes.renderer(job['scene'], job['params'])
+                entry['setup_time'] = time.time() - job_start
+                if pool is not None and renderer.params['max_cpus'] > 1:
+                    pool.attach(renderer, job['scene'])
+                render_job(renderer, job['output'])
+                entry.update(renderer.stats if renderer.stats is not None else {})
+            except (AssertionError, KeyError, ValueError, OSError) as error:
+                entry['error'] = '{}: {}'.format(type(error).__name__, error)
+                if verbose:
+                    print("Batch job {} failed with {}".format(index + 1, entry['error']))
+            entry['total_time'] = time.time() - job_start
+            summary.append(entry)
+    finally:
+        if pool is not None:
+            pool.close()
+
+    return { \
+        'jobs': summary,
+        'worker_count': worker_count,
+        'total_time': time.time() - start_time}
+
+def print_batch_summary(summary):
+    """Prints table of timings of batch jobs."""
+    print("{:>4} {:<24} {:>9} {:>8} {:>8} {:>8}  {}".format( \
+        'job', 'scene', 'size', 'spp', 'setup', 'render', 'output'))
+    for index, entry in enumerate(summary['jobs']):
+        if 'error' in entry:
+            print("{:>4} {:<24} {}".format(index + 1, entry['scene'][-24:], entry['error']))
+            continue
+        print("{:>4} {:<24} {:>9} {:>8.2f} {:>7.2f}s {:>7.2f}s  {}".format( \
+            index + 1, entry['scene'][-24:], '{}x{}'.format(entry['width'], entry['height']),
+            entry['samples_per_pixel'], entry['setup_time'], entry['render_time'],
+            entry['output']))
+    print("Batch of {} jobs done in {:.2f} s ({} workers).".format( \
+        len(summary['jobs']), summary['total_time'], summary['worker_count']))
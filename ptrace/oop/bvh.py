@@ -0,0 +1,384 @@
+"""Bounding volume hierarchy (BVH) of scene primitives stored as flat arrays,
+   and on-disk cache of built hierarchies keyed by hash of primitive bounds.
+
+   Nodes are stored in depth-first order, so left child of an inner node
+   directly follows it, while 'start' field holds index of the right child.
+   For leaves 'start' and 'count' give range of primitive indices in 'order'
+   array. Nodes and order arrays are saved as npy files, which are loaded
+   memory-mapped."""
+
+import hashlib
+import os
+import tempfile
+
+import numpy as np
+
+from .ray_order import coherent_order
+
+
+DEFAULT_LEAF_SIZE = 4
+
+NODE_DTYPE = np.dtype([('lo', 'double', 3), ('hi', 'double', 3),
+                       ('start', 'int32'), ('count', 'int32')])
+
+# relative padding of primitive bounds, so that hits at box surfaces are not
+# lost to rounding errors of slab tests
+_BOUNDS_PADDING = 1e-7
+
+# minimal number of rays of batches sorted into coherent order before traversal
+_MIN_COHERENT_RAYS = 256
+
+_NODES_FILE_EXT = '.nodes.npy'
+_ORDER_FILE_EXT = '.order.npy'
+
+
+def primitive_bounds(primitives):
+    """Returns arrays of lower and upper corners of bounding boxes of given
+       primitives (or None if some primitive is not bounded)."""
+    bounds = [primitive.bounds() for primitive in primitives]
+    if not bounds or any(bound is None for bound in bounds):
+        return None
+    return np.array([lo for lo, _ in bounds], dtype='double').reshape(-1, 3), \
+           np.array([hi for _, hi in bounds], dtype='double').reshape(-1, 3)
+
+def bounds_key(lows, highs, leaf_size):
+    """Returns hash identifying hierarchy built for primitives with given
+       bounds."""
+    digest = hashlib.sha256()
+    digest.update('{}:{}:'.format(len(lows), leaf_size).encode())
+    digest.update(np.ascontiguousarray(lows, dtype='double').tobytes())
+    digest.update(np.ascontiguousarray(highs, dtype='double').tobytes())
+    return digest.hexdigest()
+
+def occlude_rays(primitives, rays, max_distances, occluded, ray_ixs):
+    """Marks rays with given indices blocked by any of given primitives
+       before their maximum distances in given occluded array. Only rays not
+       blocked yet are tested against further primitives."""
+    for primitive in primitives:
+        blocked = primitive.occluded_batch(rays[ray_ixs], max_distances[ray_ixs])
+        occluded[ray_ixs[blocked]] = True
+        ray_ixs = ray_ixs[~blocked]
+        if len(ray_ixs) == 0:
+            break
+
+def median_split(points, leaf_size):
+    """Splits given points recursively at the median along the widest axis
+       until at most leaf_size remain. Returns order of points and list of
+       nodes in depth-first order as [axis, beg, end, right] lists, where
+       beg:end is range of order array, axis is -1 for leaves and right is
+       index of right child of inner nodes (left child follows its parent)."""
+    count = len(points)
+    order = np.arange(count, dtype='int32')
+    nodes = []
+
+    # ranges of order array, with index of parent whose right child it is
+    stack = [(0, count, -1)]
+    while stack:
+        beg, end, parent = stack.pop()
+        if parent >= 0:
+            nodes[parent][3] = len(nodes)
+        if end - beg <= leaf_size:
+            nodes.append([-1, beg, end, 0])
+            continue
+        node_points = points[order[beg:end]]
+        axis = int(np.argmax(np.ptp(node_points, axis=0)))
+        mid = (end - beg) // 2
+        order[beg:end] = order[beg:end][np.argpartition(node_points[:, axis], mid)]
+        nodes.append([axis, beg, end, 0])
+        stack.append((beg + mid, end, len(nodes) - 1))
+        stack.append((beg, beg + mid, -1))
+    return order, nodes
+
+def build_bvh(lows, highs, leaf_size=DEFAULT_LEAF_SIZE):
+    """Builds hierarchy of primitives with given bounds, splitting nodes at
+       the median of primitive centres along the widest axis."""
+    assert len(lows) > 0 and leaf_size > 0
+    order, splits = median_split((lows + highs) * 0.5, leaf_size)
+    nodes = [[beg, end - beg] if axis < 0 else [right, 0]
+             for axis, beg, end, right in splits]
+
+    bvh = Bvh(np.zeros(len(nodes), dtype=NODE_DTYPE), order)
+    bvh.nodes['start'], bvh.nodes['count'] = np.array(nodes, dtype='int32').T
+    bvh.refit(lows, highs)
+    return bvh
+
+
+class Bvh():
+    """Bounding volume hierarchy of primitives of a scene."""
+
+    nodes = None
+    order = None
+    _node_list = None
+
+    def __init__(self, nodes, order):
+        """Creates hierarchy of given nodes and primitive order arrays."""
+        self.nodes = nodes
+        self.order = order
+
+    def __getstate__(self):
+        """Returns state for pickling (without derived node list)."""
+        return {'nodes': np.asarray(self.nodes), 'order': np.asarray(self.order)}
+
+    def __setstate__(self, state):
+        """Restores pickled state."""
+        self.nodes = state['nodes']
+        self.order = state['order']
+
+    def refit(self, lows, highs):
+        """Updates bounds of nodes to given bounds of (moved) primitives,
+           keeping structure of the hierarchy."""
+        padding = _BOUNDS_PADDING * (1.0 + np.abs(lows) + np.abs(highs))
+        lows = (lows - padding)[self.order]
+        highs = (highs + padding)[self.order]
+
+        node_lo = np.array(self.nodes['lo'])
+        node_hi = np.array(self.nodes['hi'])
+        starts = self.nodes['start']
+        counts = self.nodes['count']
+        leaves = np.nonzero(counts > 0)[0]
+        # leaves in depth-first order cover consecutive ranges of order array
+        node_lo[leaves] = np.minimum.reduceat(lows, starts[leaves])
+        node_hi[leaves] = np.maximum.reduceat(highs, starts[leaves])
+        for index in np.nonzero(counts == 0)[0][::-1].tolist():
+            right = starts[index]
+            node_lo[index] = np.minimum(node_lo[index + 1], node_lo[right])
+            node_hi[index] = np.maximum(node_hi[index + 1], node_hi[right])
+
+        if not self.nodes.flags.writeable:
+            self.nodes = np.array(self.nodes)
+        self.nodes['lo'] = node_lo
+        self.nodes['hi'] = node_hi
+        self._node_list = None
+
+    def save(self, path):
+        """Saves hierarchy to npy files with given path prefix."""
+        np.save(path + _ORDER_FILE_EXT, np.asarray(self.order))
+        np.save(path + _NODES_FILE_EXT, np.asarray(self.nodes))
+
+    @staticmethod
+    def load(path):
+        """Loads hierarchy (memory-mapped) from npy files with given path
+           prefix."""
+        return Bvh(np.load(path + _NODES_FILE_EXT, mmap_mode='r'),
+                   np.load(path + _ORDER_FILE_EXT, mmap_mode='r'))
+
+    def _scalar_nodes(self):
+        """Returns nodes as list of tuples (of corner coordinates, start and
+           count) for traversal by single rays."""
+        if self._node_list is None:
+            self._node_list = [tuple(node['lo'].tolist() + node['hi'].tolist() +
+                                     [int(node['start']), int(node['count'])])
+                               for node in self.nodes]
+        return self._node_list
+
+    #pylint: disable=too-many-locals
+
+    def intersect_ex(self, ray, primitives):
+        """Checks whether given ray intersects with any of given primitives
+           (indexed by the hierarchy), returning closest hit as in
+           Scene.intersect_ex."""
+        nodes = self._scalar_nodes()
+        origin = ray.origin.data().tolist()
+        inverse = [1.0 / value if value != 0.0 else None
+                   for value in ray.direction.data().tolist()]
+
+        result = None
+        best = float('inf')
+        stack = [0]
+        while stack:
+            index = stack.pop()
+            node = nodes[index]
+            t_min, t_max = 0.0, best
+            for axis in range(3):
+                if inverse[axis] is None:
+                    if not node[axis] <= origin[axis] <= node[axis + 3]:
+                        t_min = float('inf')
+                    continue
+                t_near = (node[axis] - origin[axis]) * inverse[axis]
+                t_far = (node[axis + 3] - origin[axis]) * inverse[axis]
+                if t_near > t_far:
+                    t_near, t_far = t_far, t_near
+                t_min = max(t_min, t_near)
+                t_max = min(t_max, t_far)
+            if t_min > t_max:
+                continue
+            if node[7] == 0:
+                stack.append(node[6])
+                stack.append(index + 1)
+                continue
+            for prim_ix in self.order[node[6]:node[6] + node[7]].tolist():
+                hit = primitives[prim_ix].intersect_ex(ray)
+                if hit and hit['hit_record'].distance < best:
+                    best = hit['hit_record'].distance
+                    result = hit
+        return result
+
+    def occluded(self, ray, primitives, max_distance):
+        """Checks whether any of given primitives (indexed by the hierarchy)
+           blocks given ray before given distance, stopping at the first
+           blocker found."""
+        nodes = self._scalar_nodes()
+        origin = ray.origin.data().tolist()
+        inverse = [1.0 / value if value != 0.0 else None
+                   for value in ray.direction.data().tolist()]
+
+        stack = [0]
+        while stack:
+            index = stack.pop()
+            node = nodes[index]
+            t_min, t_max = 0.0, max_distance
+            for axis in range(3):
+                if inverse[axis] is None:
+                    if not node[axis] <= origin[axis] <= node[axis + 3]:
+                        t_min = float('inf')
+                    continue
+                t_near = (node[axis] - origin[axis]) * inverse[axis]
+                t_far = (node[axis + 3] - origin[axis]) * inverse[axis]
+                if t_near > t_far:
+                    t_near, t_far = t_far, t_near
+                t_min = max(t_min, t_near)
+                t_max = min(t_max, t_far)
+            if t_min > t_max:
+                continue
+            if node[7] == 0:
+                stack.append(node[6])
+                stack.append(index + 1)
+                continue
+            for prim_ix in self.order[node[6]:node[6] + node[7]].tolist():
+                if primitives[prim_ix].occluded(ray, max_distance):
+                    return True
+        return False
+
+    #pylint: enable=too-many-locals
+
+    def _packet_hits(self, index, ray_ixs, origins, inverses, max_distances):
+        """Returns indices of rays (from given ones) hitting bounds of node
+           with given index before given distances."""
+        node = self.nodes[index]
+        with np.errstate(invalid='ignore'):
+            t_lo = (node['lo'] - origins[ray_ixs]) * inverses[ray_ixs]
+            t_hi = (node['hi'] - origins[ray_ixs]) * inverses[ray_ixs]
+        # NaNs (rays parallel to and lying in slab planes) are ignored
+        t_min = np.fmax.reduce(np.fmin(t_lo, t_hi), axis=1)
+        t_max = np.fmin.reduce(np.fmax(t_lo, t_hi), axis=1)
+        return ray_ixs[(t_max >= np.maximum(t_min, 0.0)) & (t_min <= max_distances[ray_ixs])]
+
+    def occluded_batch(self, rays, primitives, max_distances):
+        """Checks which rays from given batch are blocked by any of given
+           primitives (indexed by the hierarchy) before given distances
+           (scalar or per ray array). Rays are dropped from traversed packets
+           as soon as a blocker is found for them. Large batches are sorted
+           into coherent order first."""
+        max_distances = np.broadcast_to(np.asarray(max_distances, dtype='double'), len(rays))
+        if len(rays) < _MIN_COHERENT_RAYS:
+            return self._occluded_packets(rays, primitives, max_distances)
+        permutation = coherent_order(rays.origins, rays.directions)
+        occluded = np.empty(len(rays), dtype='bool')
+        occluded[permutation] = self._occluded_packets(rays[permutation], primitives,
+                                                       max_distances[permutation])
+        return occluded
+
+    def _occluded_packets(self, rays, primitives, max_distances):
+        """Checks which rays from given batch are blocked as in
+           occluded_batch, traversing the hierarchy in given order of rays."""
+        occluded = np.zeros(len(rays), dtype='bool')
+        origins = rays.origins.astype('double')
+        with np.errstate(divide='ignore'):
+            inverses = 1.0 / rays.directions.astype('double')
+
+        stack = [(0, np.arange(len(rays)))]
+        while stack:
+            index, ray_ixs = stack.pop()
+            ray_ixs = ray_ixs[~occluded[ray_ixs]]
+            ray_ixs = self._packet_hits(index, ray_ixs, origins, inverses, max_distances)
+            if len(ray_ixs) == 0:
+                continue
+            node = self.nodes[index]
+            if node['count'] == 0:
+                stack.append((int(node['start']), ray_ixs))
+                stack.append((index + 1, ray_ixs))
+                continue
+            occlude_rays([primitives[prim_ix] for prim_ix in
+                          self.order[node['start']:node['start'] + node['count']].tolist()],
+                         rays, max_distances, occluded, ray_ixs)
+        return occluded
+
+    def intersect_batch_ex(self, rays, primitives):
+        """Checks which rays from given batch intersect with given primitives
+           (indexed by the hierarchy), returning arrays of distances to
+           closest hits and indices of primitives hit as in
+           Scene.intersect_batch_ex. Rays are traversed down the hierarchy in
+           packets of rays hitting each node, with large batches sorted into
+           coherent order (by direction octants and origin cells) first, so
+           that packets gather rays stored close to each other."""
+        if len(rays) < _MIN_COHERENT_RAYS:
+            return self._intersect_packets(rays, primitives)
+        permutation = coherent_order(rays.origins, rays.directions)
+        distances = np.empty(len(rays), dtype=rays.dtype)
+        primitive_ids = np.empty(len(rays), dtype='int32')
+        distances[permutation], primitive_ids[permutation] = \
+            self._intersect_packets(rays[permutation], primitives)
+        return distances, primitive_ids
+
+    def _intersect_packets(self, rays, primitives):
+        """Intersects given batch of rays with given primitives as in
+           intersect_batch_ex, traversing the hierarchy in given order of
+           rays."""
+        distances = np.full(len(rays), np.inf, dtype=rays.dtype)
+        primitive_ids = np.full(len(rays), -1, dtype='int32')
+        origins = rays.origins.astype('double')
+        with np.errstate(divide='ignore'):
+            inverses = 1.0 / rays.directions.astype('double')
+
+        stack = [(0, np.arange(len(rays)))]
+        while stack:
+            index, ray_ixs = stack.pop()
+            ray_ixs = self._packet_hits(index, ray_ixs, origins, inverses, distances)
+            if len(ray_ixs) == 0:
+                continue
+            node = self.nodes[index]
+            if node['count'] == 0:
+                stack.append((int(node['start']), ray_ixs))
+                stack.append((index + 1, ray_ixs))
+                continue
+            sub_rays = rays[ray_ixs]
+            for prim_ix in self.order[node['start']:node['start'] + node['count']].tolist():
+                prim_dist = primitives[prim_ix].intersect_batch(sub_rays)
+                closer = prim_dist < distances[ray_ixs]
+                distances[ray_ixs[closer]] = prim_dist[closer]
+                primitive_ids[ray_ixs[closer]] = prim_ix
+        return distances, primitive_ids
+
+
+class BvhCache():
+    """Stores built hierarchies in a directory under hashes of bounds of
+       their primitives."""
+
+    path = None
+
+    def __init__(self, path):
+        """Opens (creating if needed) cache in given directory."""
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def get(self, lows, highs, leaf_size=DEFAULT_LEAF_SIZE):
+        """Returns hierarchy of primitives with given bounds, loading it from
+           cache if available, or building (and storing) it otherwise."""
+        entry_path = os.path.join(self.path, bounds_key(lows, highs, leaf_size))
+        try:
+            return Bvh.load(entry_path)
+        except (FileNotFoundError, ValueError):
+            pass
+        bvh = build_bvh(lows, highs, leaf_size)
+        self.put(lows, highs, leaf_size, bvh)
+        return bvh
+
+    def put(self, lows, highs, leaf_size, bvh):
+        """Stores hierarchy of primitives with given bounds (e.g. refitted to
+           moved primitives)."""
+        entry_path = os.path.join(self.path, bounds_key(lows, highs, leaf_size))
+        for ext, data in ((_ORDER_FILE_EXT, bvh.order), (_NODES_FILE_EXT, bvh.nodes)):
+            handle, temp_path = tempfile.mkstemp(suffix='.tmp', dir=self.path)
+            with os.fdopen(handle, 'wb') as entry:
+                np.save(entry, np.asarray(data))
+            os.replace(temp_path, entry_path + ext)
@@ -1,10 +1,13 @@
 """Abstract camera for rendering scenes."""
 
+import copy
 import math
 import random
 
+import numpy as np
+
 from .vector import OrthonormalBasis
-from .raycast_base import Ray
+from .raycast_base import Ray, RayBatch
 
 #pylint: disable=too-many-arguments
 #pylint: disable=too-many-instance-attributes
@@ -15,6 +18,7 @@ class Camera():
        which given scene is rendered."""
 
     position = None
+    look_at = None
     basis = None
     aspect_ratio = 1.0
     camera_plane_dist = 0.0
@@ -30,6 +34,7 @@ class Camera():
            (given in degrees).
            """
         self.position = eye
+        self.look_at = look_at
         self.basis = OrthonormalBasis.from_two('zy',
                                                (look_at - eye).normalised(), up)
         self.aspect_ratio = float(width) / float(height)
@@ -37,6 +42,14 @@ class Camera():
         self.reciprocal_height = 1.0 / float(height)
         self.reciprocal_width = 1.0 / float(width)
 
+    def with_resolution(self, width, height):
+        """Creates copy of the camera for output image of given dimensions."""
+        result = copy.copy(self)
+        result.aspect_ratio = float(width) / float(height)
+        result.reciprocal_height = 1.0 / float(height)
+        result.reciprocal_width = 1.0 / float(width)
+        return result
+
     def set_focus(self, focal_pt, aperture_radius):
         """Sets focus parameters for given camera."""
         self.focal_distance = abs(focal_pt - self.position)
@@ -69,5 +82,40 @@ class Camera():
 
         return Ray.from_points(origin, focal_pt)
 
+    def get_rays(self, px_x, px_y, jitter=True, dtype='double', offsets=None):
+        """Casts a batch of rays from camera that correspond to output pixels
+           with indices given in arrays 'px_x' and 'px_y' (randomly placed
+           within pixels, or through their centres if jitter is disabled, or
+           at given array of offsets within pixels of shape 2 x count)."""
+        count = len(px_x)
+        if offsets is None:
+            offsets = np.random.random_sample((2, count)) if jitter else np.full((2, count), 0.5)
+        xxx = (np.asarray(px_x, dtype='double') + offsets[0]) * self.reciprocal_width
+        yyy = (np.asarray(px_y, dtype='double') + offsets[1]) * self.reciprocal_height
+        return self._rays_from_unit(2.0 * xxx - 1.0, 2.0 * yyy - 1.0).astype(dtype)
+
+    def _rays_from_unit(self, x_pos, y_pos):
+        """Casts a batch of rays from within camera's field of view acording to
+           arrays of uniform units."""
+        x_axis = self.basis.x_axis.data()
+        y_axis = self.basis.y_axis.data()
+        directions = np.outer(-x_pos * self.aspect_ratio, x_axis) + \
+                     np.outer(-y_pos, y_axis) + \
+                     self.basis.z_axis.data() * self.camera_plane_dist
+        directions /= np.linalg.norm(directions, axis=1)[:, np.newaxis]
+        origins = np.broadcast_to(self.position.data(), directions.shape).copy()
+        if self.aperture_radius == 0:
+            return RayBatch(origins, directions)
+
+        focal_pts = origins + directions * self.focal_distance
+
+        angles = np.random.uniform(0, 2.0 * math.pi, len(x_pos))
+        radii = np.random.uniform(0, self.aperture_radius, len(x_pos))
+        origins += np.outer(np.cos(angles) * radii, x_axis) + \
+                   np.outer(np.sin(angles) * radii, y_axis)
+        directions = focal_pts - origins
+        directions /= np.linalg.norm(directions, axis=1)[:, np.newaxis]
+        return RayBatch(origins, directions)
+
 #pylint: enable=too-many-arguments
 #pylint: enable=too-many-instance-attributes
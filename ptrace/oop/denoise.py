@@ -0,0 +1,87 @@
+"""Edge-avoiding A-trous wavelet denoising of rendered images guided by
+   per-pixel variance and AOV buffers.
+
+   For details see:
+   https://jo.dreggn.org/home/2010_atrous.pdf"""
+
+import numpy as np
+
+
+# B3 spline kernel of the A-trous wavelet transform
+_KERNEL = (1.0 / 16.0, 1.0 / 4.0, 3.0 / 8.0, 1.0 / 4.0, 1.0 / 16.0)
+
+# albedo below which pixel colour is not demodulated
+_MIN_ALBEDO = 0.001
+
+_EPS = 0.0000001
+
+
+#pylint: disable=too-many-arguments
+#pylint: disable=too-many-locals
+
+def denoise(colours, variances, aovs, iterations=5,
+            sigma_colour=4.0, sigma_normal=128.0, sigma_depth=0.1):
+    """Denoises colours (array of shape (w, h, 3)) given their per-pixel sample
+       variances (divided by sample counts, i.e. variances of pixel means) and
+       AOV buffers (albedo, normal and depth) of the same image.
+
+       Colours are demodulated by albedo, filtered in given number of A-trous
+       iterations (with kernel footprint doubling each time), whose weights
+       avoid edges in colour (relative to its standard deviation), normals and
+       relative depth, and remodulated back."""
+    albedo = np.where(aovs.albedo < _MIN_ALBEDO, 1.0, aovs.albedo)
+    signal = colours / albedo
+    variance = np.mean(variances / albedo ** 2, axis=-1)
+    normals = aovs.normal
+    depth = np.where(aovs.primitive_id >= 0, aovs.depth, 0.0)
+    depth_scale = sigma_depth * np.maximum(depth, _EPS)
+    missed = aovs.primitive_id < 0
+
+    for iteration in range(iterations):
+        step = 1 << iteration
+        std_dev = np.sqrt(np.maximum(variance, 0.0))
+        luminance = np.mean(signal, axis=-1)
+        total = np.zeros_like(signal)
+        total_var = np.zeros_like(variance)
+        weights = np.zeros_like(variance)
+
+        for i, k_x in enumerate(_KERNEL):
+            for j, k_y in enumerate(_KERNEL):
+                offset = ((i - 2) * step, (j - 2) * step)
+                q_signal = _shifted(signal, offset)
+                q_var = _shifted(variance, offset)
+
+                w_colour = np.abs(luminance - np.mean(q_signal, axis=-1)) / \
+                           (sigma_colour * std_dev + _EPS)
+                w_normal = np.maximum(0.0, np.sum(normals * _shifted(normals, offset),
+                                                  axis=-1)) ** sigma_normal
+                w_depth = np.abs(depth - _shifted(depth, offset)) / depth_scale
+                weight = k_x * k_y * np.exp(-w_colour - w_depth) * \
+                         np.where(missed | _shifted(missed, offset),
+                                  missed & _shifted(missed, offset), w_normal)
+
+                total += q_signal * weight[..., np.newaxis]
+                total_var += q_var * weight ** 2
+                weights += weight
+
+        weights = np.maximum(weights, _EPS)
+        signal = total / weights[..., np.newaxis]
+        variance = total_var / weights ** 2
+
+    return signal * albedo
+
+#pylint: enable=too-many-locals
+#pylint: enable=too-many-arguments
+
+def _shifted(data, offset):
+    """Returns array with elements of given one at positions shifted by given
+       offset (with pixels outside the image clamped to its border)."""
+    x_ix = np.clip(np.arange(data.shape[0]) + offset[0], 0, data.shape[0] - 1)
+    y_ix = np.clip(np.arange(data.shape[1]) + offset[1], 0, data.shape[1] - 1)
+    return data[x_ix][:, y_ix]
+
+def denoise_image(image, aovs, **kwargs):
+    """Denoises accumulable image (that tracks variance) using given AOV
+       buffers, returning colours of shape (width, height, 3)."""
+    counts = np.maximum(1, image.pixel_sample_counts())[..., np.newaxis]
+    return denoise(image.colours(), image.variances() / counts, aovs, **kwargs)
@@ -0,0 +1,207 @@
+"""Distributed tiled rendering, where a coordinator hands out tiles of a frame
+   to worker processes (possibly on other machines) connected over TCP.
+
+   Renderers and rendered tiles are exchanged as pickles, so anyone who can
+   connect with the authentication key can run arbitrary code on the other
+   end. The link must only be used on trusted networks, with a secret key
+   (coordinators generate a random one unless given one)."""
+
+import random
+import secrets
+import threading
+import time
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener, Client
+
+import numpy as np
+
+from .tile_scheduler import TileScheduler
+
+
+# maximal time (in seconds) worker may spend on a tile before it is presumed
+# dead and the tile is handed out to another one
+DEFAULT_TILE_TIMEOUT = 600.0
+
+
+def parse_address(text):
+    """Parses 'host:port' string into address tuple (host defaults to
+       localhost if omitted)."""
+    host, port = text.rsplit(':', 1) if ':' in text else ('', text)
+    return (host or 'localhost', int(port))
+
+def generate_authkey():
+    """Returns new random authentication key."""
+    return secrets.token_hex(16).encode()
+
+
+#pylint: disable=too-many-instance-attributes
+
+class Coordinator():
+    """Listens for worker connections, sends each worker the renderer (scene,
+       camera and parameters) once and then streams tile jobs to it, merging
+       returned tile images into the output image.
+
+       Tiles of workers that disconnect or time out are put back at the front
+       of the queue and re-issued to remaining (or newly connected) workers."""
+
+    renderer = None
+    scheduler = None
+    output = None
+    tile_timeout = None
+    listener = None
+    condition = None
+    in_flight = None
+    authkey = None
+    worker_count = 0
+
+    def __init__(self, renderer, address=('localhost', 0), authkey=None,
+                 tile_timeout=DEFAULT_TILE_TIMEOUT):
+        """Creates coordinator of rendering given renderer's frame, listening
+           at given address (port 0 picks a free one) for workers
+           authenticating with given key (random one if not given, see
+           authkey attribute)."""
+        self.renderer = renderer
+        self.authkey = authkey if authkey else generate_authkey()
+        self.tile_timeout = tile_timeout
+        width = renderer.params['width']
+        height = renderer.params['height']
+        tiles = renderer.generate_tiles(renderer.params['tile_size'],
+                                        renderer.params['tile_size'],
+                                        renderer.params['samples_per_pixel'],
+                                        renderer.params['samples_per_tile'], width, height)
+        self.scheduler = TileScheduler(tiles, width, height, 1,
+                                       renderer.params['target_tile_time'])
+        self.output = renderer.create_output(width, height)
+        self.condition = threading.Condition()
+        self.in_flight = []
+        self.listener = Listener(address, authkey=self.authkey)
+
+    def address(self):
+        """Returns address the coordinator listens at."""
+        return self.listener.address
+
+    def is_done(self):
+        """Checks whether all tiles have been rendered and merged."""
+        return not self.in_flight and self.scheduler.pending_count() == 0
+
+    def run(self, verbose=False, update=None):
+        """Serves workers until all tiles are rendered and returns output
+           image. Update function (if given) is called with output image and
+           tile after each tile is merged."""
+        start_time = time.time()
+        thread = threading.Thread(target=self._accept_workers, args=(verbose, update),
+                                  daemon=True)
+        thread.start()
+        if verbose:
+            print("Coordinator listening at {}:{}.".format(*self.address()))
+        with self.condition:
+            self.condition.wait_for(self.is_done)
+        self.listener.close()
+
+        self.renderer.stats = { \
+            'samples_per_pixel': self.output.total_sample_count() /
+                                 (self.output.width * self.output.height),
+            'estimated_error': None,
+            'render_time': time.time() - start_time,
+            'stop_reason': 'samples'}
+        if verbose:
+            print("\rRendering done.                                     ")
+        return self.output
+
+    def _accept_workers(self, verbose, update):
+        """Accepts worker connections and serves each in a separate thread."""
+        while True:
+            try:
+                conn = self.listener.accept()
+            except (OSError, EOFError, AuthenticationError):
+                with self.condition:
+                    if self.is_done():
+                        return
+                continue
+            self.worker_count += 1
+            if verbose:
+                print("\rWorker #{} connected.".format(self.worker_count))
+            threading.Thread(target=self._serve_worker, args=(conn, verbose, update),
+                             daemon=True).start()
+
+    def _next_tile(self):
+        """Waits for a tile to hand out and returns it (or None when rendering
+           is done)."""
+        with self.condition:
+            self.condition.wait_for(lambda: self.is_done() or self.scheduler.pending_count())
+            if self.is_done():
+                return None
+            tile = self.scheduler.next_tile(0)
+            self.in_flight.append(tile)
+            return tile
+
+    def _serve_worker(self, conn, verbose, update):
+        """Sends renderer and tiles to connected worker and merges its results
+           until there is no more work or the worker fails."""
+        tile = None
+        try:
+            conn.send(('setup', self.renderer))
+            tile = self._next_tile()
+            while tile is not None:
+                conn.send(('tile', tile))
+                if not conn.poll(self.tile_timeout):
+                    raise TimeoutError('Worker timed out.')
+                block, elapsed = conn.recv()
+                with self.condition:
+                    self.output.add_image_block(tile['x_range'][0], tile['y_range'][0], block)
+                    self.in_flight.remove(tile)
+                    self.scheduler.report(tile, elapsed)
+                    if verbose:
+                        print("\rRendering... Tiles left: {:6}".format( \
+                            self.scheduler.pending_count() + len(self.in_flight)), end='')
+                    if update is not None:
+                        update(self.output, tile)
+                    self.condition.notify_all()
+                tile = self._next_tile()
+            conn.send(('done', None))
+        # any failure (also invalid results sent by worker) drops the worker,
+        # so that its tile is re-issued instead of stalling the render
+        except Exception as error: #pylint: disable=broad-except
+            if tile is not None:
+                with self.condition:
+                    if tile in self.in_flight:
+                        self.in_flight.remove(tile)
+                        self.scheduler.requeue(tile)
+                    self.condition.notify_all()
+            if verbose:
+                print("\rWorker lost ({}: {}), tile re-issued.".format(type(error).__name__,
+                                                                       error))
+        finally:
+            conn.close()
+
+#pylint: enable=too-many-instance-attributes
+
+
+def run_worker(address, authkey, verbose=False):
+    """Connects to coordinator at given address (authenticating with given
+       key) and renders tiles it sends until told there is no more work.
+       Returns number of rendered tiles."""
+    tile_count = 0
+    with Client(address, authkey=authkey) as conn:
+        kind, renderer = conn.recv()
+        assert kind == 'setup', 'Unexpected coordinator message.'
+        # unseeded renders must not repeat random sequences of other workers
+        random.seed()
+        np.random.seed()
+        if verbose:
+            print("Connected to coordinator, rendering {}x{} frame.".format( \
+                renderer.params['width'], renderer.params['height']))
+        while True:
+            try:
+                kind, tile = conn.recv()
+            except EOFError:
+                break
+            if kind != 'tile':
+                break
+            start_time = time.time()
+            block = renderer.render_tile(tile)
+            conn.send((block, time.time() - start_time))
+            tile_count += 1
+    if verbose:
+        print("Worker done, {} tiles rendered.".format(tile_count))
+    return tile_count
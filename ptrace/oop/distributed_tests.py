@@ -0,0 +1,110 @@
+"""Unit tests for distributed rendering."""
+
+import threading
+import unittest
+from multiprocessing import Process, AuthenticationError
+from multiprocessing.connection import Client
+import numpy as np
+
+from .distributed import Coordinator, run_worker, parse_address
+from .render_tests import _small_renderer
+
+
+def _failing_worker(address, authkey):
+    """Connects to coordinator, takes a tile and disconnects without rendering
+       it."""
+    conn = Client(address, authkey=authkey)
+    conn.recv()
+    conn.recv()
+    conn.close()
+
+def _invalid_worker(address, authkey):
+    """Connects to coordinator, takes a tile and returns invalid result for
+       it."""
+    with Client(address, authkey=authkey) as conn:
+        conn.recv()
+        conn.recv()
+        conn.send((None, 0.0))
+        try:
+            conn.recv()
+        except EOFError:
+            pass
+
+
+class DistributedRenderingTests(unittest.TestCase):
+    """Tests for distributed tiled rendering over localhost sockets."""
+
+    def test_distributed_render(self):
+        """Workers in separate processes render all tiles of the frame."""
+        renderer = _small_renderer(tile_size=4, samples_per_tile=1)
+        coordinator = Coordinator(renderer)
+        workers = [Process(target=run_worker, args=(coordinator.address(), coordinator.authkey))
+                   for _ in range(2)]
+        for worker in workers:
+            worker.start()
+        output = coordinator.run()
+        for worker in workers:
+            worker.join(10)
+        self.assertTrue(np.all(output.sample_counts == 2))
+        self.assertEqual(renderer.stats['samples_per_pixel'], 2)
+
+    def test_worker_failure(self):
+        """Tiles of a worker that disconnects are re-issued to others."""
+        renderer = _small_renderer(tile_size=4, samples_per_tile=1)
+        coordinator = Coordinator(renderer)
+        failing = threading.Thread(target=_failing_worker,
+                                   args=(coordinator.address(), coordinator.authkey))
+
+        def worker():
+            failing.join()
+            run_worker(coordinator.address(), coordinator.authkey)
+
+        thread = threading.Thread(target=worker)
+        failing.start()
+        thread.start()
+        output = coordinator.run()
+        thread.join(10)
+        self.assertTrue(np.all(output.sample_counts == 2))
+
+    def test_invalid_result(self):
+        """Tiles of a worker that returns invalid result are re-issued."""
+        renderer = _small_renderer(tile_size=4, samples_per_tile=1)
+        coordinator = Coordinator(renderer)
+        invalid = threading.Thread(target=_invalid_worker,
+                                   args=(coordinator.address(), coordinator.authkey))
+
+        def worker():
+            invalid.join()
+            run_worker(coordinator.address(), coordinator.authkey)
+
+        thread = threading.Thread(target=worker)
+        invalid.start()
+        thread.start()
+        output = coordinator.run()
+        thread.join(10)
+        self.assertTrue(np.all(output.sample_counts == 2))
+
+    def test_authentication(self):
+        """Coordinators listen on localhost by default with random keys, and
+           reject workers with wrong keys."""
+        self.assertEqual(parse_address('9000'), ('localhost', 9000))
+        self.assertEqual(parse_address('0.0.0.0:9000'), ('0.0.0.0', 9000))
+        coordinator = Coordinator(_small_renderer())
+        self.addCleanup(coordinator.listener.close)
+        other = Coordinator(_small_renderer())
+        self.addCleanup(other.listener.close)
+        self.assertNotEqual(coordinator.authkey, other.authkey)
+        rejected = []
+
+        def accept():
+            try:
+                coordinator.listener.accept().close()
+            except AuthenticationError:
+                rejected.append(True)
+
+        thread = threading.Thread(target=accept)
+        thread.start()
+        with self.assertRaises(AuthenticationError):
+            Client(coordinator.address(), authkey=b'ptrace')
+        thread.join(10)
+        self.assertEqual(rejected, [True])
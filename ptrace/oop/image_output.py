@@ -1,10 +1,16 @@
 """Classes handling output data of rendered image that is being accumulated
    throughout rendering process."""
 
+import io
+import json
+import os
+import struct
+import zlib
+
 import numpy as np
 from PIL import Image
 
-from .utils import colour2bytes
+from .utils import colour2bytes, colours2bytes
 from .vector import Vec3
 
 
@@ -16,21 +22,53 @@ class AccumulableImage():
     height = None
     image = None
     sample_counts = None
+    sqr_image = None
 
-    def __init__(self, width, height):
-        """Initializes empty accumulable image of given dimensions.
+    def __init__(self, width, height, dtype='double', track_variance=False):
+        """Initializes empty accumulable image of given dimensions (with colour
+           sums stored as floating point numbers of given type). If variance
+           tracking is enabled, sums of squared colours are accumulated too.
 
             Optionally, may be initialized with iterable sample data source."""
         self.width = width
         self.height = height
-        self.image = np.zeros((3, width, height), dtype='double')
+        self.image = np.zeros((3, width, height), dtype=dtype)
         self.sample_counts = np.zeros((width, height), dtype='int')
+        if track_variance:
+            self.sqr_image = np.zeros((3, width, height), dtype=dtype)
+
+    def tracks_variance(self):
+        """Checks whether sums of squared colours are accumulated."""
+        return self.sqr_image is not None
 
     def add_samples(self, x_pos, y_pos, colour, sample_count):
         """Adds given number of samples with specified colour (as Vec3) to pixel
            at given position."""
         self.image[:, x_pos, y_pos] += colour.data() * sample_count
         self.sample_counts[x_pos, y_pos] += sample_count
+        if self.sqr_image is not None:
+            self.sqr_image[:, x_pos, y_pos] += (colour.data() ** 2) * sample_count
+
+    #pylint: disable=too-many-arguments
+
+    def add_block(self, x_pos, y_pos, colours, sample_counts, sqr_colours=None):
+        """Adds block of accumulated colour sums (of shape (3, w, h)) and
+           respective sample counts (of shape (w, h)), and optionally sums of
+           squared colours, with its top-left corner placed at given
+           position."""
+        x_end = x_pos + sample_counts.shape[0]
+        y_end = y_pos + sample_counts.shape[1]
+        self.image[:, x_pos:x_end, y_pos:y_end] += colours
+        self.sample_counts[x_pos:x_end, y_pos:y_end] += sample_counts
+        if self.sqr_image is not None and sqr_colours is not None:
+            self.sqr_image[:, x_pos:x_end, y_pos:y_end] += sqr_colours
+
+    #pylint: enable=too-many-arguments
+
+    def add_image_block(self, x_pos, y_pos, other):
+        """Adds all data accumulated in another (smaller) accumulable image with
+           its top-left corner placed at given position."""
+        self.add_block(x_pos, y_pos, other.image, other.sample_counts, other.sqr_image)
 
     def __getitem__(self, pos):
         """Returns colour (as Vec3) of a pixel at given position adjusted by the
@@ -38,6 +76,10 @@ class AccumulableImage():
         divisor = max(1, self.sample_counts[pos])
         return Vec3.from_array(self.image[:, pos[0], pos[1]] / divisor)
 
+    def sample_count_at(self, pos):
+        """Returns number of samples accumulated in pixel at given position."""
+        return self.sample_counts[pos]
+
     def bytes_at(self, pos):
         """Returns length 3 byte array representing colour of a pixel at given
            position."""
@@ -49,18 +91,421 @@ class AccumulableImage():
         assert self.width == other.width and self.height == other.height
         self.image += other.image
         self.sample_counts += other.sample_counts
+        if self.sqr_image is not None and other.sqr_image is not None:
+            self.sqr_image += other.sqr_image
         return self
 
     def total_sample_count(self):
         """Returns total number of samples accumulated."""
         return np.sum(self.sample_counts)
 
+    def _iter_raw_tiles(self):
+        """Iterates over disjoint blocks covering the image yielding position
+           of their top-left pixel, colour sums (of shape (3, w, h)), sample
+           counts and sums of squared colours (or None)."""
+        yield 0, 0, self.image, self.sample_counts, self.sqr_image
+
+    def _iter_tiles(self):
+        """Iterates over disjoint blocks covering the image yielding position
+           of their top-left pixel and their colours (of shape (w, h, 3))."""
+        for x_beg, y_beg, sums, counts, _ in self._iter_raw_tiles():
+            yield x_beg, y_beg, _block_colours(sums, counts)
+
+    @staticmethod
+    def from_colours(colours):
+        """Creates accumulable image with given array of colours of shape
+           (width, height, 3) as single samples."""
+        result = AccumulableImage(colours.shape[0], colours.shape[1], colours.dtype)
+        result.add_block(0, 0, np.moveaxis(colours, -1, 0),
+                         np.ones(colours.shape[:2], dtype='int'))
+        return result
+
+    def colours(self):
+        """Returns array of shape (width, height, 3) with colours of all pixels
+           adjusted by the number of samples accumulated."""
+        return _block_colours(self.image, self.sample_counts)
+
+    def pixel_sample_counts(self):
+        """Returns array of shape (width, height) with numbers of samples
+           accumulated in respective pixels."""
+        result = np.empty((self.width, self.height), dtype='int64')
+        for x_beg, y_beg, _, counts, _ in self._iter_raw_tiles():
+            result[x_beg:x_beg + counts.shape[0], y_beg:y_beg + counts.shape[1]] = counts
+        return result
+
+    def variances(self):
+        """Returns array of shape (width, height, 3) with unbiased estimates of
+           variance of samples of respective pixels (zero for pixels with less
+           than two samples).
+
+           Requires variance tracking."""
+        assert self.tracks_variance()
+        result = np.empty((self.width, self.height, 3), dtype=self.image.dtype)
+        for x_beg, y_beg, sums, counts, sqr_sums in self._iter_raw_tiles():
+            block = _block_variances(sums, counts, sqr_sums)
+            result[x_beg:x_beg + block.shape[0], y_beg:y_beg + block.shape[1]] = block
+        return result
+
+    def estimated_error(self):
+        """Returns estimated relative error of the image, i.e. standard error of
+           pixel luminance means relative to the luminance itself, averaged over
+           all pixels (infinite if any pixel has less than two samples).
+
+           Requires variance tracking."""
+        assert self.tracks_variance()
+        total = 0.0
+        for _, _, sums, counts, sqr_sums in self._iter_raw_tiles():
+            if np.min(counts) < 2:
+                return float('inf')
+            std_err = np.sqrt(np.mean(_block_variances(sums, counts, sqr_sums), axis=-1) /
+                              counts)
+            luminance = np.mean(_block_colours(sums, counts), axis=-1)
+            total += np.sum(std_err / (luminance + _ERROR_LUMINANCE_EPS))
+        return total / (self.width * self.height)
+
+    def upsampled(self, width, height):
+        """Creates accumulable image of given (larger) dimensions whose colours
+           are bilinearly interpolated from this one. Each pixel inherits sample
+           count of the nearest pixel of this image."""
+        near_x = np.arange(width) * self.width // width
+        near_y = np.arange(height) * self.height // height
+        counts = self.sample_counts[near_x][:, near_y]
+        colours = _bilinear_resize(self.colours(), width, height)
+
+        result = AccumulableImage(width, height, self.image.dtype)
+        result.add_block(0, 0, np.moveaxis(colours, -1, 0) * counts, counts)
+        return result
+
     def save_as_png(self, output_path):
         """Saves current contents of accumulable image to png file at given
            path."""
-        byte_array = np.empty((self.width, self.height, 3), dtype='uint8')
-        for i in range(0, self.width):
-            for j in range(0, self.height):
-                byte_array[i, j, :] = self.bytes_at((i, j))
-        img = Image.fromarray(byte_array)
+        img = Image.fromarray(colours2bytes(self.colours()))
         img.save(output_path)
+
+    def png_bytes(self):
+        """Returns current contents of accumulable image encoded as png."""
+        stream = io.BytesIO()
+        Image.fromarray(colours2bytes(self.colours())).save(stream, 'PNG')
+        return stream.getvalue()
+
+    def save_as_npy(self, output_path):
+        """Saves current colours of accumulable image (as single precision
+           floats of shape (width, height, 3)) to npy file at given path."""
+        np.save(output_path, self.colours().astype('single'))
+
+    def to_bytes(self):
+        """Serializes accumulated buffers into bytes (npz archive)."""
+        buffers = {'image': self.image, 'sample_counts': self.sample_counts}
+        if self.sqr_image is not None:
+            buffers['sqr_image'] = self.sqr_image
+        stream = io.BytesIO()
+        np.savez(stream, **buffers)
+        return stream.getvalue()
+
+    @staticmethod
+    def from_bytes(data):
+        """Creates accumulable image from bytes previously returned by
+           to_bytes."""
+        with np.load(io.BytesIO(data)) as buffers:
+            image = np.asarray(buffers['image'])
+            result = AccumulableImage(image.shape[1], image.shape[2], image.dtype,
+                                      'sqr_image' in buffers)
+            result.add_block(0, 0, image, buffers['sample_counts'],
+                             buffers['sqr_image'] if 'sqr_image' in buffers else None)
+        return result
+
+
+# luminance offset preventing relative error blowing up for black pixels
+_ERROR_LUMINANCE_EPS = 0.01
+
+def _block_colours(sums, counts):
+    """Returns colours (of shape (w, h, 3)) of block with given colour sums and
+       sample counts."""
+    return np.moveaxis(sums / np.maximum(1, counts).astype(sums.dtype), 0, -1)
+
+def _block_variances(sums, counts, sqr_sums):
+    """Returns unbiased sample variances (of shape (w, h, 3)) of block with
+       given colour sums, squared colour sums and sample counts."""
+    divisor = np.maximum(1, counts).astype(sums.dtype)
+    means = sums / divisor
+    variances = np.maximum(0.0, sqr_sums / divisor - means ** 2) * \
+                (divisor / np.maximum(1, counts - 1))
+    return np.moveaxis(variances, 0, -1)
+
+
+def _bilinear_resize(colours, width, height):
+    """Resizes array of colours of shape (w, h, 3) to given dimensions using
+       bilinear interpolation between pixel centres."""
+    def weights(size, new_size):
+        pos = np.clip((np.arange(new_size) + 0.5) * size / new_size - 0.5, 0, size - 1)
+        low = np.floor(pos).astype('int')
+        high = np.minimum(low + 1, size - 1)
+        return low, high, (pos - low)[:, np.newaxis]
+
+    x_low, x_high, x_frac = weights(colours.shape[0], width)
+    y_low, y_high, y_frac = weights(colours.shape[1], height)
+    rows = colours[x_low] * (1.0 - x_frac[..., np.newaxis]) + \
+           colours[x_high] * x_frac[..., np.newaxis]
+    return rows[:, y_low] * (1.0 - y_frac) + rows[:, y_high] * y_frac
+
+
+_MAPPED_META_FILE = 'meta.json'
+_MAPPED_IMAGE_FILE = 'image.npy'
+_MAPPED_COUNTS_FILE = 'counts.npy'
+_MAPPED_SQR_IMAGE_FILE = 'sqr_image.npy'
+
+
+#pylint: disable=too-many-instance-attributes
+
+class MappedAccumulableImage(AccumulableImage):
+    """Accumulable image whose buffers are kept in memory-mapped files within
+       given directory instead of RAM.
+
+       Pixels are stored in tile-aligned layout, i.e. buffers have shape
+       (tiles_x, tiles_y, 3, tile_size, tile_size) for colours and
+       (tiles_x, tiles_y, tile_size, tile_size) for sample counts, so that all
+       the data of a single tile is contiguous. Only pages of tiles being
+       accessed need to be resident in memory, which holds for tiled
+       rendering adding whole tile blocks; regular sampling passes over the
+       whole image touch every page in each pass."""
+
+    path = None
+    tile_size = None
+    tiles_x = None
+    tiles_y = None
+
+    #pylint: disable=super-init-not-called
+    #pylint: disable=too-many-arguments
+
+    def __init__(self, width, height, path, tile_size=64, mode='w+', dtype='double',
+                 track_variance=False):
+        """Initializes accumulable image of given dimensions backed by files in
+           given directory (with colour sums stored as floating point numbers of
+           given type, and optionally sums of squared colours).
+
+           Mode 'w+' creates new (empty) buffers, while 'r+' opens buffers
+           previously stored in given directory."""
+        assert mode in ('w+', 'r+')
+        self.width = width
+        self.height = height
+        self.path = path
+        self.tile_size = tile_size
+        self.tiles_x = -(-width // tile_size)
+        self.tiles_y = -(-height // tile_size)
+
+        if mode == 'w+':
+            os.makedirs(path, exist_ok=True)
+            with open(os.path.join(path, _MAPPED_META_FILE), 'w', encoding='utf-8') as metafile:
+                json.dump({'width': width, 'height': height, 'tile_size': tile_size,
+                           'dtype': np.dtype(dtype).name,
+                           'track_variance': track_variance}, metafile)
+
+        colour_shape = (self.tiles_x, self.tiles_y, 3, tile_size, tile_size)
+        self.image = np.lib.format.open_memmap( \
+            os.path.join(path, _MAPPED_IMAGE_FILE), mode, dtype=dtype, shape=colour_shape)
+        self.sample_counts = np.lib.format.open_memmap( \
+            os.path.join(path, _MAPPED_COUNTS_FILE), mode, dtype='int64',
+            shape=(self.tiles_x, self.tiles_y, tile_size, tile_size))
+        if track_variance:
+            self.sqr_image = np.lib.format.open_memmap( \
+                os.path.join(path, _MAPPED_SQR_IMAGE_FILE), mode, dtype=dtype,
+                shape=colour_shape)
+
+    #pylint: enable=too-many-arguments
+    #pylint: enable=super-init-not-called
+
+    @staticmethod
+    def open(path):
+        """Opens memory-mapped accumulable image previously stored in given
+           directory."""
+        with open(os.path.join(path, _MAPPED_META_FILE), 'r', encoding='utf-8') as metafile:
+            meta = json.load(metafile)
+        return MappedAccumulableImage(meta['width'], meta['height'], path,
+                                      meta['tile_size'], mode='r+',
+                                      dtype=meta.get('dtype', 'double'),
+                                      track_variance=meta.get('track_variance', False))
+
+    def flush(self):
+        """Writes any pending changes of buffers to the disk."""
+        self.image.flush()
+        self.sample_counts.flush()
+        if self.sqr_image is not None:
+            self.sqr_image.flush()
+
+    def _locate(self, x_pos, y_pos):
+        """Returns tile indices and offsets within tile for given pixel."""
+        tile_x, off_x = divmod(x_pos, self.tile_size)
+        tile_y, off_y = divmod(y_pos, self.tile_size)
+        return tile_x, tile_y, off_x, off_y
+
+    def add_samples(self, x_pos, y_pos, colour, sample_count):
+        """Adds given number of samples with specified colour (as Vec3) to pixel
+           at given position."""
+        tile_x, tile_y, off_x, off_y = self._locate(x_pos, y_pos)
+        self.image[tile_x, tile_y, :, off_x, off_y] += colour.data() * sample_count
+        self.sample_counts[tile_x, tile_y, off_x, off_y] += sample_count
+        if self.sqr_image is not None:
+            self.sqr_image[tile_x, tile_y, :, off_x, off_y] += (colour.data() ** 2) * sample_count
+
+    #pylint: disable=too-many-arguments
+    #pylint: disable=too-many-locals
+
+    def add_block(self, x_pos, y_pos, colours, sample_counts, sqr_colours=None):
+        """Adds block of accumulated colour sums (of shape (3, w, h)) and
+           respective sample counts (of shape (w, h)), and optionally sums of
+           squared colours, with its top-left corner placed at given
+           position."""
+        size = self.tile_size
+        x_end = x_pos + sample_counts.shape[0]
+        y_end = y_pos + sample_counts.shape[1]
+        for tile_x in range(x_pos // size, -(-x_end // size)):
+            x_beg_t = max(x_pos, tile_x * size)
+            x_end_t = min(x_end, (tile_x + 1) * size)
+            for tile_y in range(y_pos // size, -(-y_end // size)):
+                y_beg_t = max(y_pos, tile_y * size)
+                y_end_t = min(y_end, (tile_y + 1) * size)
+                dst = (slice(x_beg_t - tile_x * size, x_end_t - tile_x * size),
+                       slice(y_beg_t - tile_y * size, y_end_t - tile_y * size))
+                src = (slice(x_beg_t - x_pos, x_end_t - x_pos),
+                       slice(y_beg_t - y_pos, y_end_t - y_pos))
+                self.image[tile_x, tile_y, :, dst[0], dst[1]] += colours[:, src[0], src[1]]
+                self.sample_counts[tile_x, tile_y, dst[0], dst[1]] += sample_counts[src]
+                if self.sqr_image is not None and sqr_colours is not None:
+                    self.sqr_image[tile_x, tile_y, :, dst[0], dst[1]] += \
+                        sqr_colours[:, src[0], src[1]]
+
+    #pylint: enable=too-many-locals
+    #pylint: enable=too-many-arguments
+
+    def __getitem__(self, pos):
+        """Returns colour (as Vec3) of a pixel at given position adjusted by the
+           number of samples accumulated."""
+        tile_x, tile_y, off_x, off_y = self._locate(*pos)
+        divisor = max(1, self.sample_counts[tile_x, tile_y, off_x, off_y])
+        return Vec3.from_array(self.image[tile_x, tile_y, :, off_x, off_y] / divisor)
+
+    def sample_count_at(self, pos):
+        """Returns number of samples accumulated in pixel at given position."""
+        tile_x, tile_y, off_x, off_y = self._locate(*pos)
+        return self.sample_counts[tile_x, tile_y, off_x, off_y]
+
+    def __iadd__(self, other):
+        """Adds all respective colour values and sample counts from another
+           accumulable image to the current one (one tile row at a time)."""
+        assert self.width == other.width and self.height == other.height
+        if isinstance(other, MappedAccumulableImage) and other.tile_size == self.tile_size:
+            for tile_x in range(self.tiles_x):
+                self.image[tile_x] += other.image[tile_x]
+                self.sample_counts[tile_x] += other.sample_counts[tile_x]
+                if self.sqr_image is not None and other.sqr_image is not None:
+                    self.sqr_image[tile_x] += other.sqr_image[tile_x]
+        else:
+            self.add_image_block(0, 0, other)
+        return self
+
+    def _tile_slices(self, tile_x, tile_y):
+        """Returns slices of a tile at given tile indices cropped to image
+           dimensions."""
+        width = min(self.tile_size, self.width - tile_x * self.tile_size)
+        height = min(self.tile_size, self.height - tile_y * self.tile_size)
+        return slice(0, width), slice(0, height)
+
+    def _iter_raw_tiles(self):
+        """Iterates over tiles yielding position of their top-left pixel, colour
+           sums (of shape (3, w, h)), sample counts and sums of squared colours
+           (or None)."""
+        for tile_x in range(self.tiles_x):
+            for tile_y in range(self.tiles_y):
+                x_sl, y_sl = self._tile_slices(tile_x, tile_y)
+                sqr_sums = self.sqr_image[tile_x, tile_y, :, x_sl, y_sl] \
+                           if self.sqr_image is not None else None
+                yield tile_x * self.tile_size, tile_y * self.tile_size, \
+                      self.image[tile_x, tile_y, :, x_sl, y_sl], \
+                      self.sample_counts[tile_x, tile_y, x_sl, y_sl], sqr_sums
+
+    def tile_colours(self, tile_x, tile_y):
+        """Returns array of shape (w, h, 3) with colours of pixels in a tile at
+           given tile indices (cropped to image dimensions)."""
+        x_sl, y_sl = self._tile_slices(tile_x, tile_y)
+        return _block_colours(self.image[tile_x, tile_y, :, x_sl, y_sl],
+                              self.sample_counts[tile_x, tile_y, x_sl, y_sl])
+
+    def colours(self):
+        """Returns array of shape (width, height, 3) with colours of all pixels
+           adjusted by the number of samples accumulated.
+
+           Note that this materializes whole image in memory."""
+        result = np.empty((self.width, self.height, 3), dtype=self.image.dtype)
+        for x_beg, y_beg, tile in self._iter_tiles():
+            result[x_beg:x_beg + tile.shape[0], y_beg:y_beg + tile.shape[1]] = tile
+        return result
+
+    def save_as_png(self, output_path):
+        """Saves current contents of accumulable image to png file at given
+           path, converting and writing one row of tiles at a time."""
+        with _PngStreamWriter(output_path, self.height, self.width) as writer:
+            for tile_x in range(self.tiles_x):
+                rows = min(self.tile_size, self.width - tile_x * self.tile_size)
+                band = np.empty((rows, self.height, 3), dtype='uint8')
+                for tile_y in range(self.tiles_y):
+                    y_beg = tile_y * self.tile_size
+                    tile = colours2bytes(self.tile_colours(tile_x, tile_y))
+                    band[:, y_beg:y_beg + tile.shape[1]] = tile
+                writer.write_rows(band)
+
+    def save_as_npy(self, output_path):
+        """Saves current colours of accumulable image (as single precision
+           floats of shape (width, height, 3)) to npy file at given path,
+           writing one tile at a time."""
+        output = np.lib.format.open_memmap(output_path, 'w+', dtype='single',
+                                           shape=(self.width, self.height, 3))
+        for x_beg, y_beg, tile in self._iter_tiles():
+            output[x_beg:x_beg + tile.shape[0], y_beg:y_beg + tile.shape[1]] = tile
+        output.flush()
+        del output
+
+#pylint: enable=too-many-instance-attributes
+
+
+_PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+_PNG_IDAT_SIZE = 1 << 16
+
+
+class _PngStreamWriter():
+    """Writes 8-bit RGB png file incrementally, row by row."""
+
+    def __init__(self, path, width, height):
+        """Opens png file at given path for image of given dimensions."""
+        self._file = open(path, 'wb') #pylint: disable=consider-using-with
+        self._compressor = zlib.compressobj()
+        self._pending = b''
+        self._file.write(_PNG_SIGNATURE)
+        self._write_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def _write_chunk(self, tag, data):
+        """Writes single png chunk."""
+        self._file.write(struct.pack('>I', len(data)))
+        self._file.write(tag)
+        self._file.write(data)
+        self._file.write(struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff))
+
+    def write_rows(self, rows):
+        """Writes rows given as array of shape (n, width, 3) of bytes."""
+        filtered = np.zeros((rows.shape[0], rows.shape[1] * 3 + 1), dtype='uint8')
+        filtered[:, 1:] = rows.reshape(rows.shape[0], -1)
+        self._pending += self._compressor.compress(filtered.tobytes())
+        if len(self._pending) >= _PNG_IDAT_SIZE:
+            self._write_chunk(b'IDAT', self._pending)
+            self._pending = b''
+
+    def close(self):
+        """Finishes writing png file."""
+        self._write_chunk(b'IDAT', self._pending + self._compressor.flush())
+        self._write_chunk(b'IEND', b'')
+        self._file.close()
@@ -0,0 +1,114 @@
+"""Irradiance cache reusing estimates of diffuse indirect lighting between
+   nearby surface points (after Ward, Rubinstein and Clear).
+
+   Each record stores position, normal, average incoming radiance over
+   cosine-weighted hemisphere and harmonic mean distance R to surfaces seen
+   from the point. Record is reused at point p with normal n if its weight
+     w = 1 / (|p - p_i| / R_i + sqrt(1 - n . n_i))
+   exceeds 1 / error, where error is the parameter trading bias for speed
+   (larger errors reuse records further away). Records are stored in hash
+   grids of cells holding records whose areas of influence overlap them, one
+   grid for each (power of two) size of areas of influence, so that lookups
+   visit only a few records."""
+
+import math
+
+import numpy as np
+
+from .vector import Vec3
+
+
+DEFAULT_MIN_RADIUS = 0.05
+DEFAULT_MAX_RADIUS = 2.0
+
+# tolerance of test for records lying in front of the point looked up
+_FRONT_TOLERANCE = 1e-3
+
+
+def _grid_level(ratio):
+    """Returns level of grid with cells at least given number of times
+       larger than the smallest ones."""
+    return max(0, int(math.ceil(math.log2(ratio) - 1e-9)))
+
+
+class IrradianceCache():
+    """Sparse records of diffuse indirect lighting in a spatial hash grid."""
+
+    error = None
+    min_radius = None
+    max_radius = None
+    records = None
+    grids = None
+
+    def __init__(self, error, min_radius=DEFAULT_MIN_RADIUS, max_radius=DEFAULT_MAX_RADIUS):
+        """Creates empty cache with given error bound. Harmonic mean distances
+           of records are clamped to given range, which bounds their spacing."""
+        assert error > 0.0 and 0.0 < min_radius <= max_radius
+        self.error = error
+        self.min_radius = min_radius
+        self.max_radius = max_radius
+        self.records = []
+        # grid levels by cell size (the smallest one holds records of minimal
+        # reach, each next one has cells twice as large)
+        self.grids = [{} for _ in range(_grid_level(max_radius / min_radius) + 1)]
+
+    def __len__(self):
+        """Returns number of records in the cache."""
+        return len(self.records)
+
+    def _cell(self, level, coords):
+        """Returns key of cell of grid of given level containing point of
+           given coordinates."""
+        cell_size = self.error * self.min_radius * (1 << level)
+        return tuple(int(math.floor(coord / cell_size)) for coord in coords)
+
+    #pylint: disable=too-many-locals
+
+    def lookup(self, position, normal):
+        """Returns radiance interpolated from records valid at given point
+           with given normal, or None if there are no such records."""
+        point = position.data().tolist()
+        direction = normal.data().tolist()
+        total = None
+        total_weight = 0.0
+        indices = [index for level, grid in enumerate(self.grids)
+                   for index in grid.get(self._cell(level, point), ())]
+        for index in indices:
+            rec_point, rec_normal, value, radius = self.records[index]
+            offset = [point[axis] - rec_point[axis] for axis in range(3)]
+            cosine = sum(direction[axis] * rec_normal[axis] for axis in range(3))
+            # records in front of the point do not see its surroundings
+            if sum(offset[axis] * (direction[axis] + rec_normal[axis]) for axis in range(3)) < \
+               -_FRONT_TOLERANCE * radius:
+                continue
+            inv_weight = math.sqrt(sum(val * val for val in offset)) / radius + \
+                         math.sqrt(max(0.0, 1.0 - cosine))
+            if inv_weight >= self.error:
+                continue
+            weight = 1.0 / max(inv_weight, 1e-9)
+            total = value * weight if total is None else total + value * weight
+            total_weight += weight
+        if total is None:
+            return None
+        return Vec3(arr=total / total_weight)
+
+    #pylint: enable=too-many-locals
+
+    def add(self, position, normal, value, radius):
+        """Adds record of given radiance (Vec3) at given point with given
+           normal and harmonic mean distance to surrounding surfaces."""
+        radius = min(max(radius, self.min_radius), self.max_radius)
+        point = position.data().tolist()
+        index = len(self.records)
+        self.records.append((point, normal.data().tolist(),
+                             np.array(value.data(), dtype='double'), radius))
+
+        reach = self.error * radius
+        level = _grid_level(radius / self.min_radius)
+        grid = self.grids[level]
+        lo_cell = self._cell(level, [coord - reach for coord in point])
+        hi_cell = self._cell(level, [coord + reach for coord in point])
+        for cell_x in range(lo_cell[0], hi_cell[0] + 1):
+            for cell_y in range(lo_cell[1], hi_cell[1] + 1):
+                for cell_z in range(lo_cell[2], hi_cell[2] + 1):
+                    grid.setdefault((cell_x, cell_y, cell_z), []).append(index)
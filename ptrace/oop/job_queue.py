@@ -0,0 +1,271 @@
+"""Persistent queue of render jobs split into tiles, stored in a local SQLite
+   database, so that rendering survives restarts of worker processes."""
+
+import json
+import os
+import socket
+import sqlite3
+import time
+
+from .image_output import AccumulableImage
+
+
+# time (in seconds) after which tile claimed by a worker that did not report
+# it back is handed out again
+DEFAULT_LEASE_TIME = 300.0
+
+# number of finished tiles whose images are merged into job's checkpoint at once
+DEFAULT_CHECKPOINT_TILES = 32
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    scene TEXT NOT NULL,
+    params TEXT NOT NULL,
+    output_path TEXT,
+    status TEXT NOT NULL DEFAULT 'queued',
+    created REAL NOT NULL,
+    finished REAL,
+    checkpoint BLOB);
+CREATE TABLE IF NOT EXISTS tiles (
+    job_id INTEGER NOT NULL REFERENCES jobs(id),
+    tile_ix INTEGER NOT NULL,
+    tile TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    worker TEXT,
+    lease_until REAL,
+    PRIMARY KEY (job_id, tile_ix));
+CREATE TABLE IF NOT EXISTS tile_results (
+    job_id INTEGER NOT NULL REFERENCES jobs(id),
+    tile_ix INTEGER NOT NULL,
+    image BLOB NOT NULL,
+    PRIMARY KEY (job_id, tile_ix));
+CREATE INDEX IF NOT EXISTS tiles_status ON tiles (status, lease_until);
+"""
+
+
+def default_worker_name():
+    """Returns name identifying current worker process."""
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+
+class JobQueue():
+    """Stores render jobs (scene name and parameters), their tiles and progress
+       of rendering them, as well as rendered tile images, in an SQLite
+       database.
+
+       Workers claim tiles in transactions, leasing them for a limited time,
+       so tiles of killed workers are eventually handed out again. Rendered
+       tile is stored together with marking it done, and only if the lease
+       was still held, so no samples are lost or merged twice. Finished tile
+       images are periodically merged into per-job accumulation checkpoint."""
+
+    path = None
+    connection = None
+    lease_time = None
+    checkpoint_tiles = None
+
+    def __init__(self, path, lease_time=DEFAULT_LEASE_TIME,
+                 checkpoint_tiles=DEFAULT_CHECKPOINT_TILES):
+        """Opens (creating if needed) job queue database at given path."""
+        self.path = path
+        self.lease_time = lease_time
+        self.checkpoint_tiles = checkpoint_tiles
+        self.connection = sqlite3.connect(path, timeout=60.0, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.executescript(_SCHEMA)
+
+    def close(self):
+        """Closes database connection."""
+        self.connection.close()
+
+    def _transaction(self):
+        """Returns context manager of write transaction (taking database lock
+           immediately, so that concurrent claims are serialized)."""
+        return _Transaction(self.connection)
+
+    def submit(self, scene_name, renderer, output_path=None):
+        """Adds job of rendering given scene with parameters of given renderer
+           (which also splits it into tiles) and returns its id."""
+        params = renderer.params
+        tiles = renderer.generate_tiles(params['tile_size'], params['tile_size'],
+                                        params['samples_per_pixel'],
+                                        params['samples_per_tile'])
+        with self._transaction() as cursor:
+            cursor.execute('INSERT INTO jobs (scene, params, output_path, created) '
+                           'VALUES (?, ?, ?, ?)',
+                           (scene_name, json.dumps(params), output_path, time.time()))
+            job_id = cursor.lastrowid
+            cursor.executemany('INSERT INTO tiles (job_id, tile_ix, tile) VALUES (?, ?, ?)',
+                               [(job_id, index, json.dumps(tile))
+                                for index, tile in enumerate(tiles)])
+        return job_id
+
+    def claim(self, worker):
+        """Claims next tile to render (in job submission and tile priority
+           order) for given worker. Returns tuple of job id, tile index, tile,
+           scene name and parameters (or None if there are no tiles to
+           render)."""
+        now = time.time()
+        with self._transaction() as cursor:
+            row = cursor.execute( \
+                "SELECT job_id, tile_ix, tile FROM tiles WHERE status = 'pending' OR "
+                "(status = 'claimed' AND lease_until < ?) "
+                "ORDER BY job_id, tile_ix LIMIT 1", (now,)).fetchone()
+            if row is None:
+                return None
+            job_id, tile_ix, tile = row
+            cursor.execute("UPDATE tiles SET status = 'claimed', worker = ?, lease_until = ? "
+                           "WHERE job_id = ? AND tile_ix = ?",
+                           (worker, now + self.lease_time, job_id, tile_ix))
+            cursor.execute("UPDATE jobs SET status = 'running' WHERE id = ? "
+                           "AND status = 'queued'", (job_id,))
+            scene, params = cursor.execute('SELECT scene, params FROM jobs WHERE id = ?',
+                                           (job_id,)).fetchone()
+        return job_id, tile_ix, json.loads(tile), scene, json.loads(params)
+
+    def complete(self, worker, job_id, tile_ix, image):
+        """Stores rendered image of tile claimed by given worker and marks the
+           tile as done. Returns false (discarding the image) if the tile is
+           no longer leased to the worker."""
+        with self._transaction() as cursor:
+            cursor.execute("UPDATE tiles SET status = 'done', lease_until = NULL "
+                           "WHERE job_id = ? AND tile_ix = ? AND status = 'claimed' "
+                           "AND worker = ?", (job_id, tile_ix, worker))
+            if cursor.rowcount == 0:
+                return False
+            cursor.execute('INSERT INTO tile_results (job_id, tile_ix, image) VALUES (?, ?, ?)',
+                           (job_id, tile_ix, image.to_bytes()))
+
+            left = cursor.execute("SELECT COUNT(*) FROM tiles WHERE job_id = ? "
+                                  "AND status != 'done'", (job_id,)).fetchone()[0]
+            unmerged = cursor.execute('SELECT COUNT(*) FROM tile_results WHERE job_id = ?',
+                                      (job_id,)).fetchone()[0]
+            if left == 0 or unmerged >= self.checkpoint_tiles:
+                self._merge_results(cursor, job_id)
+            if left == 0:
+                cursor.execute("UPDATE jobs SET status = 'done', finished = ? WHERE id = ?",
+                               (time.time(), job_id))
+        return True
+
+    def release(self, worker):
+        """Returns all tiles claimed by given worker (e.g. one restarted after
+           being killed) to pending state. Returns number of released tiles."""
+        with self._transaction() as cursor:
+            cursor.execute("UPDATE tiles SET status = 'pending', worker = NULL, "
+                           "lease_until = NULL WHERE status = 'claimed' AND worker = ?",
+                           (worker,))
+            return cursor.rowcount
+
+    def release_all(self):
+        """Returns all claimed tiles to pending state (only safe when no worker
+           is running). Returns number of released tiles."""
+        with self._transaction() as cursor:
+            cursor.execute("UPDATE tiles SET status = 'pending', worker = NULL, "
+                           "lease_until = NULL WHERE status = 'claimed'")
+            return cursor.rowcount
+
+    def checkpoint(self, job_id):
+        """Merges all finished tile images of given job into its checkpoint."""
+        with self._transaction() as cursor:
+            self._merge_results(cursor, job_id)
+
+    def _merge_results(self, cursor, job_id):
+        """Merges finished tile images of given job into its checkpoint within
+           transaction of given cursor."""
+        output = self._load_checkpoint(cursor, job_id)
+        rows = cursor.execute('SELECT t.tile, r.image FROM tile_results r JOIN tiles t '
+                              'ON r.job_id = t.job_id AND r.tile_ix = t.tile_ix '
+                              'WHERE r.job_id = ?', (job_id,)).fetchall()
+        if not rows:
+            return
+        for tile, image in rows:
+            tile = json.loads(tile)
+            output.add_image_block(tile['x_range'][0], tile['y_range'][0],
+                                   AccumulableImage.from_bytes(image))
+        cursor.execute('UPDATE jobs SET checkpoint = ? WHERE id = ?',
+                       (output.to_bytes(), job_id))
+        cursor.execute('DELETE FROM tile_results WHERE job_id = ?', (job_id,))
+
+    @staticmethod
+    def _load_checkpoint(cursor, job_id):
+        """Returns accumulation checkpoint of given job (empty image if none
+           has been stored yet)."""
+        params, checkpoint = cursor.execute('SELECT params, checkpoint FROM jobs WHERE id = ?',
+                                            (job_id,)).fetchone()
+        if checkpoint is not None:
+            return AccumulableImage.from_bytes(checkpoint)
+        params = json.loads(params)
+        return AccumulableImage(params['width'], params['height'], params['precision'],
+                                params['target_error'] is not None or params['denoise'])
+
+    def result(self, job_id):
+        """Returns accumulable image with all tiles of given job rendered so far
+           (also merging them into the checkpoint)."""
+        with self._transaction() as cursor:
+            self._merge_results(cursor, job_id)
+            return self._load_checkpoint(cursor, job_id)
+
+    def jobs(self):
+        """Returns list of dictionaries describing all jobs and their
+           progress."""
+        rows = self.connection.execute( \
+            "SELECT j.id, j.scene, j.output_path, j.status, j.created, j.finished, "
+            "COUNT(t.tile_ix), COALESCE(SUM(t.status = 'done'), 0), "
+            "COALESCE(SUM(t.status = 'claimed'), 0) "
+            "FROM jobs j LEFT JOIN tiles t ON t.job_id = j.id "
+            "GROUP BY j.id ORDER BY j.id").fetchall()
+        keys = ('id', 'scene', 'output_path', 'status', 'created', 'finished',
+                'tiles', 'tiles_done', 'tiles_claimed')
+        return [dict(zip(keys, row)) for row in rows]
+
+    def job(self, job_id):
+        """Returns dictionary describing job with given id (or None)."""
+        return next((job for job in self.jobs() if job['id'] == job_id), None)
+
+
+class _Transaction():
+    """Context manager of immediate SQLite transaction, committed on success
+       and rolled back on exception."""
+
+    connection = None
+    cursor = None
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        self.cursor = self.connection.cursor()
+        self.cursor.execute('BEGIN IMMEDIATE')
+        return self.cursor
+
+    def __exit__(self, exc_type, *_):
+        self.cursor.execute('ROLLBACK' if exc_type is not None else 'COMMIT')
+        self.cursor.close()
+
+
+def run_queue_worker(queue, renderer_factory, worker=None, verbose=False, should_stop=None):
+    """Claims and renders tiles from given job queue until there are none
+       left (or stop predicate, if given, returns true). Renderers are created
+       with given factory called with scene name and parameters of a job.
+       Returns number of rendered tiles."""
+    worker = worker if worker is not None else default_worker_name()
+    queue.release(worker)
+    renderers = {}
+    tile_count = 0
+    while should_stop is None or not should_stop():
+        claimed = queue.claim(worker)
+        if claimed is None:
+            break
+        job_id, tile_ix, tile, scene, params = claimed
+        if job_id not in renderers:
+            renderers = {job_id: renderer_factory(scene, params)}
+        image = renderers[job_id].render_tile(tile)
+        if queue.complete(worker, job_id, tile_ix, image):
+            tile_count += 1
+        if verbose:
+            print("\rWorker {}: job {}, tiles rendered: {}".format(worker, job_id, tile_count),
+                  end='')
+    if verbose:
+        print()
+    return tile_count
@@ -223,6 +223,18 @@ class CameraTests(unittest.TestCase):
                 ray = cam.get_ray(px_x, px_y)
                 self.assertGreaterEqual(ray.direction.dot(Vec3.versor(0)), 0.0)
 
+    def test_cam_batch(self):
+        """Batched camera rays match rays cast one by one."""
+        cam = Camera(Vec3(0, 0, -3), Vec3(), Vec3.versor(1), 8, 6, 40)
+        px_x, px_y = np.meshgrid(np.arange(8), np.arange(6), indexing='ij')
+        rays = cam.get_rays(px_x.ravel(), px_y.ravel(), jitter=False, dtype='single')
+        self.assertEqual(rays.dtype, np.dtype('single'))
+        for index, (x_pos, y_pos) in enumerate(zip(px_x.ravel(), px_y.ravel())):
+            #pylint: disable=protected-access
+            ray = cam._ray_from_unit(2.0 * (x_pos + 0.5) / 8 - 1.0, 2.0 * (y_pos + 0.5) / 6 - 1.0)
+            self.assertTrue(np.allclose(rays.directions[index], ray.direction.data(), atol=1e-6))
+            self.assertTrue(np.allclose(rays.origins[index], ray.origin.data()))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -30,8 +30,9 @@ class MatteMaterial(Material):
 
     def sample(self, hit_record, incoming_ray, radiance_sampler, u_pos, v_pos, prob):
         """Samples material for emitted light given ray collision record,
-           incoming ray, specific radiance sampling finction (Ray -> Vec3),
-           as well as uniform u, v coordinates and preset sampling probability.
+           incoming ray, specific radiance sampling finction (Ray -> Vec3, with
+           'diffuse' method for diffuse reflection rays), as well as uniform
+           u, v coordinates and preset sampling probability.
            """
         ior_from = 1.0
         ior_to = self.material_data.refraction_index
@@ -49,8 +50,8 @@ class MatteMaterial(Material):
         # diffuse reflection
         basis = OrthonormalBasis.from_z_axis(hit_record.normal)
         return self.material_data.diffuse * \
-                     radiance_sampler(Ray(hit_record.position, \
-                                      sample_hemisphere(basis, u_pos, v_pos)))
+                     radiance_sampler.diffuse(hit_record, Ray(hit_record.position, \
+                                              sample_hemisphere(basis, u_pos, v_pos)))
 
 
 class ShinyMaterial(Material):
@@ -63,8 +64,9 @@ class ShinyMaterial(Material):
 
     def sample(self, hit_record, incoming_ray, radiance_sampler, u_pos, v_pos, prob):
         """Samples material for emitted light given ray collision record,
-           incoming ray, specific radiance sampling finction (Ray -> Vec3),
-           as well as uniform u, v coordinates and preset sampling probability.
+           incoming ray, specific radiance sampling finction (Ray -> Vec3, with
+           'diffuse' method for diffuse reflection rays), as well as uniform
+           u, v coordinates and preset sampling probability.
            """
 
         # specular reflection
@@ -75,8 +77,8 @@ class ShinyMaterial(Material):
 
         basis = OrthonormalBasis.from_z_axis(hit_record.normal)
         return self.material_data.diffuse * \
-                radiance_sampler(Ray(hit_record.position, \
-                                 sample_hemisphere(basis, u_pos, v_pos)))
+                radiance_sampler.diffuse(hit_record, Ray(hit_record.position, \
+                                         sample_hemisphere(basis, u_pos, v_pos)))
 
 #pylint: enable=too-many-arguments
 
@@ -2,10 +2,82 @@
 
 import math
 
+import numpy as np
+
 from .raycast_base import HitRecord
 
 _EPS = 0.0000001
 
+# Minimal distances of valid hits used to avoid self-intersections for
+# respective floating point types. Hit positions (i.e. origins of secondary
+# rays) computed in single precision have relative error of about 1e-7, so for
+# scenes spanning tens of units they are off by up to 1e-5.
+_EPS_BY_DTYPE = { \
+    np.dtype('double'): _EPS,
+    np.dtype('single'): 0.0001}
+
+# Relative offsets along surface normal applied to origins of secondary rays.
+# In single precision distance threshold alone is not enough for grazing rays,
+# as error of sphere equation coefficients grows with squared radius.
+_SPAWN_OFFSET_BY_DTYPE = { \
+    np.dtype('double'): 0.0,
+    np.dtype('single'): 0.00003}
+
+
+def ray_epsilon(dtype):
+    """Returns minimal distance of a valid ray hit for given floating point type
+       of ray data."""
+    return _EPS_BY_DTYPE[np.dtype(dtype)]
+
+def spawn_offset(dtype):
+    """Returns relative offset of secondary ray origins from surface for given
+       floating point type of ray data."""
+    return _SPAWN_OFFSET_BY_DTYPE[np.dtype(dtype)]
+
+
+def _dot_rows(lhs, rhs):
+    """Row-wise dot product of two arrays of vectors."""
+    return np.einsum('ij,ij->i', lhs, rhs)
+
+def triangle_hits(rays, corners):
+    """Performs vectorized intersection of given rays with triangle of given
+       corners (3x3 array), returning arrays of distances (infinite for rays
+       that miss), barycentric coordinates u, v and backface flags."""
+    eps = ray_epsilon(rays.dtype)
+    corners = np.asarray(corners, dtype='double')
+    vert0 = corners[0].astype(rays.dtype)
+    face_u = (corners[1] - corners[0]).astype(rays.dtype)
+    face_v = (corners[2] - corners[0]).astype(rays.dtype)
+
+    p_vec = np.cross(rays.directions, face_v)
+    det = p_vec @ face_u
+    parallel = np.abs(det) < _EPS
+    det = np.where(parallel, 1.0, det).astype(rays.dtype)
+
+    t_vec = rays.origins - vert0
+    u_pos = _dot_rows(t_vec, p_vec) / det
+    q_vec = np.cross(t_vec, face_u)
+    v_pos = _dot_rows(rays.directions, q_vec) / det
+    t_val = (q_vec @ face_v) / det
+
+    missed = parallel | (u_pos < 0.0) | (u_pos > 1.0) | (v_pos < 0.0) | \
+             (u_pos + v_pos > 1.0) | (t_val < eps)
+    t_val[missed] = np.inf
+    return t_val, u_pos, v_pos, det < _EPS
+
+def triangle_normals(rays, corners, normals):
+    """Returns arrays of normals (facing against rays, interpolated from given
+       vertex normals, 3x3 array) and inside flags of triangle of given
+       corners at points where given rays hit it."""
+    _, u_pos, v_pos, is_backface = triangle_hits(rays, corners)
+    normals = np.asarray(normals, dtype='double').astype(rays.dtype)
+    delta_u_norm = normals[1] - normals[0]
+    delta_v_norm = normals[2] - normals[0]
+    result = np.outer(u_pos, delta_u_norm) + np.outer(v_pos, delta_v_norm) + normals[0]
+    result /= np.sqrt(_dot_rows(result, result))[:, np.newaxis]
+    result[is_backface] *= -1
+    return result.astype(rays.dtype), is_backface
+
 
 class Primitive():
     """Base class for geometry primitives."""
@@ -18,6 +90,11 @@ class Primitive():
         """Checks whether given ray intersects with the primitive."""
         return None
 
+    def bounds(self):
+        """Returns lower and upper corners of bounding box of the primitive
+           (as numpy arrays), or None if it is unbounded."""
+        return None
+
     #pylint: enable=no-self-use
     #pylint: disable=assignment-from-none
 
@@ -29,6 +106,46 @@ class Primitive():
             return None
         return {'hit_record': hit, 'material': self.material}
 
+    def occluded(self, ray, max_distance=float('inf')):
+        """Checks whether the primitive blocks given ray before given
+           distance."""
+        hit = self.intersect(ray)
+        return hit is not None and hit.distance < max_distance
+
+    def occluded_batch(self, rays, max_distances=np.inf):
+        """Checks which rays from given batch are blocked by the primitive
+           before given distances (scalar or per ray array)."""
+        return self.intersect_batch(rays) < max_distances
+
+    def intersect_batch(self, rays):
+        """Checks which rays from given batch intersect with the primitive and
+           returns array of distances to hits (infinite for rays that miss).
+
+           Generic implementation intersecting rays one by one."""
+        result = np.full(len(rays), np.inf, dtype=rays.dtype)
+        for index, ray in enumerate(rays):
+            hit = self.intersect(ray)
+            if hit:
+                result[index] = hit.distance
+        return result
+
+    #pylint: disable=unused-argument
+
+    def normal_batch(self, rays, distances):
+        """Returns arrays of normals (facing against rays) and inside flags of
+           the primitive at points where given rays hit it at given distances.
+
+           Generic implementation intersecting rays one by one."""
+        normals = np.zeros((len(rays), 3), dtype=rays.dtype)
+        is_inside = np.zeros(len(rays), dtype='bool')
+        for index, ray in enumerate(rays):
+            hit = self.intersect(ray)
+            if hit:
+                normals[index] = hit.normal.data()
+                is_inside[index] = hit.is_inside
+        return normals, is_inside
+
+    #pylint: enable=unused-argument
     #pylint: enable=assignment-from-none
 
 
@@ -49,6 +166,11 @@ class Sphere(Primitive):
         """Checks whether point lies within the sphere."""
         return abs(point - self.centre) <= self.radius
 
+    def bounds(self):
+        """Returns lower and upper corners of bounding box of the sphere."""
+        centre = self.centre.data().astype('double')
+        return centre - self.radius, centre + self.radius
+
     def intersect(self, ray):
         """Checks whether given ray intersects with the sphere.
 
@@ -75,6 +197,44 @@ class Sphere(Primitive):
             hit_norm = -hit_norm
         return HitRecord(t_val, hit_pos, hit_inside, hit_norm)
 
+    def occluded(self, ray, max_distance=float('inf')):
+        """Checks whether the sphere blocks given ray before given distance
+           (without computing hit record)."""
+        orig = self.centre - ray.origin
+        b_coeff = orig.dot(ray.direction)
+        discr = b_coeff ** 2 - orig.sqr_length() + self.radius ** 2
+        if discr < 0.0:
+            return False
+        discr = math.sqrt(discr)
+        t_val = b_coeff - discr
+        if t_val <= _EPS:
+            t_val = b_coeff + discr
+        return _EPS < t_val < max_distance
+
+    def intersect_batch(self, rays):
+        """Checks which rays from given batch intersect with the sphere and
+           returns array of distances to hits (infinite for rays that miss)."""
+        eps = ray_epsilon(rays.dtype)
+        orig = self.centre.data().astype(rays.dtype) - rays.origins
+        b_coeff = _dot_rows(orig, rays.directions)
+        discr = b_coeff ** 2 - _dot_rows(orig, orig) + rays.dtype.type(self.radius ** 2)
+        missed = discr < 0.0
+        discr = np.sqrt(np.where(missed, 0.0, discr).astype(rays.dtype))
+        t_neg = b_coeff - discr
+        t_pos = b_coeff + discr
+        t_val = np.where(t_neg > eps, t_neg, np.where(t_pos > eps, t_pos, np.inf))
+        t_val[missed] = np.inf
+        return t_val.astype(rays.dtype)
+
+    def normal_batch(self, rays, distances):
+        """Returns arrays of normals (facing against rays) and inside flags of
+           the sphere at points where given rays hit it at given distances."""
+        normals = rays.points_at(distances) - self.centre.data().astype(rays.dtype)
+        normals /= np.sqrt(_dot_rows(normals, normals))[:, np.newaxis]
+        is_inside = _dot_rows(normals, rays.directions) > 0.0
+        normals[is_inside] *= -1
+        return normals, is_inside
+
 class Triangle(Primitive):
     """Class representing geometry of a triangle."""
 
@@ -101,6 +261,11 @@ class Triangle(Primitive):
         """Returns normal vector to triangle face."""
         return self.face_u().cross(self.face_v()).normalised()
 
+    def bounds(self):
+        """Returns lower and upper corners of bounding box of the triangle."""
+        vertices = self._corners()
+        return vertices.min(axis=0), vertices.max(axis=0)
+
     def intersect(self, ray):
         """Checks whether given ray intersects with the triangle."""
 
@@ -134,3 +299,42 @@ class Triangle(Primitive):
             hit_norm = -hit_norm
 
         return HitRecord(t_val, ray.point_at(t_val), is_backface, hit_norm)
+
+    def occluded(self, ray, max_distance=float('inf')):
+        """Checks whether the triangle blocks given ray before given distance
+           (without interpolating normals)."""
+        face_u = self.face_u()
+        face_v = self.face_v()
+        p_vec = ray.direction.cross(face_v)
+        det = face_u.dot(p_vec)
+        if abs(det) < _EPS:
+            return False
+
+        t_vec = ray.origin - self.vertices[0]
+        u_pos = t_vec.dot(p_vec) / det
+        if u_pos < 0.0 or u_pos > 1.0:
+            return False
+        q_vec = t_vec.cross(face_u)
+        v_pos = ray.direction.dot(q_vec) / det
+        if v_pos < 0.0 or u_pos + v_pos > 1.0:
+            return False
+        return _EPS <= face_v.dot(q_vec) / det < max_distance
+
+    def _corners(self):
+        """Returns 3x3 array of vertices of the triangle."""
+        return np.array([vertex.data() for vertex in self.vertices], dtype='double')
+
+    def intersect_batch(self, rays):
+        """Checks which rays from given batch intersect with the triangle and
+           returns array of distances to hits (infinite for rays that miss)."""
+        return triangle_hits(rays, self._corners())[0]
+
+    #pylint: disable=unused-argument
+
+    def normal_batch(self, rays, distances):
+        """Returns arrays of normals (facing against rays) and inside flags of
+           the triangle at points where given rays hit it at given distances."""
+        return triangle_normals(rays, self._corners(),
+                                [normal.data() for normal in self.normals])
+
+    #pylint: enable=unused-argument
@@ -1,9 +1,23 @@
 """Encapsulates monte carlo path tracing rendering engine."""
 
+import math
 import random
-
-from .vector import Vec3
-from.image_output import AccumulableImage
+import time
+
+import numpy as np
+
+from .vector import Vec3, OrthonormalBasis, sample_hemisphere
+from .raycast_base import Ray, HitBatch
+from .utils import seed_random
+from .aov import render_aovs
+from .bvh import BvhCache
+from .irradiance_cache import IrradianceCache
+from .photon_map import trace_photons
+from .path_guiding import PathGuide
+from .ray_order import pixel_order
+from .image_output import AccumulableImage, MappedAccumulableImage
+from .tile_scheduler import TileScheduler, make_tile, tile_priority, tile_pixel_samples, \
+                            run_scheduler
 
 ## Hardcoded renderer parameters:
 DEFAULT_RENDERER_PARAMS = { \
@@ -14,7 +28,46 @@ DEFAULT_RENDERER_PARAMS = { \
     'max_cpus': 1,
     'max_depth': 5,
     'first_bounce_u_samples': 4,
-    'first_bounce_v_samples': 4}
+    'first_bounce_v_samples': 4,
+    'accumulation_path': None,
+    'accumulation_tile_size': 64,
+    'precision': 'double',
+    'tiled': False,
+    'tile_size': 32,
+    'samples_per_tile': 1,
+    'target_tile_time': 0.5,
+    'time_budget': None,
+    'target_error': None,
+    'progressive': False,
+    'progressive_levels': [16, 4],
+    'progressive_level_samples': 1,
+    'ray_batch_size': 65536,
+    'denoise': False,
+    'seed': None,
+    'scene_size': None,
+    'scene_seed': 0,
+    'bvh_min_primitives': 16,
+    'bvh_leaf_size': 4,
+    'bvh_cache_path': None,
+    'irradiance_cache_error': None,
+    'irradiance_cache_samples': 32,
+    'photon_count': None,
+    'photon_radius': 0.1,
+    'guiding_fraction': None,
+    'guiding_resolution': 16,
+    'guiding_split_records': 4000,
+    'primary_hit_strata': None,
+    'pixel_order': 'scanline',
+    'tile_order': 'centre'}
+
+
+# minimal interval (in seconds) between estimating error in tiled rendering
+_ERROR_CHECK_INTERVAL = 0.5
+
+# kinds of paths: after diffuse reflection, and after specular reflection
+# following diffuse one (light reaching them comes from caustic photon map)
+PATH_DIFFUSE = 'diffuse'
+PATH_CAUSTIC = 'caustic'
 
 
 #pylint: disable=too-few-public-methods
@@ -24,35 +77,151 @@ class RadianceSampler():
 
     renderer = None
     depth = 0
+    # kind of path sampled rays continue (see Renderer.radiance)
+    path = None
 
-    def __init__(self, renderer, depth=0):
-        """Initializes sampler for given renderer at given depth."""
+    def __init__(self, renderer, depth=0, path=None):
+        """Initializes sampler for given renderer at given depth, continuing
+           path of given kind."""
         self.renderer = renderer
         self.depth = depth
+        self.path = path
 
     def __call__(self, ray):
-        """Performs sampling using current renderer and depth setting."""
-        return self.renderer.radiance(ray, self.depth)
+        """Performs sampling using current renderer and depth setting (for
+           specular reflection rays)."""
+        path = PATH_CAUSTIC if self.path in (PATH_DIFFUSE, PATH_CAUSTIC) else None
+        return self.renderer.radiance(ray, self.depth, path)
+
+    def diffuse(self, hit_record, ray):
+        """Samples incoming radiance for given (cosine-weighted) diffuse
+           reflection ray leaving given hit. Beyond the first bounce it is
+           taken from irradiance cache of the renderer (if enabled). Otherwise
+           direction may be importance sampled by path guide (if enabled).
+           Irradiance from caustic photon map (if any) is added to it."""
+        renderer = self.renderer
+        if renderer.irradiance_caches is None or self.depth < 2 or \
+           self.depth >= renderer.params['max_depth']:
+            result = renderer.radiance(ray, self.depth, PATH_DIFFUSE) \
+                     if renderer.path_guide is None \
+                     else renderer.guided_radiance(hit_record, ray, self.depth)
+        else:
+            result = renderer.cached_irradiance(hit_record, self.depth)
+        if renderer.photon_map is not None:
+            result = result + renderer.photon_map.irradiance( \
+                hit_record.position, hit_record.normal, renderer.params['photon_radius']) / math.pi
+        return result
 
 #pylint: enable=too-few-public-methods
 
 
 
+def completed_passes(output):
+    """Returns number of sampling passes given output image is complete for,
+       i.e. the lowest number of samples accumulated in any of its pixels."""
+    return int(np.min(output.pixel_sample_counts()))
+
+
+#pylint: disable=too-many-instance-attributes
+
 class Renderer():
     """Rendering engine for monte carlo path tracing method."""
 
     scene = None
     camera = None
     params = None
+    stats = None
+    # irradiance caches by depth of rays sampling their records
+    irradiance_caches = None
+    # map of caustic photons (see trace_photons)
+    photon_map = None
+    # distributions of incoming radiance learned from completed passes
+    path_guide = None
+    # cached camera rays and their first hits by sub-pixel stratum
+    primary_hits = None
+    # function submitting tiles to shared worker pool (see run_scheduler)
+    submit_tile = None
 
     def __init__(self, scene, camera, params=None):
-        """Initializes renderer with given scene, camera, and parameters."""
+        """Initializes renderer with given scene, camera, and parameters.
+
+           Bounding volume hierarchy is built for scenes with at least
+           'bvh_min_primitives' primitives (unless it is None), or loaded from
+           cache directory given by 'bvh_cache_path' parameter. Irradiance
+           cache is used if 'irradiance_cache_error' parameter is set (each
+           worker process fills its own cache). Caustics are rendered with
+           photon map if 'photon_count' parameter is set. Diffuse reflections
+           are guided by distributions learned from completed passes (or
+           tiles, separately by each worker process) if 'guiding_fraction'
+           parameter (probability of sampling them) is set. First hits of
+           camera rays are cached and replayed in later passes if
+           'primary_hit_strata' parameter is set."""
         self.scene = scene
         self.camera = camera
-        self.params = params if params is not None else DEFAULT_RENDERER_PARAMS
-
-    def render(self, verbose=False):
-        """Renders scene returns accumulable image."""
+        self.params = dict(DEFAULT_RENDERER_PARAMS, **params) if params is not None \
+                      else DEFAULT_RENDERER_PARAMS
+        min_primitives = self.params['bvh_min_primitives']
+        if min_primitives is not None and len(scene.primitives) >= min_primitives and \
+           not scene.has_bvh():
+            cache_path = self.params['bvh_cache_path']
+            scene.build_bvh(self.params['bvh_leaf_size'],
+                            BvhCache(cache_path) if cache_path else None)
+        if self.params['photon_count'] is not None:
+            self.trace_photons()
+        if self.params['guiding_fraction'] is not None:
+            assert 0.0 <= self.params['guiding_fraction'] < 1.0
+        if self.params['primary_hit_strata'] is not None:
+            assert self.params['primary_hit_strata'] > 0
+            self.primary_hits = {}
+        self.reset_learned_state()
+
+    def reset_learned_state(self):
+        """Discards state learned while rendering (irradiance caches and path
+           guide), so that renders do not depend on previous ones."""
+        if self.params['irradiance_cache_error'] is not None:
+            self.irradiance_caches = {}
+        if self.params['guiding_fraction'] is not None:
+            self.path_guide = PathGuide(self.scene.bounds(), self.params['guiding_resolution'],
+                                        self.params['guiding_split_records'])
+
+    def trace_photons(self):
+        """Traces 'photon_count' photons through the scene (seeded with 'seed'
+           parameter, if set) and stores photon map of caustics."""
+        self.photon_map = trace_photons(self.scene, self.params['photon_count'],
+                                        self.params['max_depth'],
+                                        np.random.default_rng(self.params['seed']))
+
+    def render(self, verbose=False, update=None, resume_from=None):
+        """Renders scene returns accumulable image.
+
+           In 'preview' mode each sampling pass is a single vectorized first
+           hit pass over the whole image. Otherwise uses tiled rendering if
+           'tiled' parameter is set or more than one cpu is allowed
+           ('max_cpus' parameter). Update function (if given) is
+           called with partial output image after each sampling pass (or
+           tile).
+
+           Rendering stops after 'samples_per_pixel' passes, or earlier if
+           'time_budget' (in seconds) would be exceeded by the next pass or
+           estimated relative error drops to 'target_error'. Achieved number of
+           samples per pixel and estimated error are stored in 'stats'.
+
+           If previously rendered output image is given to resume from, samples
+           are accumulated into it, starting after the number of sampling
+           passes it is complete for. If 'seed' parameter is set, random
+           generators are seeded with it, sample index and pixel position
+           before each pixel sample (or each pass in preview mode), so that
+           rendering (and resumed rendering) is reproducible, and does not
+           depend on whether (and how) the image is split into tiles. State
+           learned while rendering (path guide, irradiance caches) depends on
+           order of pixels, so images rendered with them are reproducible
+           only with the same 'pixel_order' in non-tiled rendering. It is
+           discarded at the start of each rendering, so resumed rendering
+           learns it again from the first resumed pass."""
+
+        if not self.params['preview'] and (self.params['tiled'] or self.params['max_cpus'] > 1):
+            return self.render_tiled(verbose, update, resume_from)
+        self.reset_learned_state()
 
         height = self.params['height']
         width = self.params['width']
@@ -61,41 +230,326 @@ class Renderer():
         if verbose:
             print("Rendering... Sampling passes done:  0/{:2}".format(samples), end='')
 
-        output = AccumulableImage(width, height)
-        for sample in range(1, samples + 1):
-            for x_pos in range(0, width):
-                for y_pos in range(0, height):
-                    ray = self.camera.get_ray(x_pos, y_pos)
-                    output.add_samples(x_pos, y_pos, self.radiance(ray, 0), 1)
+        start_time = time.time()
+        stop_reason = 'samples'
+        output = resume_from if resume_from is not None else self.create_output(width, height)
+        first_sample = completed_passes(output)
+        for sample in range(first_sample + 1, samples + 1):
+            if self.params['seed'] is not None:
+                seed_random(self.params['seed'], sample - 1)
+            if self.params['preview']:
+                self.preview_pass(output)
+            elif self.primary_hits is not None:
+                self.replay_pass(output, sample - 1)
+                if self.path_guide is not None:
+                    self.path_guide.update()
+            else:
+                self.render_pass(output, sample_ix=sample - 1)
+            if update is not None:
+                update(output, None)
             if verbose:
                 print("\rRendering... Sampling passes done: {:2}/{:2}".format(sample, samples),
                       end='')
+            elapsed = time.time() - start_time
+            if sample < samples and \
+               self._exceeds_budget(elapsed, elapsed / (sample - first_sample)):
+                stop_reason = 'time_budget'
+                break
+            if sample < samples and self._meets_target_error(output):
+                stop_reason = 'target_error'
+                break
+
+        self._update_stats(output, start_time, stop_reason, verbose)
+        return output
+
+    def _seed_pixel(self, sample_ix, x_pos, y_pos):
+        """Seeds random generators for sample of given index of given pixel
+           (if 'seed' parameter and sample index are set)."""
+        if self.params['seed'] is not None and sample_ix is not None:
+            seed_random(self.params['seed'], sample_ix, x_pos, y_pos)
+
+    def render_pass(self, output, camera=None, sample_ix=None):
+        """Renders single sample (of given index, used for seeding) for every
+           pixel of the image accumulating them into given output image (using
+           given camera set up for its resolution, renderer's camera by
+           default), visiting pixels in 'pixel_order'."""
+        camera = camera if camera is not None else self.camera
+        for x_pos, y_pos in pixel_order(output.width, output.height, self.params['pixel_order']):
+            self._seed_pixel(sample_ix, x_pos, y_pos)
+            ray = camera.get_ray(x_pos, y_pos)
+            output.add_samples(x_pos, y_pos, self.radiance(ray, 0), 1)
+        if self.path_guide is not None:
+            self.path_guide.update()
+
+    #pylint: disable=too-many-locals
+
+    def replay_pass(self, output, sample_ix, x_range=None, y_range=None):
+        """Renders sample of given index for every pixel of the image (or of
+           given ranges of pixels, accumulated at positions relative to their
+           beginnings) into given output image, replaying cached first hits
+           of camera rays of its stratum, so that only further bounces are
+           traced."""
+        x_beg, x_end = x_range if x_range is not None else (0, output.width)
+        y_beg, y_end = y_range if y_range is not None else (0, output.height)
+        rays, hits, material_ids, materials = self.cached_primary_hits(sample_ix, (x_beg, x_end),
+                                                                       (y_beg, y_end))
+        for x_pos, y_pos in pixel_order(x_end - x_beg, y_end - y_beg, self.params['pixel_order']):
+            self._seed_pixel(sample_ix, x_pos + x_beg, y_pos + y_beg)
+            index = x_pos * (y_end - y_beg) + y_pos
+            material_ix = material_ids[index]
+            if material_ix < 0:
+                colour = self.scene.environment_colour
+            else:
+                ray = Ray(Vec3(arr=rays.origins[index].copy()),
+                          Vec3(arr=rays.directions[index].copy()))
+                colour = self._shade(ray, {'hit_record': hits[index],
+                                           'material': materials[material_ix]}, 0)
+            output.add_samples(x_pos, y_pos, colour, 1)
+
+    def cached_primary_hits(self, sample_ix, x_range=None, y_range=None):
+        """Returns camera rays of pixels in given ranges (whole image by
+           default, flattened column by column) for sample of given index,
+           their hit batch, indices of materials hit (-1 for misses) and list
+           of these materials. Rays pass through one of 'primary_hit_strata'
+           x 'primary_hit_strata' sub-pixel strata (sample indices cycle
+           through them), jittered once (seeded with 'seed' parameter and the
+           stratum, if set, the same way for any ranges), and are traced in
+           vectorized batches of 'ray_batch_size' on first use. Hits are
+           cached by stratum and ranges, so that tile workers trace only
+           their tiles. Cache must be cleared when camera or scene changes."""
+        strata = self.params['primary_hit_strata']
+        stratum = sample_ix % (strata * strata)
+        width, height = self.params['width'], self.params['height']
+        x_beg, x_end = x_range if x_range is not None else (0, width)
+        y_beg, y_end = y_range if y_range is not None else (0, height)
+        key = (stratum, x_beg, x_end, y_beg, y_end)
+        if key in self.primary_hits:
+            return self.primary_hits[key]
+
+        px_x, px_y = np.divmod(np.arange((x_end - x_beg) * (y_end - y_beg)), y_end - y_beg)
+        px_x += x_beg
+        px_y += y_beg
+        if self.params['seed'] is not None:
+            # jitter of the whole image, so that it does not depend on ranges
+            rng = np.random.default_rng((self.params['seed'], stratum))
+            jitter = rng.random((2, width * height))[:, px_x * height + px_y]
+        else:
+            jitter = np.random.random((2, len(px_x)))
+        offsets = (np.array([[stratum % strata], [stratum // strata]]) + jitter) / strata
+        rays = self.camera.get_rays(px_x, px_y, offsets=offsets)
+        batch_size = self.params['ray_batch_size']
+        batches = [self.scene.hit_batch(rays[beg:beg + batch_size])
+                   for beg in range(0, len(rays), batch_size)]
+        hits = HitBatch(*[np.concatenate([getattr(batch, name) for batch in batches])
+                          for name in ('distances', 'primitive_ids', 'positions', 'normals',
+                                       'is_inside')])
+
+        material_ids = np.full(len(rays), -1, dtype='int32')
+        materials = []
+        known = {}
+        for index in np.flatnonzero(hits.hit_mask()).tolist():
+            primitive = self.scene.primitives[hits.primitive_ids[index]]
+            material = primitive.material
+            if material is None:
+                # instances take materials of mesh primitives hit
+                material = primitive.intersect_ex(Ray(Vec3(arr=rays.origins[index].copy()),
+                                                      Vec3(arr=rays.directions[index].copy())))
+                material = material['material'] if material else None
+            if material is None:
+                continue
+            if id(material) not in known:
+                known[id(material)] = len(materials)
+                materials.append(material)
+            material_ids[index] = known[id(material)]
+        self.primary_hits[key] = (rays, hits, material_ids, materials)
+        return self.primary_hits[key]
+
+    #pylint: enable=too-many-locals
+
+    def preview_pass(self, output, camera=None):
+        """Renders single preview sample (i.e. preview colour of the first hit)
+           for every pixel of the image in a vectorized pass, accumulating them
+           into given output image (using given camera set up for its
+           resolution, renderer's camera by default)."""
+        camera = camera if camera is not None else self.camera
+        albedo = np.moveaxis(self.render_aov_buffers(camera, output.width, output.height,
+                                                     jitter=True).albedo, -1, 0)
+        output.add_block(0, 0, albedo, np.ones((output.width, output.height), dtype='int'),
+                         albedo ** 2)
+
+    def render_aov_buffers(self, camera=None, width=None, height=None, jitter=False):
+        """Renders AOV buffers (albedo, normal, depth and primitive index of the
+           first hits) in vectorized batches of 'ray_batch_size' rays (for image
+           of given dimensions and camera, renderer's ones by default)."""
+        return render_aovs(self.scene, camera if camera is not None else self.camera,
+                           width if width is not None else self.params['width'],
+                           height if height is not None else self.params['height'],
+                           self.params['ray_batch_size'], self.params['precision'], jitter)
+
+    def render_progressive(self, emit, verbose=False):
+        """Renders scene progressively: first at reduced resolutions (scaled
+           down by factors given in 'progressive_levels' parameter), then
+           refining full resolution image as in regular rendering.
+
+           Emit function is called with intermediate images (upsampled to full
+           resolution) and their labels, i.e. 'level<factor>' for reduced
+           resolution levels and 'progress' after each full resolution sampling
+           pass (or tile). Returns final accumulable image."""
+        height = self.params['height']
+        width = self.params['width']
+
+        for factor in self.params['progressive_levels']:
+            level_width = max(1, width // factor)
+            level_height = max(1, height // factor)
+            camera = self.camera.with_resolution(level_width, level_height)
+            level = AccumulableImage(level_width, level_height, self.params['precision'])
+            render_pass = self.preview_pass if self.params['preview'] else self.render_pass
+            for _ in range(self.params['progressive_level_samples']):
+                render_pass(level, camera)
+            if verbose:
+                print("Rendered preview level 1/{} ({}x{}).".format(factor, level_width,
+                                                                   level_height))
+            emit(level.upsampled(width, height), 'level{}'.format(factor))
+
+        return self.render(verbose, lambda output, _: emit(output, 'progress'))
+
+    def _exceeds_budget(self, elapsed, next_step_time):
+        """Checks whether next step of rendering taking given time would exceed
+           time budget given elapsed time."""
+        budget = self.params['time_budget']
+        return budget is not None and elapsed + next_step_time > budget
+
+    def _meets_target_error(self, output):
+        """Checks whether estimated error of given output meets the target."""
+        target = self.params['target_error']
+        return target is not None and output.estimated_error() <= target
+
+    def _update_stats(self, output, start_time, stop_reason, verbose):
+        """Stores statistics of finished rendering of given output image."""
+        self.stats = { \
+            'samples_per_pixel': output.total_sample_count() / (output.width * output.height),
+            'estimated_error': output.estimated_error() if output.tracks_variance() else None,
+            'render_time': time.time() - start_time,
+            'stop_reason': stop_reason}
         if verbose:
             print("\rRendering done.                                     ")
+            print("Achieved {:.2f} samples per pixel{} (stopped by: {}).".format( \
+                self.stats['samples_per_pixel'],
+                ", estimated error {:.4f}".format(self.stats['estimated_error']) \
+                    if self.stats['estimated_error'] is not None else '',
+                stop_reason))
+
+    def needs_variance(self):
+        """Checks whether rendering requires tracking variance of samples."""
+        return self.params['target_error'] is not None or self.params['denoise']
+
+    def create_output(self, width, height):
+        """Creates empty accumulable image of given dimensions, backed by
+           memory-mapped files if 'accumulation_path' parameter is set (which
+           limits memory use of tiled rendering only)."""
+        dtype = self.params['precision']
+        if self.params['accumulation_path']:
+            return MappedAccumulableImage(width, height, self.params['accumulation_path'],
+                                          self.params['accumulation_tile_size'], dtype=dtype,
+                                          track_variance=self.needs_variance())
+        return AccumulableImage(width, height, dtype, self.needs_variance())
 
-        return output
-
-    #pylint: disable=no-self-use
+    #pylint: disable=too-many-locals
 
-    def render_tiled(self):
+    def render_tiled(self, verbose=False, update=None, resume_from=None):
         """Renders scene in a tiled mode using given update function and returns
-           accumulable image."""
-        assert False, "Not yet implemented!"
+           accumulable image.
 
-    #pylint: enable=no-self-use
+           Tiles are handed out to 'max_cpus' worker processes (of shared
+           pool if tile submitting function is set) centre-first, so update
+           function (called with partial output image and a tile after each
+           tile is rendered) sees centre of the image resolve first. Output
+           image to resume from is handled as in render."""
+        height = self.params['height']
+        width = self.params['width']
+        tile_size = self.params['tile_size']
+        workers = max(1, self.params['max_cpus'])
+        output = resume_from if resume_from is not None else self.create_output(width, height)
+        self.reset_learned_state()
+
+        tiles = self.generate_tiles(tile_size, tile_size, self.params['samples_per_pixel'],
+                                    self.params['samples_per_tile'], width, height,
+                                    completed_passes(output))
+        scheduler = TileScheduler(tiles, width, height, workers,
+                                  self.params['target_tile_time'],
+                                  order=self.params['tile_order'])
+        total_samples = output.total_sample_count() + \
+                        sum(tile_pixel_samples(tile) for tile in tiles)
+
+        start_time = time.time()
+        state = {'stop_reason': 'samples', 'error_checked': start_time}
+
+        def on_tile(output, tile):
+            now = time.time()
+            if verbose:
+                print("\rRendering... Samples done: {:6.2f}%".format( \
+                    100.0 * output.total_sample_count() / total_samples), end='')
+            if now - state['error_checked'] >= _ERROR_CHECK_INTERVAL:
+                state['error_checked'] = now
+                if self._meets_target_error(output):
+                    state['stop_reason'] = 'target_error'
+            if update is not None:
+                update(output, tile)
+
+        def should_stop():
+            if scheduler.first_pass_pending():
+                return False
+            if self._exceeds_budget(time.time() - start_time,
+                                    scheduler.mean_tile_time() / workers):
+                state['stop_reason'] = 'time_budget'
+            return state['stop_reason'] != 'samples'
+
+        output = run_scheduler(self, scheduler, output, workers, on_tile, should_stop,
+                               self.submit_tile)
+        self._update_stats(output, start_time, state['stop_reason'], verbose)
+        return output
+
+    #pylint: enable=too-many-locals
+
+    def render_tile(self, tile):
+        """Renders given tile and returns accumulable image of its size."""
+        x_beg, x_end = tile['x_range']
+        y_beg, y_end = tile['y_range']
+        output = AccumulableImage(x_end - x_beg, y_end - y_beg, self.params['precision'],
+                                  self.needs_variance())
+        for sample in range(tile['samples']):
+            if self.primary_hits is not None:
+                self.replay_pass(output, tile['sample_ix'] + sample, (x_beg, x_end),
+                                 (y_beg, y_end))
+                continue
+            for x_pos, y_pos in pixel_order(x_end - x_beg, y_end - y_beg,
+                                            self.params['pixel_order']):
+                self._seed_pixel(tile['sample_ix'] + sample, x_pos + x_beg, y_pos + y_beg)
+                ray = self.camera.get_ray(x_pos + x_beg, y_pos + y_beg)
+                output.add_samples(x_pos, y_pos, self.radiance(ray, 0), 1)
+        if self.path_guide is not None:
+            self.path_guide.update()
+        return output
 
-    def radiance(self, ray, depth):
-        """Probes light for given ray and given maximal depth."""
+    def radiance(self, ray, depth, path=None):
+        """Probes light for given ray and given maximal depth. Kind of path
+           the ray continues (None for camera rays and their specular
+           reflections, PATH_DIFFUSE or PATH_CAUSTIC) is given, as light
+           emitted along caustic paths is already in photon map (if any)."""
 
         if depth >= self.params['max_depth']:
             return Vec3()
 
-        u_samples = self.params['first_bounce_u_samples'] if depth == 0 else 1
-        v_samples = self.params['first_bounce_v_samples'] if depth == 0 else 1
-
         hit = self.scene.intersect_ex(ray)
         if hit is None:
             return self.scene.environment_colour
+        return self._shade(ray, hit, depth, path)
+
+    def _shade(self, ray, hit, depth, path=None):
+        """Probes light leaving given hit (as returned by intersect_ex of the
+           scene) of given ray at given depth continuing path of given kind."""
+        u_samples = self.params['first_bounce_u_samples'] if depth == 0 else 1
+        v_samples = self.params['first_bounce_v_samples'] if depth == 0 else 1
 
         material = hit['material']
         if self.params['preview']:
@@ -103,7 +557,7 @@ class Renderer():
         hit = hit['hit_record']
 
         result = Vec3()
-        sampler = RadianceSampler(self, depth + 1)
+        sampler = RadianceSampler(self, depth + 1, path)
 
         # even sampling with random offset
         for u_ix in range(0, u_samples):
@@ -114,41 +568,88 @@ class Renderer():
 
                 result += material.sample(hit, ray, sampler, u_pos, v_pos, prob)
 
-        return material.total_emission(result / (u_samples * v_samples))
+        result /= u_samples * v_samples
+        if path == PATH_CAUSTIC and self.photon_map is not None:
+            return result
+        return material.total_emission(result)
+
+    def guided_radiance(self, hit_record, ray, depth):
+        """Returns radiance incoming at given hit along direction sampled from
+           path guide (with probability given by 'guiding_fraction' parameter,
+           once the cell of the hit learned its distribution) or along given
+           cosine-weighted diffuse reflection ray, weighted by ratio of
+           cosine-weighted density to the density of the mixture. Radiance is
+           recorded in the guide."""
+        guide = self.path_guide
+        cell = guide.cell(hit_record.position)
+        fraction = self.params['guiding_fraction'] if guide.is_guiding(cell) else 0.0
+        if fraction > 0.0 and random.random() < fraction:
+            ray = Ray(hit_record.position, guide.sample(cell, random.random(), random.random()))
+        cosine = hit_record.normal.dot(ray.direction)
+        if cosine <= 0.0:
+            return Vec3()
+        density = cosine / math.pi
+        if fraction > 0.0:
+            density = fraction * guide.pdf(cell, ray.direction) + (1.0 - fraction) * density
+        result = self.radiance(ray, depth, PATH_DIFFUSE)
+        guide.record(cell, ray.direction, float(np.mean(result.data())) / density)
+        return result * (cosine / math.pi / density)
+
+    def cached_irradiance(self, hit_record, depth):
+        """Returns average radiance incoming (from cosine-weighted hemisphere)
+           at given hit from irradiance cache, adding new record sampled with
+           rays of given depth if there are no valid records. Records are
+           kept separately for each depth, as paths sampling them are
+           truncated at different lengths."""
+        if depth not in self.irradiance_caches:
+            self.irradiance_caches[depth] = IrradianceCache(self.params['irradiance_cache_error'])
+        cache = self.irradiance_caches[depth]
+        value = cache.lookup(hit_record.position, hit_record.normal)
+        if value is not None:
+            return value
+
+        # stratified sampling of hemisphere, recording distances to hits
+        strata = max(1, int(round(self.params['irradiance_cache_samples'] ** 0.5)))
+        basis = OrthonormalBasis.from_z_axis(hit_record.normal)
+        value = Vec3()
+        inv_distances = 0.0
+        for u_ix in range(strata):
+            for v_ix in range(strata):
+                ray = Ray(hit_record.position,
+                          sample_hemisphere(basis, (u_ix + random.random()) / strata,
+                                            (v_ix + random.random()) / strata))
+                hit = self.scene.intersect_ex(ray)
+                if hit is None:
+                    value += self.scene.environment_colour
+                    continue
+                inv_distances += 1.0 / max(hit['hit_record'].distance, 1e-9)
+                value += self._shade(ray, hit, depth, PATH_DIFFUSE)
+        value /= strata * strata
+        radius = strata * strata / inv_distances if inv_distances > 0.0 else float('inf')
+        cache.add(hit_record.position, hit_record.normal, value, radius)
+        return value
 
     #pylint: disable=too-many-arguments
-    #pylint: disable=too-many-locals
 
-    def generate_tiles(self, x_size, y_size, sample_count, samples_per_tile, width=-1, height=-1):
-        """Generates tiles for tiled rendering."""
+    def generate_tiles(self, x_size, y_size, sample_count, samples_per_tile, width=-1, height=-1,
+                       first_sample=0):
+        """Generates tiles for tiled rendering (of samples starting with given
+           index)."""
         if width < 0:
-            width = self.params.width
+            width = self.params['width']
         if height < 0:
-            height = self.params.height
-
-        x_centre = width / 2
-        y_centre = height / 2
+            height = self.params['height']
 
         tiles = []
         for y_pos in range(0, height, y_size):
-            y_beg = y_pos
-            y_end = min(y_pos + y_size, height)
+            y_range = (y_pos, min(y_pos + y_size, height))
             for x_pos in range(0, width, x_size):
-                x_beg = x_pos
-                x_end = min(x_pos + x_size, width)
-                x_mid = int(x_beg + x_end / 2)
-                y_mid = int(y_beg + y_end / 2)
-                dist_sqr = int(((x_mid - x_centre) ** 2) + ((y_mid - y_centre) ** 2))
-                for samples in range(0, sample_count, samples_per_tile):
+                x_range = (x_pos, min(x_pos + x_size, width))
+                for samples in range(first_sample, sample_count, samples_per_tile):
                     n_sampl = min(samples + samples_per_tile, sample_count) - samples
-                    tiles.append({ \
-                        'x_range': (x_beg, x_end),
-                        'y_range': (y_beg, y_end),
-                        'samples': n_sampl,
-                        'sample_ix': samples,
-                        'dist_prio': dist_sqr,
-                        'rand_prio': random.random()})
-        return sorted(tiles, key=lambda x: (x['sample_ix'], x['dist_prio'], x['rand_prio']))
+                    tiles.append(make_tile(x_range, y_range, n_sampl, samples, width, height))
+        return sorted(tiles, key=tile_priority)
 
-    #pylint: enable=too-many-locals
     #pylint: enable=too-many-arguments
+
+#pylint: enable=too-many-instance-attributes
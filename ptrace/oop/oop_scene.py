@@ -2,28 +2,72 @@
 
 import math
 
+import numpy as np
+
 from .vector import Vec3
-from .raycast_base import HitRecord
-from .oop_primitives import Primitive, Sphere, Triangle
+from .raycast_base import Ray, RayBatch, HitRecord, HitBatch
+from .oop_primitives import Primitive, Sphere, Triangle, triangle_hits, triangle_normals
 from .oop_material import material_from_data
+from .bvh import DEFAULT_LEAF_SIZE, build_bvh, occlude_rays, primitive_bounds
 
-class Scene(Primitive):
-    """Represents scene being rendered."""
+class PrimitiveGroup(Primitive):
+    """Represents group of primitives (optionally with bounding volume
+       hierarchy) intersected as a whole."""
 
     primitives = None
-    environment_colour = None
+    _bvh = None
+    _bvh_leaf_size = None
 
-    def __init__(self, environment_colour):
-        """Creates empty scene with given environment colour."""
-        self.environment_colour = environment_colour
-        self.primitives = []
+    def __init__(self, primitives=None):
+        """Creates group of given primitives (empty by default)."""
+        self.primitives = list(primitives) if primitives is not None else []
 
     def add(self, primitive):
         """Adds new geometry primitive to the scenr."""
         self.primitives.append(primitive)
+        self._bvh = None
+
+    def has_bvh(self):
+        """Checks whether bounding volume hierarchy of the scene is built."""
+        return self._bvh is not None
+
+    def build_bvh(self, leaf_size=DEFAULT_LEAF_SIZE, cache=None):
+        """Builds bounding volume hierarchy of scene primitives (or loads it
+           from given BVH cache) used to speed up intersection. Returns false
+           if some primitive is unbounded."""
+        bounds = primitive_bounds(self.primitives)
+        if bounds is None:
+            return False
+        self._bvh = cache.get(*bounds, leaf_size) if cache is not None \
+                    else build_bvh(*bounds, leaf_size)
+        self._bvh_leaf_size = leaf_size
+        return True
+
+    def refit_bvh(self, cache=None):
+        """Updates bounding volume hierarchy after primitives moved, without
+           rebuilding it. Refitted hierarchy is stored in given BVH cache."""
+        bounds = primitive_bounds(self.primitives)
+        self._bvh.refit(*bounds)
+        if cache is not None:
+            cache.put(*bounds, self._bvh_leaf_size, self._bvh)
+
+    def bounds(self):
+        """Returns lower and upper corners of bounding box of the group (or
+           None if it is unbounded)."""
+        bounds = primitive_bounds(self.primitives)
+        if bounds is None:
+            return None
+        return bounds[0].min(axis=0), bounds[1].max(axis=0)
+
+    def intersect(self, ray):
+        """Checks whether given ray intersects with the group."""
+        hit = self.intersect_ex(ray)
+        return hit['hit_record'] if hit else None
 
     def intersect_ex(self, ray):
         """Checks whether given ray intersects with scene geometry."""
+        if self._bvh is not None:
+            return self._bvh.intersect_ex(ray, self.primitives)
         result = {'hit_record': HitRecord(float('inf'), Vec3()), 'material': None}
         for primitive in self.primitives:
             hit = primitive.intersect_ex(ray)
@@ -33,6 +77,360 @@ class Scene(Primitive):
             return None
         return result
 
+    def occluded(self, ray, max_distance=float('inf')):
+        """Checks whether any primitive of the group blocks given ray before
+           given distance (e.g. for shadow rays), returning as soon as one is
+           found."""
+        if self._bvh is not None:
+            return self._bvh.occluded(ray, self.primitives, max_distance)
+        return any(primitive.occluded(ray, max_distance) for primitive in self.primitives)
+
+    def occluded_batch(self, rays, max_distances=np.inf):
+        """Checks which rays from given batch are blocked by any primitive of
+           the group before given distances (scalar or per ray array). Only
+           rays not blocked yet are tested against further primitives."""
+        if self._bvh is not None:
+            return self._bvh.occluded_batch(rays, self.primitives, max_distances)
+        occluded = np.zeros(len(rays), dtype='bool')
+        max_distances = np.broadcast_to(np.asarray(max_distances, dtype='double'), len(rays))
+        occlude_rays(self.primitives, rays, max_distances, occluded, np.arange(len(rays)))
+        return occluded
+
+    def intersect_batch_ex(self, rays):
+        """Checks which rays from given batch intersect with scene geometry and
+           returns arrays of distances to closest hits (infinite for misses) and
+           indices of primitives hit (-1 for misses)."""
+        if self._bvh is not None:
+            return self._bvh.intersect_batch_ex(rays, self.primitives)
+        distances = np.full(len(rays), np.inf, dtype=rays.dtype)
+        primitive_ids = np.full(len(rays), -1, dtype='int32')
+        for index, primitive in enumerate(self.primitives):
+            prim_dist = primitive.intersect_batch(rays)
+            closer = prim_dist < distances
+            distances[closer] = prim_dist[closer]
+            primitive_ids[closer] = index
+        return distances, primitive_ids
+
+    def intersect_batch(self, rays):
+        """Checks which rays from given batch intersect with the group and
+           returns array of distances to hits (infinite for rays that miss)."""
+        return self.intersect_batch_ex(rays)[0]
+
+    def normal_batch_ex(self, rays, distances, primitive_ids):
+        """Returns arrays of normals (facing against rays) and inside flags at
+           points where given rays hit primitives with given indices (-1 for
+           misses) at given distances."""
+        normals = np.zeros((len(rays), 3), dtype=rays.dtype)
+        is_inside = np.zeros(len(rays), dtype='bool')
+        for index in np.unique(primitive_ids[primitive_ids >= 0]):
+            mask = primitive_ids == index
+            normals[mask], is_inside[mask] = \
+                self.primitives[index].normal_batch(rays[mask], distances[mask])
+        return normals, is_inside
+
+    def normal_batch(self, rays, distances):
+        """Returns arrays of normals (facing against rays) and inside flags of
+           the group at points where given rays hit it at given distances."""
+        distances, primitive_ids = self.intersect_batch_ex(rays)
+        return self.normal_batch_ex(rays, distances, primitive_ids)
+
+
+class Scene(PrimitiveGroup):
+    """Represents scene being rendered."""
+
+    environment_colour = None
+
+    def __init__(self, environment_colour):
+        """Creates empty scene with given environment colour."""
+        super().__init__()
+        self.environment_colour = environment_colour
+
+    def hit_batch(self, rays):
+        """Intersects given batch of rays with scene geometry returning full
+           information on closest hits as hit batch."""
+        distances, primitive_ids = self.intersect_batch_ex(rays)
+        hit_mask = primitive_ids >= 0
+        positions = np.zeros((len(rays), 3), dtype=rays.dtype)
+        positions[hit_mask] = rays[hit_mask].points_at(distances[hit_mask])
+        normals, is_inside = self.normal_batch_ex(rays, distances, primitive_ids)
+        return HitBatch(distances, primitive_ids, positions, normals, is_inside)
+
+
+class MeshFace(Primitive):
+    """Represents face of array-backed mesh. Batches of rays are intersected
+       directly with vertices read from arrays of the mesh (single rays with
+       triangle created from them)."""
+
+    mesh = None
+    index = None
+
+    def __init__(self, mesh, index):
+        """Creates primitive of face of given mesh with given index."""
+        self.mesh = mesh
+        self.index = index
+        self.material = mesh.materials[mesh.face_materials[index]]
+
+    def _corners(self):
+        """Returns 3x3 array of vertices of the face."""
+        return np.asarray(self.mesh.vertices[self.mesh.faces[self.index]], dtype='double')
+
+    def bounds(self):
+        """Returns lower and upper corners of bounding box of the face."""
+        corners = self._corners()
+        return corners.min(axis=0), corners.max(axis=0)
+
+    def intersect(self, ray):
+        """Checks whether given ray intersects with the face."""
+        return self.mesh.triangle(self.index).intersect(ray)
+
+    def occluded(self, ray, max_distance=float('inf')):
+        """Checks whether the face blocks given ray before given distance."""
+        return self.mesh.triangle(self.index).occluded(ray, max_distance)
+
+    def intersect_batch(self, rays):
+        """Checks which rays from given batch intersect with the face and
+           returns array of distances to hits (infinite for rays that miss)."""
+        return triangle_hits(rays, self._corners())[0]
+
+    #pylint: disable=unused-argument
+
+    def normal_batch(self, rays, distances):
+        """Returns arrays of normals (facing against rays) and inside flags of
+           the face at points where given rays hit it at given distances."""
+        corners = self._corners()
+        normals = self.mesh.vertex_normals(self.index)
+        if normals is None:
+            normal = np.cross(corners[1] - corners[0], corners[2] - corners[0])
+            normals = np.tile(normal / np.linalg.norm(normal), (3, 1))
+        return triangle_normals(rays, corners, normals)
+
+    #pylint: enable=unused-argument
+
+
+class _MeshFaces():
+    """Read-only sequence of faces of array-backed mesh, created on access
+       (so that they are not kept in memory)."""
+
+    mesh = None
+
+    def __init__(self, mesh):
+        """Creates sequence of faces of given mesh."""
+        self.mesh = mesh
+
+    def __len__(self):
+        """Returns number of faces of the mesh."""
+        return len(self.mesh.faces)
+
+    def __getitem__(self, index):
+        """Returns face with given index."""
+        return MeshFace(self.mesh, index)
+
+    def __iter__(self):
+        """Iterates over all faces."""
+        return (MeshFace(self.mesh, index) for index in range(len(self.mesh.faces)))
+
+
+#pylint: disable=too-many-instance-attributes
+
+class Mesh(PrimitiveGroup):
+    """Represents triangle mesh geometry (given in its object space) shared
+       by instances, with its own bounding volume hierarchy.
+
+       Mesh is backed by vertex, normal and face arrays (which may be views of
+       memory-mapped mesh file, as they are never copied), with material
+       indices of faces into list of materials. Faces visited during
+       intersection are read from the arrays on the fly (see MeshFace)."""
+
+    vertices = None
+    normals = None
+    faces = None
+    face_materials = None
+    materials = None
+    _bounds = None
+
+    #pylint: disable=super-init-not-called
+    #pylint: disable=too-many-arguments
+
+    def __init__(self, vertices, normals, faces, face_materials, materials):
+        """Creates mesh of given vertices, per vertex normals (array of the
+           same shape, NaNs or None for face normals), faces (vertex index
+           triples), their material indices and list of materials."""
+        self.vertices = vertices
+        self.normals = normals if normals is not None and len(normals) == len(vertices) \
+                       else None
+        self.faces = faces
+        self.face_materials = face_materials
+        self.materials = materials
+        self.primitives = _MeshFaces(self)
+
+    #pylint: enable=too-many-arguments
+    #pylint: enable=super-init-not-called
+
+    @staticmethod
+    def from_arrays(vertices, normals, faces, material):
+        """Creates mesh of triangles with given vertices, per vertex normals
+           (or None), faces (vertex index triples) and material."""
+        mesh = Mesh(vertices, normals, faces, np.zeros(len(faces), dtype='int32'), [material])
+        mesh.build_bvh()
+        return mesh
+
+    def add(self, primitive):
+        """Meshes are immutable (their faces are given by arrays)."""
+        raise TypeError("Cannot add primitives to array-backed mesh")
+
+    def vertex_normals(self, index):
+        """Returns 3x3 array of vertex normals of face with given index (or
+           None if it uses its face normal)."""
+        if self.normals is None:
+            return None
+        normals = np.asarray(self.normals[self.faces[index]], dtype='double')
+        return normals if np.all(np.isfinite(normals)) else None
+
+    def triangle(self, index):
+        """Creates triangle of face with given index."""
+        corners = np.array(self.vertices[self.faces[index]], dtype='double')
+        normals = self.vertex_normals(index)
+        return Triangle([Vec3(arr=corner) for corner in corners],
+                        self.materials[self.face_materials[index]],
+                        [Vec3(arr=np.array(normal)) for normal in normals]
+                        if normals is not None else None)
+
+    def used_materials(self):
+        """Returns list of distinct materials of faces of the mesh."""
+        return [self.materials[index] for index in np.unique(self.face_materials).tolist()]
+
+    def face_bounds(self):
+        """Returns arrays of lower and upper corners of bounding boxes of
+           faces of the mesh (or None if it has no faces)."""
+        if len(self.faces) == 0:
+            return None
+        corners = np.asarray(self.vertices, dtype='double')[self.faces]
+        return corners.min(axis=1), corners.max(axis=1)
+
+    def build_bvh(self, leaf_size=DEFAULT_LEAF_SIZE, cache=None):
+        """Builds bounding volume hierarchy of faces of the mesh (computing
+           their bounds directly from arrays), as in PrimitiveGroup."""
+        bounds = self.face_bounds()
+        if bounds is None:
+            return False
+        self._bvh = cache.get(*bounds, leaf_size) if cache is not None \
+                    else build_bvh(*bounds, leaf_size)
+        self._bvh_leaf_size = leaf_size
+        return True
+
+    def bounds(self):
+        """Returns lower and upper corners of bounding box of the mesh (or
+           None if it has no faces)."""
+        if self._bounds is None and len(self.faces) > 0:
+            bounds = self.face_bounds()
+            self._bounds = (bounds[0].min(axis=0), bounds[1].max(axis=0))
+        return self._bounds
+
+#pylint: enable=too-many-instance-attributes
+
+
+class Instance(Primitive):
+    """Represents placement of shared mesh in the scene given by affine
+       transform (3x4 matrix mapping object space points to world space).
+       Rays are intersected with the mesh transformed into its object
+       space, so memory use does not grow with mesh size."""
+
+    mesh = None
+    transform = None
+    overrides_material = False
+    _inverse = None
+    _normal_matrix = None
+
+    def __init__(self, mesh, transform, material=None):
+        """Creates instance of given mesh with given transform and material
+           (overriding materials of mesh primitives if given). Otherwise
+           material of the instance is the one shared by all primitives of
+           the mesh, or None if they differ (it is then resolved per hit by
+           intersect_ex)."""
+        self.mesh = mesh
+        self.transform = np.array(transform, dtype='double').reshape(3, 4)
+        inverse = np.linalg.inv(self.transform[:, :3])
+        self._inverse = np.hstack([inverse, -inverse @ self.transform[:, 3:]])
+        self._normal_matrix = inverse.T
+        materials = mesh.used_materials()
+        self.material = material if material is not None else \
+                        (materials[0] if len(materials) == 1 else None)
+        self.overrides_material = material is not None
+
+    def bounds(self):
+        """Returns lower and upper corners of bounding box of transformed
+           mesh bounds."""
+        bounds = self.mesh.bounds()
+        if bounds is None:
+            return None
+        corners = np.array([[bounds[i][0], bounds[j][1], bounds[k][2]]
+                            for i in (0, 1) for j in (0, 1) for k in (0, 1)])
+        corners = corners @ self.transform[:, :3].T + self.transform[:, 3]
+        return corners.min(axis=0), corners.max(axis=0)
+
+    def intersect(self, ray):
+        """Checks whether given ray intersects with the instance."""
+        hit = self.intersect_ex(ray)
+        return hit['hit_record'] if hit else None
+
+    def intersect_ex(self, ray):
+        """Checks whether given ray intersects with the instance (returns
+           extra information on material of mesh primitive hit)."""
+        direction = self._inverse[:, :3] @ ray.direction.data()
+        scale = np.linalg.norm(direction)
+        hit = self.mesh.intersect_ex(Ray(Vec3(arr=self._inverse[:, :3] @ ray.origin.data() +
+                                                  self._inverse[:, 3]),
+                                         Vec3(arr=direction / scale)))
+        if not hit:
+            return None
+        record = hit['hit_record']
+        distance = record.distance / scale
+        normal = self._normal_matrix @ record.normal.data()
+        return {'hit_record': HitRecord(distance, ray.point_at(distance), record.is_inside,
+                                        Vec3(arr=normal / np.linalg.norm(normal))),
+                'material': self.material if self.overrides_material else hit['material']}
+
+    def occluded(self, ray, max_distance=float('inf')):
+        """Checks whether the instance blocks given ray before given
+           distance."""
+        direction = self._inverse[:, :3] @ ray.direction.data()
+        scale = np.linalg.norm(direction)
+        return self.mesh.occluded(Ray(Vec3(arr=self._inverse[:, :3] @ ray.origin.data() +
+                                           self._inverse[:, 3]),
+                                      Vec3(arr=direction / scale)), max_distance * scale)
+
+    def occluded_batch(self, rays, max_distances=np.inf):
+        """Checks which rays from given batch are blocked by the instance
+           before given distances (scalar or per ray array)."""
+        object_rays, scales = self._object_rays(rays)
+        return self.mesh.occluded_batch(object_rays, max_distances * scales)
+
+    def _object_rays(self, rays):
+        """Returns given batch of rays transformed into object space and
+           scales of their directions (i.e. ratios of object to world space
+           distances)."""
+        directions = rays.directions @ self._inverse[:, :3].T
+        scales = np.sqrt(np.einsum('ij,ij->i', directions, directions))
+        origins = rays.origins @ self._inverse[:, :3].T + self._inverse[:, 3]
+        return RayBatch(origins.astype(rays.dtype),
+                        (directions / scales[:, np.newaxis]).astype(rays.dtype)), scales
+
+    def intersect_batch(self, rays):
+        """Checks which rays from given batch intersect with the instance and
+           returns array of distances to hits (infinite for rays that miss)."""
+        object_rays, scales = self._object_rays(rays)
+        return (self.mesh.intersect_batch(object_rays) / scales).astype(rays.dtype)
+
+    def normal_batch(self, rays, distances):
+        """Returns arrays of normals (facing against rays) and inside flags of
+           the instance at points where given rays hit it at given distances."""
+        object_rays, _ = self._object_rays(rays)
+        normals, is_inside = self.mesh.normal_batch(object_rays, None)
+        normals = normals @ self._normal_matrix.T
+        lengths = np.sqrt(np.einsum('ij,ij->i', normals, normals))
+        normals /= np.where(lengths > 0.0, lengths, 1.0)[:, np.newaxis]
+        return normals.astype(rays.dtype), is_inside
+
 
 class SceneBuilder():
     """Constructs scene from given geometry primitives."""
@@ -52,3 +450,9 @@ class SceneBuilder():
         """Adds triangle with given vertices and material to the scene.
         """
         self.scene.add(Triangle(vertices, material_from_data(material_data), normals))
+
+    def add_instance(self, mesh, transform, material_data=None):
+        """Adds instance of given mesh with given affine transform (and
+           material overriding the mesh ones, if given) to the scene."""
+        self.scene.add(Instance(mesh, transform, material_from_data(material_data)
+                                if material_data is not None else None))
@@ -1,13 +1,24 @@
 """Unit tests for oop classes."""
 
+import json
+import os
+import tempfile
 import unittest
+import numpy as np
 
 from .vector import Vec3
 from .scene_settings import MaterialData
-from .raycast_base import Ray
+from .raycast_base import Ray, RayBatch, HitBatch
 
 from .oop_material import MatteMaterial, ShinyMaterial, material_from_data
-from .oop_primitives import Sphere, Triangle
+from .oop_primitives import Sphere, Triangle, spawn_offset
+from .oop_scene import SceneBuilder
+from .scene_file import SceneArrays, SceneDescription, load_obj_mesh, load_scene_file, \
+    convert_scene_file, load_mesh, load_mesh_file, is_scene_file, MESH_FILE_EXT
+from .scene_generators import sphere_grid, sphere_field, tessellated_sphere, \
+    instanced_spheres
+from .bvh import BvhCache, primitive_bounds
+from .ray_order import PIXEL_ORDERS, pixel_order, morton_codes, hilbert_codes, coherent_order
 
 
 class MaterialTests(unittest.TestCase):
@@ -97,3 +108,464 @@ class TriangleTests(unittest.TestCase):
         self.assertAlmostEqual(hit.distance, 3)
         self.assertEqual(hit.position, Vec3(0, 0, 3))
         self.assertEqual(hit.normal, Vec3(0, 0, -1))
+
+
+def _random_rays(count, origin, dtype='double', seed=0):
+    """Creates batch of rays from given origin in random directions towards
+       positive z half-space."""
+    rng = np.random.default_rng(seed)
+    directions = rng.normal(size=(count, 3))
+    directions[:, 2] = np.abs(directions[:, 2]) * 4.0
+    directions /= np.linalg.norm(directions, axis=1)[:, np.newaxis]
+    origins = np.tile(np.array(origin, dtype='double'), (count, 1))
+    return RayBatch(origins, directions).astype(dtype)
+
+
+class BatchIntersectionTests(unittest.TestCase):
+    """Tests for vectorized intersection of ray batches."""
+
+    def test_batch_matches_scalar(self):
+        """Batched intersection gives the same results as scalar one."""
+        primitives = [Sphere(Vec3(0.5, 0, 0), 0.4), Sphere(Vec3(), 10),
+                      Triangle([Vec3(-1, -1, 1), Vec3(1, -1, 1), Vec3(0, 1, 1)]),
+                      Triangle([Vec3(-1, -1, 2), Vec3(0, 1, 2), Vec3(1, -1, 2)])]
+        rays = _random_rays(200, (0, 0, -3.2))
+        for prim in primitives:
+            distances = prim.intersect_batch(rays)
+            hit_ix = np.flatnonzero(np.isfinite(distances))
+            normals, is_inside = prim.normal_batch(rays[hit_ix], distances[hit_ix])
+            self.assertGreater(len(hit_ix), 0)
+            for index, ray in enumerate(rays):
+                hit = prim.intersect(ray)
+                self.assertEqual(hit is None, np.isinf(distances[index]))
+            for num, index in enumerate(hit_ix):
+                hit = prim.intersect(rays[int(index)])
+                self.assertAlmostEqual(hit.distance, distances[index])
+                self.assertEqual(hit.normal, Vec3.from_array(normals[num]))
+                self.assertEqual(hit.is_inside, is_inside[num])
+
+    def test_scene_hit_batch(self):
+        """Batched scene intersection finds closest primitives."""
+        scb = SceneBuilder(Vec3())
+        scb.add_sphere(Vec3(0, 0, 5), 1, MaterialData.make_diffuse(Vec3(1, 0, 0)))
+        scb.add_sphere(Vec3(0, 0, 10), 3, MaterialData.make_diffuse(Vec3(0, 1, 0)))
+        rays = RayBatch(np.zeros((3, 3)), np.array([[0, 0, 1.0], [0, 0.28, 0.96], [0, 1.0, 0]]))
+        hits = scb.scene.hit_batch(rays)
+        self.assertEqual(list(hits.primitive_ids), [0, 1, -1])
+        self.assertAlmostEqual(hits.distances[0], 4)
+        self.assertEqual(hits[0].normal, Vec3(0, 0, -1))
+        self.assertTrue(hits[2] is None)
+
+    def test_single_precision_self_intersection(self):
+        """Secondary rays spawned in single precision do not self-intersect
+           more often than in double precision."""
+        for sph in [Sphere(Vec3(0.5, 0, 0), 0.4), Sphere(Vec3(), 10)]:
+            counts = []
+            for dtype in ['double', 'single']:
+                rays = _random_rays(20000, (0, 0, -3.2), dtype)
+                distances = sph.intersect_batch(rays)
+                rays = rays[np.isfinite(distances)]
+                distances = distances[np.isfinite(distances)]
+                hits = sph.normal_batch(rays, distances)[0]
+                directions = np.random.default_rng(1).normal(size=hits.shape).astype(dtype)
+                directions /= np.linalg.norm(directions, axis=1)[:, np.newaxis]
+                directions *= np.sign(np.einsum('ij,ij->i', directions, hits))[:, np.newaxis]
+
+                hit_batch = HitBatch(distances, np.zeros(len(rays), dtype='int32'),
+                                     rays.points_at(distances), hits,
+                                     np.zeros(len(rays), dtype='bool'))
+                secondary = hit_batch.spawn_rays(directions, spawn_offset(dtype))
+                counts.append(np.sum(sph.intersect_batch(secondary) < 0.001))
+            self.assertLessEqual(counts[1], counts[0])
+
+
+_SCENE_DESC = { \
+    'camera': {'eye': [0, 0, -3], 'look_at': [0, 0, 0], 'up': [0, 1, 0], 'vertical_fov': 40},
+    'environment': [0.1, 0.1, 0.1],
+    'materials': {'red': {'diffuse': [0.5, 0.1, 0.1]},
+                  'mirror': {'diffuse': [0.9, 0.9, 0.9], 'reflectivity': 0.8}},
+    'spheres': [{'centre': [0, 0, 0], 'radius': 1, 'material': 'red'},
+                {'centre': [2, 2, 2], 'radius': 0.5, 'material': {'emission': [4, 4, 4]}}],
+    'triangles': [{'vertices': [[0, 0, 2], [1, 0, 2], [0, 1, 2]], 'material': 'mirror'}],
+    'meshes': [{'path': 'quad.obj', 'material': 'red', 'translate': [0, 0, 5], 'scale': 2}]}
+
+_QUAD_OBJ = """v 0 0 0
+v 1 0 0
+v 1 1 0
+v 0 1 0
+vn 0 0 -1
+f 1//1 2//1 3//1 4//1
+"""
+
+
+class SceneFileTests(unittest.TestCase):
+    """Tests for loading scenes from json and binary scene files."""
+
+    def _write_scene(self, path):
+        """Writes test scene file (with referenced mesh) into given directory."""
+        with open(os.path.join(path, 'quad.obj'), 'w', encoding='utf-8') as objfile:
+            objfile.write(_QUAD_OBJ)
+        scene_path = os.path.join(path, 'scene.json')
+        with open(scene_path, 'w', encoding='utf-8') as jsonfile:
+            json.dump(_SCENE_DESC, jsonfile)
+        return scene_path
+
+    def test_obj_mesh(self):
+        """Polygons of obj meshes are split into triangles."""
+        with tempfile.TemporaryDirectory() as path:
+            self._write_scene(path)
+            vertices, normals, faces = load_obj_mesh(os.path.join(path, 'quad.obj'))
+        self.assertEqual(vertices.shape, (4, 3))
+        self.assertEqual(normals.shape, (4, 3))
+        self.assertEqual(faces.shape, (2, 3))
+        self.assertTrue(np.allclose(vertices[faces[1]], [[0, 0, 0], [1, 1, 0], [0, 1, 0]]))
+
+    def test_mesh_file(self):
+        """Binary mesh files hold obj meshes, are loaded memory-mapped and
+           cache obj meshes of scene files."""
+        with tempfile.TemporaryDirectory() as path:
+            self._write_scene(path)
+            obj_path = os.path.join(path, 'quad.obj')
+            mesh_path = os.path.join(path, 'quad' + MESH_FILE_EXT)
+            convert_scene_file(obj_path, mesh_path)
+            loaded = load_mesh_file(mesh_path)
+            for array, expected in zip(loaded, load_obj_mesh(obj_path)):
+                self.assertTrue(isinstance(array.base, np.memmap))
+                self.assertFalse(array.flags.writeable)
+                self.assertTrue(np.array_equal(array, expected))
+            del loaded
+
+            self.assertFalse(os.path.isfile(obj_path + MESH_FILE_EXT))
+            load_scene_file(os.path.join(path, 'scene.json'))
+            self.assertTrue(os.path.isfile(obj_path + MESH_FILE_EXT))
+            self.assertTrue(isinstance(load_mesh(obj_path)[0].base, np.memmap))
+
+            with open(mesh_path, 'r+b') as meshfile:
+                meshfile.truncate(os.path.getsize(mesh_path) - 12)
+            with self.assertRaises((AssertionError, ValueError)):
+                load_mesh_file(mesh_path)
+
+    def test_json_scene(self):
+        """Json scene file is loaded into scene primitives."""
+        with tempfile.TemporaryDirectory() as path:
+            renderer = load_scene_file(self._write_scene(path), {'width': 16, 'height': 8})
+        prims = renderer.scene.primitives
+        self.assertEqual(len(prims), 5)
+        self.assertTrue(isinstance(prims[0], Sphere) and isinstance(prims[2], Triangle))
+        self.assertTrue(prims[0].material is prims[3].material)
+        self.assertTrue(isinstance(prims[2].material, ShinyMaterial))
+        self.assertEqual(prims[1].material.material_data.emission, Vec3(4, 4, 4))
+        self.assertTrue(prims[2].normals[0].isclose(Vec3(0, 0, 1)))
+        self.assertTrue(prims[4].vertices[1].isclose(Vec3(2, 2, 5)))
+        self.assertTrue(prims[4].normals[0].isclose(Vec3(0, 0, -1)))
+        self.assertEqual(renderer.camera.aspect_ratio, 2.0)
+
+    def test_binary_scene(self):
+        """Binary scene file holds the same scene as json one."""
+        with tempfile.TemporaryDirectory() as path:
+            binary_path = os.path.join(path, 'scene.npz')
+            convert_scene_file(self._write_scene(path), binary_path)
+            expected = SceneDescription.load(os.path.join(path, 'scene.json')).create_scene()
+            scene = load_scene_file(binary_path).scene
+        self.assertEqual(len(scene.primitives), len(expected.primitives))
+        for prim, other in zip(scene.primitives, expected.primitives):
+            self.assertEqual(type(prim), type(other))
+            self.assertTrue(prim.material.material_data == other.material.material_data)
+            if isinstance(prim, Triangle):
+                for vec, other_vec in zip(prim.vertices + prim.normals,
+                                          other.vertices + other.normals):
+                    self.assertTrue(vec.isclose(other_vec))
+            else:
+                self.assertTrue(prim.centre.isclose(other.centre))
+                self.assertEqual(prim.radius, other.radius)
+
+    def test_binary_scene_name(self):
+        """Binary scene file is saved under given name (without npz suffix)
+           and loaded from it."""
+        with tempfile.TemporaryDirectory() as path:
+            binary_path = os.path.join(path, 'scene.bin')
+            convert_scene_file(self._write_scene(path), binary_path)
+            self.assertEqual(sorted(os.listdir(path)),
+                             sorted(['scene.bin', 'scene.json', 'quad.obj',
+                                     'quad.obj' + MESH_FILE_EXT]))
+            self.assertTrue(is_scene_file(binary_path))
+            self.assertFalse(is_scene_file(os.path.join(path, 'quad.obj')))
+            scene = load_scene_file(binary_path).scene
+        self.assertEqual(len(scene.primitives), 5)
+
+
+class SceneGeneratorTests(unittest.TestCase):
+    """Tests for procedural scene generators."""
+
+    def test_sphere_grid(self):
+        """Sphere grid has size x size spheres (besides the light)."""
+        scene = sphere_grid(5).create_scene()
+        self.assertEqual(len(scene.primitives), 26)
+        self.assertTrue(scene.primitives[13].centre.isclose(Vec3(0, 0, 0)))
+
+    def test_sphere_field(self):
+        """Random sphere fields are reproducible from their seeds and made of
+           matte and shiny materials."""
+        arrays = sphere_field(200, 7).arrays
+        self.assertEqual(len(arrays.sphere_radii), 202)
+        self.assertTrue(np.array_equal(arrays.sphere_centres,
+                                       sphere_field(200, 7).arrays.sphere_centres))
+        self.assertFalse(np.array_equal(arrays.sphere_centres,
+                                        sphere_field(200, 8).arrays.sphere_centres))
+        materials = {type(prim.material) for prim in sphere_field(200, 7).create_scene().primitives}
+        self.assertEqual(materials, {MatteMaterial, ShinyMaterial})
+
+    def test_tessellated_sphere(self):
+        """Tessellated sphere has about given number of triangles lying on
+           unit sphere."""
+        arrays = tessellated_sphere(2000).arrays
+        self.assertTrue(1900 <= len(arrays.faces) <= 2100)
+        self.assertTrue(np.allclose(np.linalg.norm(arrays.vertices, axis=1), 1.0))
+        corners = arrays.vertices[arrays.faces]
+        areas = np.linalg.norm(np.cross(corners[:, 1] - corners[:, 0],
+                                        corners[:, 2] - corners[:, 0]), axis=1)
+        self.assertTrue(np.all(areas > 0.0))
+        # faces are wound outwards
+        normals = np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0])
+        self.assertTrue(np.all(np.sum(normals * corners.mean(axis=1), axis=1) > 0.0))
+
+
+class BvhTests(unittest.TestCase):
+    """Tests for bounding volume hierarchy of scenes."""
+
+    def _rays(self, count=300):
+        """Returns batch of random rays starting around the origin."""
+        rng = np.random.default_rng(1)
+        directions = rng.normal(size=(count, 3))
+        directions /= np.linalg.norm(directions, axis=1)[:, np.newaxis]
+        return RayBatch(rng.uniform(-1, 1, (count, 3)), directions)
+
+    def _assert_same_hits(self, scene, expected, rays):
+        """Asserts that scene intersects rays as scene without hierarchy."""
+        distances, primitive_ids = scene.intersect_batch_ex(rays)
+        exp_distances, exp_primitive_ids = expected.intersect_batch_ex(rays)
+        self.assertTrue(np.array_equal(primitive_ids, exp_primitive_ids))
+        self.assertTrue(np.allclose(distances, exp_distances))
+        for index in range(0, len(rays), 10):
+            hit = scene.intersect_ex(rays[index])
+            exp_hit = expected.intersect_ex(rays[index])
+            self.assertEqual(hit is None, exp_hit is None)
+            if hit is not None:
+                self.assertAlmostEqual(hit['hit_record'].distance,
+                                       exp_hit['hit_record'].distance)
+
+    def test_intersection(self):
+        """Scene with hierarchy is intersected as without it."""
+        rays = self._rays()
+        for desc in (sphere_field(100, 2), tessellated_sphere(200)):
+            scene = desc.create_scene()
+            self.assertTrue(scene.build_bvh(leaf_size=2))
+            self._assert_same_hits(scene, desc.create_scene(), rays)
+
+    def test_refit(self):
+        """Refitted hierarchy handles moved spheres."""
+        desc = sphere_field(100, 3)
+        scene = desc.create_scene()
+        scene.build_bvh()
+        expected = desc.create_scene()
+        for index in range(2, 100, 9):
+            for moved in (scene, expected):
+                moved.primitives[index].centre = moved.primitives[index].centre + Vec3(0, 0.5, 0.3)
+        scene.refit_bvh()
+        self._assert_same_hits(scene, expected, self._rays())
+
+    #pylint: disable=protected-access
+
+    def test_cache(self):
+        """Hierarchies are cached under hashes of primitive bounds and loaded
+           memory-mapped."""
+        desc = sphere_field(50, 4)
+        with tempfile.TemporaryDirectory() as path:
+            cache = BvhCache(path)
+            scene = desc.create_scene()
+            scene.build_bvh(cache=cache)
+            self.assertEqual(len(os.listdir(path)), 2)
+            loaded = desc.create_scene()
+            loaded.build_bvh(cache=cache)
+            self.assertEqual(len(os.listdir(path)), 2)
+            self.assertTrue(isinstance(loaded._bvh.nodes, np.memmap))
+            self.assertTrue(np.array_equal(loaded._bvh.nodes, scene._bvh.nodes))
+
+            loaded.primitives[3].radius = 0.5
+            loaded.refit_bvh(cache)
+            self.assertEqual(len(os.listdir(path)), 4)
+            refitted = desc.create_scene()
+            refitted.primitives[3].radius = 0.5
+            refitted.build_bvh(cache=cache)
+            self.assertTrue(isinstance(refitted._bvh.nodes, np.memmap))
+            self.assertEqual(primitive_bounds(refitted.primitives)[1][3].tolist(),
+                             (refitted.primitives[3].centre.data() + 0.5).tolist())
+            expected = desc.create_scene()
+            expected.primitives[3].radius = 0.5
+            self._assert_same_hits(refitted, expected, self._rays())
+
+    #pylint: enable=protected-access
+
+
+class InstanceTests(unittest.TestCase):
+    """Tests for mesh instancing."""
+
+    def _baked(self, desc):
+        """Returns scene with instances of given description replaced by
+           transformed copies of their triangles."""
+        arrays = desc.arrays
+        baked = SceneArrays()
+        baked.add_spheres(arrays.sphere_centres, arrays.sphere_radii, arrays.sphere_materials)
+        for mesh_ix, transform, material in zip(arrays.instance_meshes,
+                                                arrays.instance_transforms,
+                                                arrays.instance_materials):
+            faces = arrays.mesh_faces[mesh_ix]
+            normals = arrays.mesh_normals[mesh_ix] @ np.linalg.inv(transform[:, :3])
+            normals /= np.linalg.norm(normals, axis=1)[:, np.newaxis]
+            baked.add_mesh(arrays.mesh_vertices[mesh_ix] @ transform[:, :3].T + transform[:, 3],
+                           normals, faces, np.full(len(faces), material) if material >= 0
+                           else arrays.mesh_face_materials[mesh_ix])
+        return SceneDescription(desc.header, baked).create_scene()
+
+    def test_intersection(self):
+        """Instances are intersected as transformed copies of their meshes."""
+        desc = instanced_spheres(12, 5, triangle_count=100)
+        scene = desc.create_scene()
+        expected = self._baked(desc)
+        self.assertEqual(len(scene.primitives), 14)
+
+        # rays aimed around the instances
+        rng = np.random.default_rng(2)
+        origins = rng.uniform(-2, 2, (400, 3)) + [0.0, 1.0, 0.0]
+        targets = desc.arrays.instance_transforms[rng.integers(12, size=400), :, 3]
+        directions = targets + rng.normal(scale=0.3, size=(400, 3)) - origins
+        directions /= np.linalg.norm(directions, axis=1)[:, np.newaxis]
+        rays = RayBatch(origins, directions)
+        hits = scene.hit_batch(rays)
+        exp_hits = expected.hit_batch(rays)
+        self.assertTrue(np.array_equal(hits.primitive_ids < 0, exp_hits.primitive_ids < 0))
+        self.assertTrue(np.allclose(hits.distances, exp_hits.distances))
+        self.assertTrue(np.allclose(hits.normals, exp_hits.normals, atol=1e-6))
+        self.assertTrue(np.array_equal(hits.is_inside, exp_hits.is_inside))
+        self.assertGreater(np.count_nonzero(hits.primitive_ids >= 2), 100)
+        for index in range(0, len(rays), 7):
+            hit = scene.intersect_ex(rays[index])
+            exp_hit = expected.intersect_ex(rays[index])
+            self.assertEqual(hit is None, exp_hit is None)
+            if hit is not None:
+                self.assertAlmostEqual(hit['hit_record'].distance,
+                                       exp_hit['hit_record'].distance)
+                self.assertTrue(hit['hit_record'].normal.isclose(exp_hit['hit_record'].normal))
+                self.assertIs(type(hit['material']), type(exp_hit['material']))
+
+    def test_shared_mesh(self):
+        """Instances share single mesh, whose materials can be overridden."""
+        scene = instanced_spheres(9, 1).create_scene()
+        instances = scene.primitives[2:]
+        self.assertEqual(len({id(instance.mesh) for instance in instances}), 1)
+        self.assertEqual([type(instance.material) for instance in instances],
+                         [MatteMaterial, MatteMaterial, ShinyMaterial] * 3)
+        self.assertTrue(scene.has_bvh() or len(scene.primitives) < 16)
+        self.assertTrue(instances[0].mesh.has_bvh())
+
+    def test_scene_files(self):
+        """Instances are loaded from json scene files and kept by binary ones."""
+        with tempfile.TemporaryDirectory() as path:
+            with open(os.path.join(path, 'tri.obj'), 'w', encoding='utf-8') as objfile:
+                objfile.write("v 0 0 0\nv 1 0 0\nv 0 1 0\nf 1 2 3\n")
+            desc = { \
+                'camera': {'eye': [0, 0, -5], 'look_at': [0, 0, 0], 'up': [0, 1, 0],
+                           'vertical_fov': 40},
+                'materials': {'red': {'diffuse': [1, 0, 0]},
+                              'mirror': {'diffuse': [1, 1, 1], 'reflectivity': 1.0}},
+                'instances': [ \
+                    {'path': 'tri.obj', 'material': 'red',
+                     'transform': [[1, 0, 0, 0], [0, 1, 0, 0], [0, 0, 1, 0]]},
+                    {'path': 'tri.obj', 'material': 'mirror',
+                     'transform': [[2, 0, 0, 1], [0, 2, 0, 0], [0, 0, 2, 3]]}]}
+            json_path = os.path.join(path, 'scene.json')
+            with open(json_path, 'w', encoding='utf-8') as jsonfile:
+                json.dump(desc, jsonfile)
+            binary_path = os.path.join(path, 'scene.npz')
+            convert_scene_file(json_path, binary_path)
+
+            for scene_path in (json_path, binary_path):
+                scene = SceneDescription.load(scene_path).create_scene()
+                self.assertEqual(len(scene.primitives), 2)
+                self.assertIs(scene.primitives[0].mesh, scene.primitives[1].mesh)
+                self.assertEqual([type(prim.material) for prim in scene.primitives],
+                                 [MatteMaterial, ShinyMaterial])
+                hit = scene.intersect_ex(Ray(Vec3(1.5, 0.5, 0), Vec3(0, 0, 1)))
+                self.assertAlmostEqual(hit['hit_record'].distance, 3.0)
+
+            # meshes of json scenes are intersected from their mapped mesh files
+            mesh = SceneDescription.load(json_path).create_scene().primitives[0].mesh
+            self.assertIsInstance(mesh.vertices, np.memmap)
+            self.assertIsInstance(mesh.faces, np.memmap)
+            del mesh, scene
+
+
+class OcclusionTests(unittest.TestCase):
+    """Tests for any-hit occlusion queries."""
+
+    def test_occlusion(self):
+        """Rays are occluded if and only if they hit something before given
+           distance, with and without hierarchy."""
+        rng = np.random.default_rng(3)
+        directions = rng.normal(size=(300, 3))
+        directions /= np.linalg.norm(directions, axis=1)[:, np.newaxis]
+        rays = RayBatch(rng.uniform(-1, 1, (300, 3)), directions)
+        max_distances = rng.uniform(0.0, 4.0, 300)
+
+        for desc in (sphere_field(60, 2), tessellated_sphere(100),
+                     instanced_spheres(10, 3, triangle_count=50)):
+            for with_bvh in (False, True):
+                scene = desc.create_scene()
+                if with_bvh:
+                    scene.build_bvh(leaf_size=2)
+                distances = scene.intersect_batch(rays)
+                expected = distances < max_distances
+                self.assertTrue(0 < np.count_nonzero(expected) < len(rays))
+                self.assertTrue(np.array_equal(scene.occluded_batch(rays, max_distances),
+                                               expected))
+                self.assertTrue(np.array_equal(scene.occluded_batch(rays), np.isfinite(distances)))
+                for index in range(0, len(rays), 5):
+                    self.assertEqual(scene.occluded(rays[index], max_distances[index]),
+                                     expected[index])
+
+
+class RayOrderTests(unittest.TestCase):
+    """Tests for coherent orderings of pixels and rays."""
+
+    def test_curves(self):
+        """Curve codes enumerate squares, with Hilbert curve stepping between
+           neighbouring cells."""
+        px_x, px_y = np.divmod(np.arange(256), 16)
+        self.assertEqual(morton_codes([0, 1, 0, 1, 2, 5], [0, 0, 1, 1, 0, 3]).tolist(),
+                         [0, 1, 2, 3, 4, 27])
+        for codes in (morton_codes(px_x, px_y), hilbert_codes(px_x, px_y, 4)):
+            self.assertEqual(sorted(codes.tolist()), list(range(256)))
+        path = np.argsort(hilbert_codes(px_x, px_y, 4))
+        steps = np.abs(np.diff(px_x[path])) + np.abs(np.diff(px_y[path]))
+        self.assertTrue(np.all(steps == 1))
+
+    def test_pixel_order(self):
+        """All orders visit every pixel once."""
+        for order in PIXEL_ORDERS:
+            pixels = pixel_order(12, 7, order)
+            self.assertEqual(sorted(pixels), [(x, y) for x in range(12) for y in range(7)])
+        self.assertEqual(pixel_order(3, 2, 'scanline'), [(0, 0), (0, 1), (1, 0), (1, 1),
+                                                          (2, 0), (2, 1)])
+
+    def test_coherent_order(self):
+        """Rays are grouped by direction octants and neighbouring origins."""
+        rng = np.random.default_rng(2)
+        directions = rng.normal(size=(1000, 3))
+        origins = rng.uniform(-5, 5, (1000, 3))
+        permutation = coherent_order(origins, directions)
+        self.assertEqual(sorted(permutation.tolist()), list(range(1000)))
+        octants = np.packbits(directions[permutation] < 0, axis=1, bitorder='little')[:, 0]
+        self.assertTrue(np.all(np.diff(octants.astype('int')) >= 0))
+        steps = np.linalg.norm(np.diff(origins[permutation], axis=0), axis=1)
+        self.assertLess(steps.mean(), 0.5 * np.linalg.norm(np.diff(origins, axis=0),
+                                                           axis=1).mean())
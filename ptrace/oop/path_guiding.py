@@ -0,0 +1,174 @@
+"""Online path guiding: distributions of incoming radiance learned from
+   completed sampling passes, used to importance sample directions of
+   diffuse reflections (after practical path guiding of Mueller, Gross and
+   Novak, with histograms in place of quadtrees).
+
+   Space of the scene is subdivided by binary tree, splitting cells in the
+   middle along cycling axes, whose leaves hold histograms of incoming
+   radiance over directions. Directions are mapped to unit square by
+   equal-area cylindrical mapping (cosine of polar angle around z axis and
+   azimuth), so all bins cover equal solid angles. Every diffuse reflection
+   records its incoming radiance (luminance) divided by density of its
+   direction into training histogram of its cell, estimating integral of
+   radiance over the bin. After each pass sampling distributions are rebuilt
+   from training histograms accumulated so far, and cells with many records
+   are split (with children inheriting their histograms)."""
+
+import math
+
+import numpy as np
+
+from .vector import Vec3
+
+
+DEFAULT_RESOLUTION = 16
+DEFAULT_SPLIT_RECORDS = 4000
+
+# maximal depth of cells of spatial tree
+_MAX_DEPTH = 24
+# minimal number of records of a cell used to guide sampling
+_MIN_RECORDS = 64
+# extent of space subdivided for unbounded scenes
+_UNBOUNDED_EXTENT = 1e4
+
+
+#pylint: disable=too-few-public-methods
+
+class GuideCell():
+    """Leaf of spatial tree of path guide: box of space with training
+       histogram of incoming radiance and sampling distribution built from
+       it."""
+
+    lower = None
+    upper = None
+    depth = 0
+    histogram = None
+    records = 0
+    # cumulative distribution over bins (None if the cell is not guiding)
+    cdf = None
+
+    def __init__(self, lower, upper, depth, histogram, records=0):
+        """Creates cell of given bounds (lower and upper corners) and depth,
+           with given training histogram and number of records."""
+        self.lower = lower
+        self.upper = upper
+        self.depth = depth
+        self.histogram = histogram
+        self.records = records
+
+#pylint: enable=too-few-public-methods
+
+
+class PathGuide():
+    """Spatial binary tree of directional histograms of incoming radiance."""
+
+    resolution = None
+    split_records = None
+    nodes = None
+    cells = None
+
+    def __init__(self, bounds=None, resolution=DEFAULT_RESOLUTION,
+                 split_records=DEFAULT_SPLIT_RECORDS):
+        """Creates guide of space within given bounds (lower and upper corners,
+           unbounded if None), with directional histograms of given resolution
+           (bins along each axis), whose cells are split after given number of
+           records."""
+        assert resolution > 0 and split_records > 0
+        self.resolution = resolution
+        self.split_records = split_records
+        if bounds is None:
+            bounds = (np.full(3, -_UNBOUNDED_EXTENT), np.full(3, _UNBOUNDED_EXTENT))
+        # nodes are [axis, split, first child] for inner nodes (with children
+        # at consecutive indices) and [-1, 0.0, cell index] for leaves
+        self.nodes = [[-1, 0.0, 0]]
+        self.cells = [GuideCell(np.asarray(bounds[0], dtype='double'),
+                                np.asarray(bounds[1], dtype='double'), 0,
+                                np.zeros(resolution * resolution))]
+
+    def __len__(self):
+        """Returns number of cells of the guide."""
+        return len(self.cells)
+
+    def cell(self, position):
+        """Returns index of cell containing given point (Vec3)."""
+        point = position.data().tolist()
+        nodes = self.nodes
+        node = nodes[0]
+        while node[0] >= 0:
+            node = nodes[node[2] + (point[node[0]] >= node[1])]
+        return node[2]
+
+    def is_guiding(self, cell):
+        """Checks whether cell of given index has sampling distribution."""
+        return self.cells[cell].cdf is not None
+
+    def _bin(self, direction):
+        """Returns index of bin of histograms containing given direction."""
+        res = self.resolution
+        d_x, d_y, d_z = direction.data().tolist()
+        u_ix = min(res - 1, max(0, int((d_z + 1.0) * 0.5 * res)))
+        azimuth = math.atan2(d_y, d_x)
+        if azimuth < 0.0:
+            azimuth += 2.0 * math.pi
+        v_ix = min(res - 1, int(azimuth / (2.0 * math.pi) * res))
+        return u_ix * res + v_ix
+
+    def pdf(self, cell, direction):
+        """Returns density (over solid angle) of sampling given direction in
+           cell of given index."""
+        cdf = self.cells[cell].cdf
+        index = self._bin(direction)
+        weight = cdf[index + 1] - cdf[index]
+        return weight * self.resolution * self.resolution / (4.0 * math.pi)
+
+    def sample(self, cell, u_pos, v_pos):
+        """Returns direction sampled from distribution of cell of given index
+           given uniform u, v coordinates."""
+        cdf = self.cells[cell].cdf
+        res = self.resolution
+        index = min(int(np.searchsorted(cdf, u_pos, side='right')) - 1, res * res - 1)
+        # reuse u coordinate for position within the bin
+        u_pos = (u_pos - cdf[index]) / max(cdf[index + 1] - cdf[index], 1e-12)
+        cos_theta = ((index // res) + min(max(u_pos, 0.0), 1.0)) / res * 2.0 - 1.0
+        azimuth = ((index % res) + v_pos) / res * 2.0 * math.pi
+        sin_theta = math.sqrt(max(0.0, 1.0 - cos_theta * cos_theta))
+        return Vec3(sin_theta * math.cos(azimuth), sin_theta * math.sin(azimuth), cos_theta)
+
+    def record(self, cell, direction, value):
+        """Records incoming radiance (luminance) from given direction divided
+           by its sampling density in cell of given index."""
+        cell = self.cells[cell]
+        cell.histogram[self._bin(direction)] += value
+        cell.records += 1
+
+    def update(self):
+        """Splits cells with enough records and rebuilds sampling distributions
+           from training histograms."""
+        for node in list(self.nodes):
+            if node[0] >= 0:
+                continue
+            cell = self.cells[node[2]]
+            if cell.records < self.split_records or cell.depth >= _MAX_DEPTH:
+                continue
+            axis = cell.depth % 3
+            split = (cell.lower[axis] + cell.upper[axis]) * 0.5
+            mid_upper = cell.upper.copy()
+            mid_upper[axis] = split
+            mid_lower = cell.lower.copy()
+            mid_lower[axis] = split
+            first = len(self.nodes)
+            self.nodes.append([-1, 0.0, node[2]])
+            self.nodes.append([-1, 0.0, len(self.cells)])
+            self.cells[node[2]] = GuideCell(cell.lower, mid_upper, cell.depth + 1,
+                                            cell.histogram * 0.5, cell.records // 2)
+            self.cells.append(GuideCell(mid_lower, cell.upper, cell.depth + 1,
+                                        cell.histogram * 0.5, cell.records // 2))
+            node[:] = [axis, split, first]
+
+        for cell in self.cells:
+            total = cell.histogram.sum()
+            if cell.records < _MIN_RECORDS or total <= 0.0:
+                cell.cdf = None
+                continue
+            cell.cdf = np.concatenate([[0.0], np.cumsum(cell.histogram) / total])
+            cell.cdf[-1] = 1.0
@@ -0,0 +1,369 @@
+"""Photon mapping of caustics, i.e. light reaching diffuse surfaces after
+   specular reflections (paths light - specular+ - diffuse).
+
+   Photons are emitted from emissive spheres and triangles (proportionally to
+   their power) towards bounding spheres of primitives that may reflect light
+   specularly (as only photons reflected by them contribute to caustics),
+   and traced through the scene in vectorized batches. At every
+   surface with diffuse colour reached after at least one specular bounce
+   photon is stored, then it is reflected specularly with probability of
+   specular reflection of the material (or absorbed otherwise). Stored
+   photons are kept in a balanced KD-tree (stored as flat arrays, with
+   photons of each leaf forming a contiguous range) and looked up by
+   density estimation within fixed radius."""
+
+import math
+
+import numpy as np
+
+from .vector import Vec3
+from .raycast_base import RayBatch
+from .oop_primitives import Sphere, Triangle, spawn_offset
+from .oop_material import ShinyMaterial
+from .bvh import median_split
+
+
+DEFAULT_LEAF_SIZE = 8
+
+KD_NODE_DTYPE = np.dtype([('axis', 'int8'), ('split', 'double'),
+                          ('start', 'int32'), ('count', 'int32')])
+
+# number of photons traced at once
+_PHOTON_BATCH_SIZE = 1 << 16
+
+# maximal number of target spheres photons are aimed at (more targets are
+# grouped by median splits into as many bounding spheres)
+_MAX_TARGETS = 16
+
+# maximal distance of photons from tangent plane of looked up point
+# (relative to lookup radius)
+_PLANE_TOLERANCE = 0.25
+
+
+def _orthonormal_bases(normals):
+    """Returns arrays of x and y axes of orthonormal bases with given z axes
+       (as in OrthonormalBasis.from_z_axis)."""
+    x_axes = np.zeros_like(normals)
+    near_x = np.abs(normals[:, 0]) > 0.99
+    x_axes[~near_x, 0] = 1.0
+    x_axes[near_x, 1] = 1.0
+    x_axes = np.cross(x_axes, normals)
+    x_axes /= np.linalg.norm(x_axes, axis=1)[:, np.newaxis]
+    return x_axes, np.cross(normals, x_axes)
+
+def _sample_hemispheres(normals, rng):
+    """Returns cosine-weighted random directions from hemispheres around
+       given normals (as sample_hemisphere)."""
+    x_axes, y_axes = _orthonormal_bases(normals)
+    angles = 2.0 * math.pi * rng.random(len(normals))
+    radii_sqr = rng.random(len(normals))
+    radii = np.sqrt(radii_sqr)
+    return x_axes * (np.cos(angles) * radii)[:, np.newaxis] + \
+           y_axes * (np.sin(angles) * radii)[:, np.newaxis] + \
+           normals * np.sqrt(1.0 - radii_sqr)[:, np.newaxis]
+
+def _sample_cones(directions, angles, rng):
+    """Returns random directions from cones around given directions with
+       given spread angles (as sample_cone)."""
+    x_axes, y_axes = _orthonormal_bases(directions)
+    angles = angles * (1.0 - 2.0 * np.arccos(rng.random(len(directions))) / math.pi)
+    rotations = 2.0 * math.pi * rng.random(len(directions))
+    result = x_axes * (np.cos(rotations) * np.sin(angles))[:, np.newaxis] + \
+             y_axes * (np.sin(rotations) * np.sin(angles))[:, np.newaxis] + \
+             directions * np.cos(angles)[:, np.newaxis]
+    return result / np.linalg.norm(result, axis=1)[:, np.newaxis]
+
+def _reflectances(cos_theta_i, ior_from, ior_to):
+    """Returns Fresnel reflectances for given cosines of incidence angles and
+       refraction indices (as Vec3.reflectance)."""
+    ior_ratio = ior_from / ior_to
+    sin_theta_sqr = ior_ratio ** 2 * (1.0 - cos_theta_i ** 2)
+    cos_theta_t = np.sqrt(np.maximum(0.0, 1.0 - sin_theta_sqr))
+    r_perpendicular = (ior_from * cos_theta_i - ior_to * cos_theta_t) / \
+                      (ior_from * cos_theta_i + ior_to * cos_theta_t)
+    r_parallel = (ior_to * cos_theta_i - ior_from * cos_theta_t) / \
+                 (ior_to * cos_theta_i + ior_from * cos_theta_t)
+    return np.where(sin_theta_sqr > 1.0, 1.0, (r_perpendicular ** 2 + r_parallel ** 2) / 2.0)
+
+
+def _emitters(scene):
+    """Returns list of emissive primitives of the scene with their emitted
+       power (emission times pi times emitting area)."""
+    result = []
+    for prim in scene.primitives:
+        if prim.material is None or not any(prim.material.material_data.emission.data() > 0.0):
+            continue
+        if isinstance(prim, Sphere):
+            area = 4.0 * math.pi * prim.radius ** 2
+        elif isinstance(prim, Triangle):
+            # both sides of triangles emit light
+            area = prim.face_u().cross(prim.face_v()).length()
+        else:
+            continue
+        result.append((prim, prim.material.material_data.emission.data() * math.pi * area))
+    return result
+
+def _targets(scene):
+    """Returns arrays of centres and radii of bounding spheres of primitives
+       which may reflect light specularly (which photons are aimed at)."""
+    centres = []
+    radii = []
+    for prim in scene.primitives:
+        if prim.material is None:
+            continue
+        data = prim.material.material_data
+        specular = data.reflectivity > 0.0 if isinstance(prim.material, ShinyMaterial) \
+                   else data.refraction_index != 1.0
+        if not specular:
+            continue
+        if isinstance(prim, Sphere):
+            centres.append(prim.centre.data())
+            radii.append(prim.radius)
+            continue
+        bounds = prim.bounds()
+        if bounds is not None:
+            centres.append((bounds[0] + bounds[1]) * 0.5)
+            radii.append(np.linalg.norm(bounds[1] - bounds[0]) * 0.5)
+    centres = np.array(centres, dtype='double').reshape(-1, 3)
+    radii = np.array(radii, dtype='double')
+    if len(radii) <= _MAX_TARGETS:
+        return centres, radii
+
+    groups = [np.arange(len(radii))]
+    while len(groups) < _MAX_TARGETS:
+        group = groups.pop(int(np.argmax([len(group) for group in groups])))
+        points = centres[group]
+        order = np.argsort(points[:, int(np.argmax(np.ptp(points, axis=0)))])
+        groups.extend([group[order[:len(group) // 2]], group[order[len(group) // 2:]]])
+    bounds = []
+    for group in groups:
+        lower = (centres[group] - radii[group, np.newaxis]).min(axis=0)
+        upper = (centres[group] + radii[group, np.newaxis]).max(axis=0)
+        centre = (lower + upper) * 0.5
+        bounds.append((centre, (np.linalg.norm(centres[group] - centre, axis=1) +
+                                radii[group]).max()))
+    return np.array([centre for centre, _ in bounds]), np.array([radius for _, radius in bounds])
+
+def _target_cones(origins, targets):
+    """Returns arrays of axes and cosines of half-angles of cones subtended by
+       given target spheres from given points (shape: points x targets)."""
+    centres, radii = targets
+    axes = centres[np.newaxis, :, :] - origins[:, np.newaxis, :]
+    distances = np.linalg.norm(axes, axis=2)
+    axes /= np.maximum(distances, 1e-12)[:, :, np.newaxis]
+    ratios = np.minimum(radii[np.newaxis, :] / np.maximum(distances, 1e-12), 1.0)
+    # points inside bounding spheres sample whole sphere of directions
+    cosines = np.where(distances > radii, np.sqrt(1.0 - ratios * ratios), -1.0)
+    return axes, cosines
+
+#pylint: disable=too-many-locals
+
+def _emit_photons(emitters, targets, count, rng):
+    """Returns origins, directions and powers of given number of photons
+       emitted from given emitters towards given target spheres. Directions
+       are sampled uniformly from cone subtended by randomly chosen target,
+       and weighted by mixture density of all target cones."""
+    powers = np.array([power for _, power in emitters], dtype='double')
+    probs = powers.mean(axis=1) / powers.mean(axis=1).sum()
+    choices = rng.choice(len(emitters), count, p=probs)
+    origins = np.zeros((count, 3))
+    normals = np.zeros((count, 3))
+    areas = np.zeros(count)
+    for index, (prim, _) in enumerate(emitters):
+        mask = choices == index
+        size = int(np.count_nonzero(mask))
+        if isinstance(prim, Sphere):
+            normals[mask] = rng.normal(size=(size, 3))
+            normals[mask] /= np.linalg.norm(normals[mask], axis=1)[:, np.newaxis]
+            origins[mask] = prim.centre.data() + normals[mask] * prim.radius
+            areas[mask] = 4.0 * math.pi * prim.radius ** 2
+        else:
+            u_pos = np.sqrt(rng.random(size))
+            v_pos = rng.random(size)
+            vertices = np.array([vertex.data() for vertex in prim.vertices], dtype='double')
+            origins[mask] = vertices[0] * (1.0 - u_pos)[:, np.newaxis] + \
+                            vertices[1] * (u_pos * (1.0 - v_pos))[:, np.newaxis] + \
+                            vertices[2] * (u_pos * v_pos)[:, np.newaxis]
+            sides = np.where(rng.random(size) < 0.5, -1.0, 1.0)
+            normals[mask] = np.outer(sides, prim.face_normal().data())
+            areas[mask] = prim.face_u().cross(prim.face_v()).length()
+
+    axes, cosines = _target_cones(origins, targets)
+    chosen = rng.integers(len(targets[1]), size=count)
+    rows = np.arange(count)
+    cos_angles = 1.0 - rng.random(count) * (1.0 - cosines[rows, chosen])
+    sin_angles = np.sqrt(np.maximum(0.0, 1.0 - cos_angles * cos_angles))
+    rotations = 2.0 * math.pi * rng.random(count)
+    x_axes, y_axes = _orthonormal_bases(axes[rows, chosen])
+    directions = x_axes * (np.cos(rotations) * sin_angles)[:, np.newaxis] + \
+                 y_axes * (np.sin(rotations) * sin_angles)[:, np.newaxis] + \
+                 axes[rows, chosen] * cos_angles[:, np.newaxis]
+
+    inside = np.einsum('ij,ikj->ik', directions, axes) >= cosines
+    densities = (inside / (2.0 * math.pi * (1.0 - cosines))).mean(axis=1)
+    emitted_cos = np.maximum(0.0, np.einsum('ij,ij->i', directions, normals))
+    weights = areas * emitted_cos / (densities * probs[choices] * count)
+    photon_powers = powers[choices] / (math.pi * areas)[:, np.newaxis] * weights[:, np.newaxis]
+    # photons going into emitters carry no power
+    emitted = emitted_cos > 0.0
+    origins = origins + normals * (np.maximum(1.0, np.abs(origins).max(axis=1)) *
+                                   spawn_offset('double'))[:, np.newaxis]
+    return origins[emitted], directions[emitted], photon_powers[emitted]
+
+#pylint: enable=too-many-locals
+
+def _material_table(scene):
+    """Returns arrays of diffuse colours, specular reflection probabilities
+       of shiny materials (-1 for matte ones), refraction indices and
+       reflection cone angles of scene primitives."""
+    table = np.zeros((len(scene.primitives), 6))
+    for index, prim in enumerate(scene.primitives):
+        if prim.material is None:
+            # e.g. instances of meshes of many materials absorb photons
+            table[index, 3:5] = (-1.0, 1.0)
+            continue
+        data = prim.material.material_data
+        table[index, :3] = data.diffuse.data()
+        table[index, 3] = data.reflectivity if isinstance(prim.material, ShinyMaterial) else -1.0
+        table[index, 4] = data.refraction_index
+        table[index, 5] = data.reflection_cone_angle
+    return table[:, :3], table[:, 3], table[:, 4], table[:, 5]
+
+
+#pylint: disable=too-many-locals
+
+def trace_photons(scene, count, max_depth, rng=None):
+    """Emits given number of photons from emissive primitives of the scene and
+       traces them through up to given number of bounces. Returns caustic
+       photon map (empty if there are no emitters or specular primitives)."""
+    rng = rng if rng is not None else np.random.default_rng()
+    emitters = _emitters(scene)
+    targets = _targets(scene)
+    diffuse, reflectivity, refraction, cone_angle = _material_table(scene)
+    stored = []
+
+    for beg in range(0, count if emitters and len(targets[1]) else 0, _PHOTON_BATCH_SIZE):
+        origins, directions, powers = _emit_photons(emitters, targets,
+                                                    min(count - beg, _PHOTON_BATCH_SIZE), rng)
+        specular = np.zeros(len(origins), dtype='bool')
+        for _ in range(max_depth):
+            hits = scene.hit_batch(RayBatch(origins, directions))
+            hit_mask = hits.hit_mask()
+            ids = hits.primitive_ids
+            store = hit_mask & specular
+            store[store] = np.any(diffuse[ids[store]] > 0.0, axis=1)
+            stored.append((hits.positions[store], directions[store], powers[store]))
+
+            # specular reflection with probability given by material
+            probs = np.where(reflectivity[ids] >= 0.0, reflectivity[ids], 0.0)
+            matte = hit_mask & (reflectivity[ids] < 0.0)
+            cos_theta_i = -np.einsum('ij,ij->i', hits.normals[matte], directions[matte])
+            ior_from = np.where(hits.is_inside[matte], refraction[ids[matte]], 1.0)
+            ior_to = np.where(hits.is_inside[matte], 1.0, refraction[ids[matte]])
+            probs[matte] = _reflectances(cos_theta_i, ior_from, ior_to)
+            reflected = hit_mask & (rng.random(len(origins)) < probs)
+            if not np.any(reflected):
+                break
+
+            normals = hits.normals[reflected]
+            mirrored = directions[reflected] - normals * \
+                       (2.0 * np.einsum('ij,ij->i', normals, directions[reflected]))[:, np.newaxis]
+            directions[reflected] = _sample_cones(mirrored, cone_angle[ids[reflected]], rng)
+            rays = hits.spawn_rays(directions, spawn_offset('double'))[reflected]
+            origins, directions = rays.origins, rays.directions
+            powers = powers[reflected]
+            specular = np.ones(len(origins), dtype='bool')
+
+    if not stored:
+        return PhotonMap(np.zeros((0, 3)), np.zeros((0, 3)), np.zeros((0, 3)))
+    return PhotonMap(*[np.concatenate([photons[part] for photons in stored])
+                       for part in range(3)])
+
+#pylint: enable=too-many-locals
+
+
+def build_kd_tree(positions, leaf_size=DEFAULT_LEAF_SIZE):
+    """Builds balanced KD-tree of given points, splitting nodes at the median
+       along the widest axis. Returns array of nodes (in depth-first order,
+       'start' of inner nodes is index of their right child, of leaves the
+       first point of their range) and order of points in leaves."""
+    order, splits = median_split(positions, leaf_size)
+    # median of inner node is the lowest point in its right child's range
+    nodes = [[0, 0.0, beg, end - beg] if axis < 0 else
+             [axis, float(positions[order[(beg + end) // 2:end], axis].min()), right, 0]
+             for axis, beg, end, right in splits]
+
+    result = np.zeros(len(nodes), dtype=KD_NODE_DTYPE)
+    for name, values in zip(KD_NODE_DTYPE.names, zip(*nodes)):
+        result[name] = values
+    return result, order
+
+
+class PhotonMap():
+    """Photons (positions, incoming directions and powers) stored in a
+       KD-tree."""
+
+    positions = None
+    directions = None
+    powers = None
+    nodes = None
+    _node_list = None
+
+    def __init__(self, positions, directions, powers, leaf_size=DEFAULT_LEAF_SIZE):
+        """Creates photon map of given photons."""
+        self.nodes, order = build_kd_tree(positions, leaf_size) if len(positions) > 0 \
+                            else (np.zeros(0, dtype=KD_NODE_DTYPE), np.zeros(0, dtype='int32'))
+        self.positions = positions[order]
+        self.directions = directions[order]
+        self.powers = powers[order]
+
+    def __len__(self):
+        """Returns number of photons in the map."""
+        return len(self.positions)
+
+    def __getstate__(self):
+        """Returns state for pickling (without derived node list)."""
+        return {'positions': self.positions, 'directions': self.directions,
+                'powers': self.powers, 'nodes': self.nodes}
+
+    def __setstate__(self, state):
+        """Restores pickled state."""
+        self.__dict__.update(state)
+
+    def nearby(self, point, radius):
+        """Returns indices of photons within given radius from given point."""
+        if len(self.positions) == 0:
+            return np.zeros(0, dtype='int64')
+        if self._node_list is None:
+            self._node_list = [tuple(node.tolist()) for node in self.nodes]
+        nodes = self._node_list
+
+        ranges = []
+        stack = [0]
+        while stack:
+            index = stack.pop()
+            axis, split, start, count = nodes[index]
+            if count > 0:
+                ranges.append(np.arange(start, start + count))
+                continue
+            if point[axis] + radius >= split:
+                stack.append(start)
+            if point[axis] - radius <= split:
+                stack.append(index + 1)
+        indices = np.concatenate(ranges) if ranges else np.zeros(0, dtype='int64')
+        offsets = self.positions[indices] - point
+        return indices[np.einsum('ij,ij->i', offsets, offsets) <= radius * radius]
+
+    def irradiance(self, position, normal, radius):
+        """Estimates irradiance (Vec3) at given point of surface with given
+           normal from density of photons within given radius, which arrived
+           at the side normal points to and lie close to tangent plane."""
+        point = position.data()
+        indices = self.nearby(point, radius)
+        if len(indices) == 0:
+            return Vec3()
+        normal = normal.data()
+        indices = indices[(self.directions[indices] @ normal < 0.0) &
+                          (np.abs((self.positions[indices] - point) @ normal) <=
+                           _PLANE_TOLERANCE * radius)]
+        return Vec3(arr=self.powers[indices].sum(axis=0) / (math.pi * radius * radius))
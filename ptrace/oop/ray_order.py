@@ -0,0 +1,96 @@
+"""Coherent orderings of pixels, tiles and rays along space filling curves.
+
+   Pixels (and tiles) are traversed in Morton (Z-order) or Hilbert curve
+   order, so that consecutive camera rays start close to each other and hit
+   nearby geometry. Batches of secondary rays are sorted by octant of their
+   directions and Morton code of cells of their origins (quantised within
+   bounds of the batch), so that rays traversing the same nodes of
+   acceleration structure are stored next to each other."""
+
+import functools
+
+import numpy as np
+
+
+PIXEL_ORDERS = ('scanline', 'morton', 'hilbert')
+TILE_ORDERS = ('centre', 'morton', 'hilbert')
+
+# number of bits per axis of quantised ray origins
+_ORIGIN_BITS = 10
+
+
+def _spread_bits_2d(values):
+    """Spreads bits of given (16 bit) integers to even bit positions."""
+    values = values.astype('uint64') & 0xFFFF
+    values = (values | (values << 8)) & 0x00FF00FF
+    values = (values | (values << 4)) & 0x0F0F0F0F
+    values = (values | (values << 2)) & 0x33333333
+    return (values | (values << 1)) & 0x55555555
+
+def _spread_bits_3d(values):
+    """Spreads bits of given (10 bit) integers to every third bit position."""
+    values = values.astype('uint64') & 0x3FF
+    values = (values | (values << 16)) & 0x030000FF
+    values = (values | (values << 8)) & 0x0300F00F
+    values = (values | (values << 4)) & 0x030C30C3
+    return (values | (values << 2)) & 0x09249249
+
+def morton_codes(x_pos, y_pos):
+    """Returns Morton codes (interleaved bits) of given arrays of
+       non-negative (16 bit) integer coordinates."""
+    return _spread_bits_2d(np.asarray(x_pos)) | (_spread_bits_2d(np.asarray(y_pos)) << 1)
+
+def hilbert_codes(x_pos, y_pos, bits):
+    """Returns distances along Hilbert curve filling square of side 2 ** bits
+       of points with given arrays of integer coordinates."""
+    x_pos = np.array(x_pos, dtype='int64')
+    y_pos = np.array(y_pos, dtype='int64')
+    codes = np.zeros(x_pos.shape, dtype='int64')
+    side = 1 << bits
+    scale = side >> 1
+    while scale > 0:
+        x_bits = (x_pos & scale) > 0
+        y_bits = (y_pos & scale) > 0
+        codes += scale * scale * ((3 * x_bits) ^ y_bits)
+        # rotate quadrant so that curve in it starts and ends at its corners
+        rotate = ~y_bits
+        flip = rotate & x_bits
+        x_pos[flip] = side - 1 - x_pos[flip]
+        y_pos[flip] = side - 1 - y_pos[flip]
+        x_pos[rotate], y_pos[rotate] = y_pos[rotate], x_pos[rotate].copy()
+        scale >>= 1
+    return codes
+
+def curve_codes(x_pos, y_pos, curve, size):
+    """Returns codes of points with given integer coordinates (within square
+       of given side) along given curve ('morton' or 'hilbert')."""
+    if curve == 'morton':
+        return morton_codes(x_pos, y_pos)
+    assert curve == 'hilbert', "Unknown curve"
+    return hilbert_codes(x_pos, y_pos, max(1, int(size - 1).bit_length()))
+
+@functools.lru_cache(maxsize=16)
+def pixel_order(width, height, order='scanline'):
+    """Returns list of (x, y) coordinates of all pixels of image of given
+       dimensions in given order ('scanline' traverses columns in turn,
+       'morton' and 'hilbert' follow the curves)."""
+    assert order in PIXEL_ORDERS, "Unknown pixel order"
+    px_x, px_y = np.divmod(np.arange(width * height), height)
+    if order != 'scanline':
+        indices = np.argsort(curve_codes(px_x, px_y, order, max(width, height)), kind='stable')
+        px_x, px_y = px_x[indices], px_y[indices]
+    return list(zip(px_x.tolist(), px_y.tolist()))
+
+def coherent_order(origins, directions):
+    """Returns permutation of rays with given arrays of origins and
+       directions grouping them by octants of directions and sorting them
+       along Morton curve of cells of their origins."""
+    octants = (directions[:, 0] < 0).astype('uint64') | \
+              ((directions[:, 1] < 0).astype('uint64') << 1) | \
+              ((directions[:, 2] < 0).astype('uint64') << 2)
+    lower = origins.min(axis=0)
+    extent = np.maximum(origins.max(axis=0) - lower, 1e-12)
+    cells = ((origins - lower) / extent * ((1 << _ORIGIN_BITS) - 1)).astype('uint64')
+    codes = _spread_bits_3d(cells[:, 0]) | (_spread_bits_3d(cells[:, 1]) << 1) | \
+            (_spread_bits_3d(cells[:, 2]) << 2)
+    return np.argsort(codes | (octants << (3 * _ORIGIN_BITS)), kind='stable')
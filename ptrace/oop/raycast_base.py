@@ -1,6 +1,7 @@
 """Base classes for handling rays and results of their casting onto scene
    geometry."""
 
+import numpy as np
 
 from .vector import Vec3
 
@@ -49,3 +50,108 @@ class HitRecord():
         self.normal = normal if normal is not None else Vec3.versor(0)
 
 #pylint: enable=too-few-public-methods
+
+
+class RayBatch():
+    """Represents a batch of oriented rays stored as numpy arrays of origins and
+       directions (both of shape (n, 3)) for vectorized ray casting."""
+
+    origins = None
+    directions = None
+
+    def __init__(self, origins, directions):
+        """Creates a batch of rays with given origins and directions.
+
+           Directions must be normalised; both arrays must be of the same
+           floating point type."""
+        assert origins.shape == directions.shape and origins.shape[-1] == 3
+        assert origins.dtype == directions.dtype
+        self.origins = origins
+        self.directions = directions
+
+    @staticmethod
+    def from_rays(rays, dtype='double'):
+        """Creates a batch from given sequence of rays."""
+        origins = np.array([ray.origin.data() for ray in rays], dtype=dtype).reshape(-1, 3)
+        directions = np.array([ray.direction.data() for ray in rays], dtype=dtype).reshape(-1, 3)
+        return RayBatch(origins, directions)
+
+    def __len__(self):
+        """Returns number of rays in the batch."""
+        return self.origins.shape[0]
+
+    @property
+    def dtype(self):
+        """Floating point type of ray data."""
+        return self.origins.dtype
+
+    def __getitem__(self, index):
+        """Returns ray (or sub-batch of rays for slices and index arrays) at
+           given index."""
+        if isinstance(index, (int, np.integer)):
+            return Ray(Vec3.from_array(self.origins[index].copy()),
+                       Vec3.from_array(self.directions[index].copy()))
+        return RayBatch(self.origins[index], self.directions[index])
+
+    def astype(self, dtype):
+        """Returns batch of the same rays with data of given floating point
+           type."""
+        return RayBatch(self.origins.astype(dtype), self.directions.astype(dtype))
+
+    def points_at(self, distances):
+        """Returns array of positions of points on respective rays at given
+           distances from their origins."""
+        return self.origins + self.directions * distances[:, np.newaxis]
+
+
+class HitBatch():
+    """Stores information about intersections of a batch of rays with scene
+       geometry (rays that missed have infinite distance and primitive index
+       of -1)."""
+
+    distances = None
+    primitive_ids = None
+    positions = None
+    normals = None
+    is_inside = None
+
+    #pylint: disable=too-many-arguments
+
+    def __init__(self, distances, primitive_ids, positions, normals, is_inside):
+        """Initializes hit batch with given arrays of data."""
+        self.distances = distances
+        self.primitive_ids = primitive_ids
+        self.positions = positions
+        self.normals = normals
+        self.is_inside = is_inside
+
+    #pylint: enable=too-many-arguments
+
+    def __len__(self):
+        """Returns number of rays in the batch."""
+        return self.distances.shape[0]
+
+    def hit_mask(self):
+        """Returns boolean mask of rays that hit any geometry."""
+        return self.primitive_ids >= 0
+
+    def spawn_rays(self, directions, offset=0.0):
+        """Creates batch of secondary rays starting at hit positions with given
+           directions. Origins are moved off the surface (towards the side
+           given direction points to) by given offset relative to magnitude of
+           hit position."""
+        origins = self.positions
+        if offset > 0.0:
+            scale = np.maximum(1.0, np.abs(origins).max(axis=1)) * offset
+            side = np.sign(np.einsum('ij,ij->i', directions, self.normals))
+            origins = origins + self.normals * (scale * side)[:, np.newaxis]
+        return RayBatch(origins.astype(directions.dtype), directions)
+
+    def __getitem__(self, index):
+        """Returns hit record for ray at given index (or None on miss)."""
+        if self.primitive_ids[index] < 0:
+            return None
+        return HitRecord(float(self.distances[index]),
+                         Vec3.from_array(self.positions[index].astype('double')),
+                         bool(self.is_inside[index]),
+                         Vec3.from_array(self.normals[index].astype('double')))
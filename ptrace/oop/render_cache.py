@@ -0,0 +1,182 @@
+"""Content-addressed on-disk cache of rendered accumulation buffers."""
+
+import hashlib
+import os
+import tempfile
+
+import numpy as np
+
+from .image_output import AccumulableImage
+from .oop_renderer import completed_passes
+from .vector import Vec3
+
+
+DEFAULT_CACHE_SIZE = 1 << 30
+
+_CACHE_FILE_EXT = '.npz'
+
+# parameters that do not change the rendered image (as a random variable),
+# only how (and how long) it is rendered; number of samples is not part of
+# the key either, as renders with more samples resume from cached ones
+_NON_IMAGE_PARAMS = ( \
+    'samples_per_pixel', 'max_cpus', 'accumulation_path', 'accumulation_tile_size',
+    'tiled', 'tile_size', 'samples_per_tile', 'target_tile_time', 'time_budget',
+    'target_error', 'progressive', 'progressive_levels', 'progressive_level_samples',
+    'ray_batch_size', 'denoise', 'bvh_min_primitives', 'bvh_leaf_size', 'bvh_cache_path',
+    'pixel_order', 'tile_order')
+
+# parameters determining order of rendering pixels, which changes images
+# (seeded ones in particular) rendered with state learned while rendering
+_ORDER_PARAMS = ( \
+    'max_cpus', 'tiled', 'tile_size', 'samples_per_tile', 'target_tile_time', 'pixel_order',
+    'tile_order')
+_LEARNING_PARAMS = ('irradiance_cache_error', 'guiding_fraction')
+
+
+def _update_hash(digest, obj, seen=None):
+    """Feeds canonical representation of given object (scene, camera or their
+       components) into given hash. Attributes starting with underscore are
+       treated as derived data (e.g. acceleration structures) and skipped.
+       Objects shared by others (e.g. instanced meshes) are hashed once and
+       referred to by order of their first occurrence afterwards."""
+    seen = seen if seen is not None else {}
+    if obj is None or isinstance(obj, (bool, str)):
+        digest.update(repr(obj).encode())
+    elif isinstance(obj, (int, float)):
+        digest.update(float(obj).hex().encode())
+    elif isinstance(obj, np.ndarray):
+        digest.update('{}{}'.format(obj.dtype.str, obj.shape).encode())
+        digest.update(np.ascontiguousarray(obj).tobytes())
+    elif isinstance(obj, Vec3):
+        _update_hash(digest, obj.data())
+    elif isinstance(obj, np.generic):
+        _update_hash(digest, obj.item())
+    elif isinstance(obj, (list, tuple)):
+        digest.update('[{}'.format(len(obj)).encode())
+        for item in obj:
+            _update_hash(digest, item, seen)
+    elif isinstance(obj, dict):
+        digest.update('{{{}'.format(len(obj)).encode())
+        for key in sorted(obj):
+            _update_hash(digest, key, seen)
+            _update_hash(digest, obj[key], seen)
+    elif id(obj) in seen:
+        digest.update('@{}'.format(seen[id(obj)]).encode())
+    else:
+        seen[id(obj)] = len(seen)
+        digest.update(type(obj).__qualname__.encode())
+        _update_hash(digest, {key: value for key, value in vars(obj).items()
+                              if not key.startswith('_')}, seen)
+
+def render_key(renderer):
+    """Returns stable hash identifying image rendered by given renderer, i.e.
+       of its compiled scene (primitives, materials), camera, and parameters
+       affecting the image (including seed). Seeded images do not depend on
+       tiling, unless state is learned while rendering (then parameters
+       determining order of pixels are part of the key too)."""
+    digest = hashlib.sha256()
+    seen = {}
+    _update_hash(digest, renderer.scene, seen)
+    _update_hash(digest, renderer.camera, seen)
+    learning = any(renderer.params.get(key) is not None for key in _LEARNING_PARAMS)
+    _update_hash(digest, {key: value for key, value in renderer.params.items()
+                          if key not in _NON_IMAGE_PARAMS or (learning and key in _ORDER_PARAMS)})
+    return digest.hexdigest()
+
+
+class RenderCache():
+    """Stores accumulated images in a directory under their render keys,
+       evicting least recently used entries once their total size exceeds
+       given limit (in bytes)."""
+
+    path = None
+    max_size = None
+
+    def __init__(self, path, max_size=DEFAULT_CACHE_SIZE):
+        """Opens (creating if needed) cache in given directory."""
+        self.path = path
+        self.max_size = max_size
+        os.makedirs(path, exist_ok=True)
+
+    def _entry_path(self, key):
+        """Returns path of file storing entry with given key."""
+        return os.path.join(self.path, key + _CACHE_FILE_EXT)
+
+    def get(self, key):
+        """Returns accumulable image stored under given key (or None),
+           marking it as recently used."""
+        path = self._entry_path(key)
+        try:
+            with open(path, 'rb') as entry:
+                data = entry.read()
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return AccumulableImage.from_bytes(data)
+
+    def put(self, key, image):
+        """Stores accumulable image under given key (replacing previous one)
+           and evicts least recently used entries if cache is too large."""
+        handle, temp_path = tempfile.mkstemp(suffix='.tmp', dir=self.path)
+        with os.fdopen(handle, 'wb') as entry:
+            entry.write(image.to_bytes())
+        os.replace(temp_path, self._entry_path(key))
+        self.evict(keep=key)
+
+    def entries(self):
+        """Returns list of (key, size in bytes, last use time) tuples of all
+           entries, least recently used first."""
+        result = []
+        for name in os.listdir(self.path):
+            if name.endswith(_CACHE_FILE_EXT):
+                try:
+                    stat = os.stat(os.path.join(self.path, name))
+                except FileNotFoundError:
+                    continue
+                result.append((name[:-len(_CACHE_FILE_EXT)], stat.st_size, stat.st_mtime))
+        return sorted(result, key=lambda entry: entry[2])
+
+    def size(self):
+        """Returns total size (in bytes) of cached entries."""
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self, keep=None):
+        """Removes least recently used entries (except for the one with given
+           key) until total size fits in the limit."""
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for key, size, _ in entries:
+            if total <= self.max_size:
+                break
+            if key == keep:
+                continue
+            try:
+                os.remove(self._entry_path(key))
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def render(self, renderer, verbose=False, update=None):
+        """Renders image with given renderer, returning cached image if it
+           has enough samples, or resuming rendering from it otherwise, and
+           stores the result in cache."""
+        key = render_key(renderer)
+        cached = self.get(key)
+        if cached is not None and renderer.needs_variance() and not cached.tracks_variance():
+            cached = None
+        if cached is not None and completed_passes(cached) >= renderer.params['samples_per_pixel']:
+            if verbose:
+                print("Using cached render {}.".format(key))
+            renderer.stats = { \
+                'samples_per_pixel': cached.total_sample_count() / (cached.width * cached.height),
+                'estimated_error': cached.estimated_error() if cached.tracks_variance() else None,
+                'render_time': 0.0,
+                'stop_reason': 'cache'}
+            return cached
+
+        if verbose and cached is not None:
+            print("Resuming cached render {} ({} samples per pixel).".format( \
+                key, completed_passes(cached)))
+        output = renderer.render(verbose, update, cached)
+        self.put(key, output)
+        return output
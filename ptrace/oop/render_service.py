@@ -0,0 +1,321 @@
+"""Long-running asyncio HTTP service rendering scenes on a pool of worker
+   processes and streaming progressive png snapshots to its clients.
+
+   Endpoints:
+     POST /render         - body: {"scene": name, "params": {...}}, responds
+                            with multipart/x-mixed-replace stream of png
+                            snapshots, one after each sampling pass
+     GET /renders         - lists renders in progress
+     DELETE /renders/<id> - stops given render after passes in progress
+     GET /scenes          - lists available scene names
+
+   Clients may set only parameters listed in CLIENT_PARAMS, within their
+   limits; others (e.g. paths of files written, numbers of processes) keep
+   their defaults."""
+
+import asyncio
+import itertools
+import json
+import math
+import random
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from .image_output import AccumulableImage
+from .oop_renderer import DEFAULT_RENDERER_PARAMS
+
+
+_BOUNDARY = 'ptrace-frame'
+
+# parameters clients may set, with their types and ranges of allowed values
+# (inclusive, unbounded if None)
+CLIENT_PARAMS = { \
+    'width': ((int,), 1, 4096),
+    'height': ((int,), 1, 4096),
+    'preview': ((bool,), None, None),
+    'samples_per_pixel': ((int,), 1, 4096),
+    'max_depth': ((int,), 1, 16),
+    'first_bounce_u_samples': ((int,), 1, 16),
+    'first_bounce_v_samples': ((int,), 1, 16),
+    'precision': ((str,), None, None),
+    'time_budget': ((int, float, type(None)), 0, 3600),
+    'target_error': ((int, float, type(None)), 0, None),
+    'seed': ((int, type(None)), 0, None),
+    'scene_size': ((int, type(None)), 1, 100000),
+    'scene_seed': ((int,), 0, None),
+    'photon_count': ((int, type(None)), 1, 1000000),
+    'photon_radius': ((int, float), 1e-6, 10)}
+
+# maximal size (in bytes) of request body
+_MAX_BODY_SIZE = 1 << 16
+
+# number of renderers (scene and parameters combinations) kept by each worker
+_RENDERER_CACHE_SIZE = 8
+
+_STATUS_TEXTS = { \
+    200: 'OK',
+    400: 'Bad Request',
+    404: 'Not Found',
+    405: 'Method Not Allowed'}
+
+
+def _in_range(value, lowest, highest):
+    """Checks whether given number is finite and within given bounds (None for
+       unbounded)."""
+    return math.isfinite(value) and (lowest is None or value >= lowest) and \
+           (highest is None or value <= highest)
+
+def client_params(requested):
+    """Returns rendering parameters with values requested by client set.
+       Raises ValueError if any of them cannot be set by clients, is of
+       invalid type or out of its allowed range."""
+    if not isinstance(requested, dict):
+        raise ValueError('Invalid parameters.')
+    for key, value in requested.items():
+        if key not in CLIENT_PARAMS:
+            raise ValueError("Parameter '{}' cannot be set.".format(key))
+        types, lowest, highest = CLIENT_PARAMS[key]
+        if not isinstance(value, types) or (isinstance(value, bool) and bool not in types):
+            raise ValueError("Invalid type of parameter '{}'.".format(key))
+        if isinstance(value, (int, float)) and not isinstance(value, bool) and \
+           not _in_range(value, lowest, highest):
+            raise ValueError("Parameter '{}' out of allowed range.".format(key))
+    if requested.get('precision', 'double') not in ('double', 'single'):
+        raise ValueError("Invalid value of parameter 'precision'.")
+    return dict(DEFAULT_RENDERER_PARAMS, **requested)
+
+
+_WORKER_FACTORY = None
+# renderers of worker process (with id of the last request they rendered) by
+# scene name and parameters json string
+_WORKER_RENDERERS = None
+
+def _init_service_worker(renderer_factory):
+    """Initializes worker process with given factory of renderers."""
+    global _WORKER_FACTORY, _WORKER_RENDERERS #pylint: disable=global-statement
+    _WORKER_FACTORY = renderer_factory
+    _WORKER_RENDERERS = OrderedDict()
+    random.seed()
+    np.random.seed()
+
+def _warm_up_job():
+    """Does nothing (submitted to start worker processes)."""
+
+def _render_pass_job(scene_name, params_key, render_id, sample_ix):
+    """Renders sampling pass of given index (used for seeding) of given scene
+       with parameters (given as json string) for request with given id in
+       worker process, reusing renderers created for previous requests (with
+       their learned state discarded on the first pass of each request).
+       Returns accumulable image of the pass."""
+    key = (scene_name, params_key)
+    if key in _WORKER_RENDERERS:
+        _WORKER_RENDERERS.move_to_end(key)
+    else:
+        _WORKER_RENDERERS[key] = [_WORKER_FACTORY(scene_name, json.loads(params_key)), None]
+        if len(_WORKER_RENDERERS) > _RENDERER_CACHE_SIZE:
+            _WORKER_RENDERERS.popitem(last=False)
+    entry = _WORKER_RENDERERS[key]
+    renderer = entry[0]
+    if entry[1] != render_id:
+        renderer.reset_learned_state()
+        entry[1] = render_id
+
+    output = AccumulableImage(renderer.params['width'], renderer.params['height'],
+                              renderer.params['precision'], renderer.needs_variance())
+    if renderer.params['preview']:
+        renderer.preview_pass(output)
+    else:
+        renderer.render_pass(output, sample_ix=sample_ix)
+    return output
+
+
+#pylint: disable=too-many-instance-attributes
+
+class RenderService():
+    """Serves render requests over HTTP. Renderers are created (once per
+       worker process, scene and parameters) with given factory, called with
+       scene name and parameters, and each request is rendered in sampling
+       passes running in parallel on the worker pool."""
+
+    renderer_factory = None
+    scene_names = None
+    worker_count = None
+    verbose = False
+    pool = None
+    server = None
+    renders = None
+    render_ids = None
+
+    def __init__(self, renderer_factory, scene_names, worker_count=1, verbose=False):
+        """Creates service rendering scenes with given names using given
+           factory on given number of worker processes."""
+        self.renderer_factory = renderer_factory
+        self.scene_names = list(scene_names)
+        self.worker_count = worker_count
+        self.verbose = verbose
+        self.renders = {}
+        self.render_ids = itertools.count(1)
+
+    async def start(self, host='localhost', port=0):
+        """Starts worker pool and listening at given address. Returns address
+           the service listens at."""
+        self.pool = ProcessPoolExecutor(self.worker_count, initializer=_init_service_worker,
+                                        initargs=(self.renderer_factory,))
+        # worker processes are started before accepting any connection, so
+        # that they do not inherit (and keep open) client sockets
+        await asyncio.get_running_loop().run_in_executor(self.pool, _warm_up_job)
+        self.server = await asyncio.start_server(self._handle, host, port)
+        address = self.server.sockets[0].getsockname()[:2]
+        if self.verbose:
+            print("Render service listening at {}:{}.".format(*address))
+        return address
+
+    async def serve_forever(self):
+        """Serves requests until cancelled."""
+        async with self.server:
+            await self.server.serve_forever()
+
+    async def close(self):
+        """Stops listening and shuts worker pool down."""
+        self.server.close()
+        await self.server.wait_closed()
+        self.pool.shutdown(cancel_futures=True)
+
+    async def _handle(self, reader, writer):
+        """Handles single HTTP request."""
+        try:
+            method, path, body = await _read_request(reader)
+            if method == 'POST' and path == '/render':
+                await self._stream_render(body, writer)
+            elif method == 'GET' and path == '/renders':
+                await _respond_json(writer, 200, [dict(info, id=render_id) for render_id, info
+                                                  in self.renders.items()])
+            elif method == 'GET' and path == '/scenes':
+                await _respond_json(writer, 200, self.scene_names)
+            elif method == 'DELETE' and path.startswith('/renders/'):
+                render_id = path[len('/renders/'):]
+                if not render_id.isdigit() or int(render_id) not in self.renders:
+                    await _respond_json(writer, 404, {'error': 'Unknown render id.'})
+                else:
+                    self.renders[int(render_id)]['cancelled'] = True
+                    await _respond_json(writer, 200, {'cancelled': int(render_id)})
+            else:
+                await _respond_json(writer, 405 if path in ('/render', '/renders', '/scenes')
+                                    else 404, {'error': 'Unknown request.'})
+        except (ValueError, KeyError) as error:
+            await _respond_json(writer, 400, {'error': str(error)})
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    #pylint: disable=too-many-locals
+
+    async def _stream_render(self, body, writer):
+        """Renders scene described by given request body, writing png snapshot
+           of the image after each finished sampling pass."""
+        request = json.loads(body)
+        if not isinstance(request, dict) or request.get('scene') not in self.scene_names:
+            raise ValueError('Unknown scene name.')
+        params = client_params(request.get('params', {}))
+        params_key = json.dumps(params, sort_keys=True)
+        samples = params['samples_per_pixel']
+
+        render_id = next(self.render_ids)
+        info = {'scene': request['scene'], 'samples_per_pixel': samples, 'samples_done': 0,
+                'cancelled': False}
+        self.renders[render_id] = info
+        writer.write(('HTTP/1.1 200 OK\r\n'
+                      'Content-Type: multipart/x-mixed-replace; boundary={}\r\n'
+                      'X-Render-Id: {}\r\n'
+                      'Connection: close\r\n\r\n').format(_BOUNDARY, render_id).encode())
+
+        loop = asyncio.get_running_loop()
+        start_time = time.time()
+        output = None
+        running = set()
+        submitted = 0
+        try:
+            while True:
+                while not self._should_stop(info, params, output, start_time) and \
+                      submitted < samples and len(running) < self.worker_count:
+                    running.add(loop.run_in_executor(self.pool, _render_pass_job,
+                                                     request['scene'], params_key,
+                                                     render_id, submitted))
+                    submitted += 1
+                if not running:
+                    break
+                done, running = await asyncio.wait(running,
+                                                   return_when=asyncio.FIRST_COMPLETED)
+                for future in done:
+                    if output is None:
+                        output = future.result()
+                    else:
+                        output += future.result()
+                    info['samples_done'] += 1
+                snapshot = await loop.run_in_executor(None, output.png_bytes)
+                writer.write(('--{}\r\nContent-Type: image/png\r\nContent-Length: {}\r\n'
+                              'X-Samples: {}\r\n\r\n').format(_BOUNDARY, len(snapshot),
+                                                              info['samples_done']).encode())
+                writer.write(snapshot + b'\r\n')
+                await writer.drain()
+            writer.write('--{}--\r\n'.format(_BOUNDARY).encode())
+            await writer.drain()
+        finally:
+            for future in running:
+                future.cancel()
+            del self.renders[render_id]
+            if self.verbose:
+                print("Render {} ({}) finished with {}/{} samples in {:.2f} s.".format( \
+                    render_id, request['scene'], info['samples_done'], samples,
+                    time.time() - start_time))
+
+    #pylint: enable=too-many-locals
+
+    @staticmethod
+    def _should_stop(info, params, output, start_time):
+        """Checks whether no more sampling passes should be started for given
+           render (because it was cancelled, or time budget or target error
+           given in parameters is reached)."""
+        if info['cancelled']:
+            return True
+        if output is None:
+            return False
+        elapsed = time.time() - start_time
+        if params['time_budget'] is not None and \
+           elapsed * (info['samples_done'] + 1) / info['samples_done'] > params['time_budget']:
+            return True
+        return params['target_error'] is not None and \
+               output.estimated_error() <= params['target_error']
+
+#pylint: enable=too-many-instance-attributes
+
+
+async def _read_request(reader):
+    """Reads HTTP request, returning its method, path and body."""
+    request_line = (await reader.readline()).decode('latin-1').split()
+    if len(request_line) < 2:
+        raise ValueError('Malformed request.')
+    headers = {}
+    while True:
+        line = (await reader.readline()).decode('latin-1').strip()
+        if not line:
+            break
+        name, value = line.split(':', 1)
+        headers[name.strip().lower()] = value.strip()
+    length = int(headers.get('content-length', 0))
+    if not 0 <= length <= _MAX_BODY_SIZE:
+        raise ValueError('Invalid request body size.')
+    body = await reader.readexactly(length) if length else b''
+    return request_line[0].upper(), request_line[1], body
+
+async def _respond_json(writer, status, data):
+    """Writes HTTP response with given status and json encoded data."""
+    body = json.dumps(data).encode()
+    writer.write(('HTTP/1.1 {} {}\r\nContent-Type: application/json\r\n'
+                  'Content-Length: {}\r\nConnection: close\r\n\r\n').format( \
+                      status, _STATUS_TEXTS[status], len(body)).encode() + body)
+    await writer.drain()
@@ -0,0 +1,934 @@
+"""Unit tests for rendering pipeline."""
+
+import asyncio
+import json
+import os
+import signal
+import tempfile
+import time
+import unittest
+from multiprocessing import Process
+import numpy as np
+
+from .vector import Vec3
+from .raycast_base import Ray
+from .scene_settings import MaterialData
+from .camera import Camera
+from .oop_scene import SceneBuilder
+from .oop_renderer import Renderer
+from .image_output import AccumulableImage
+from .tile_scheduler import TileScheduler, make_tile
+from .aov import AovBuffers
+from .denoise import denoise, denoise_image
+from .job_queue import JobQueue, run_queue_worker
+from .render_service import RenderService, client_params
+from .render_cache import RenderCache, render_key
+from . import batch
+from .batch import SceneCache, RenderPool, load_manifest, run_batch
+from .animation import Animation, Keyframes, SceneAnimator, render_sequence
+from .irradiance_cache import IrradianceCache
+from .photon_map import PhotonMap, trace_photons
+from .path_guiding import PathGuide
+from .autotune import TuningCache, apply_tuning, scene_class, tune
+from .scene_generators import sphere_field, caustic_cup, instanced_spheres
+
+
+def _small_renderer(**params):
+    """Creates renderer of a simple scene with tiny default parameters
+       overridden by given ones."""
+    params = dict({'width': 8, 'height': 6, 'preview': False, 'samples_per_pixel': 2,
+                   'max_cpus': 1, 'max_depth': 2, 'first_bounce_u_samples': 1,
+                   'first_bounce_v_samples': 1}, **params)
+    cam = Camera(Vec3(0, 0, -3.2), Vec3(), Vec3(0, 1, 0),
+                 params['width'], params['height'], 40)
+    scb = SceneBuilder(Vec3(0.1, 0.1, 0.1))
+    scb.add_sphere(Vec3(2, 2, -1), 1, MaterialData.make_light(Vec3(4, 4, 4)))
+    scb.add_sphere(Vec3(), 1, MaterialData.make_diffuse(Vec3(0.5, 0.2, 0.2)))
+    return Renderer(scb.scene, cam, params)
+
+def _render_with_feature(test, features, **params):
+    """Renders small sphere field scene with tiny seeded default parameters
+       (overridden by given ones) without and with given feature parameters,
+       checking that mean colours of both images are within 25% of each
+       other. Returns plain renderer, renderer with features and its output
+       image."""
+    params = dict({'width': 16, 'height': 12, 'preview': False, 'samples_per_pixel': 8,
+                   'max_cpus': 1, 'max_depth': 4, 'first_bounce_u_samples': 1,
+                   'first_bounce_v_samples': 1, 'seed': 1}, **params)
+    desc = sphere_field(4, 1)
+    plain = desc.create_renderer(params)
+    expected = plain.render().colours().mean()
+    renderer = desc.create_renderer(dict(params, **features))
+    output = renderer.render()
+    test.assertAlmostEqual(output.colours().mean(), expected, delta=0.25 * expected)
+    return plain, renderer, output
+
+
+class TileSchedulerTests(unittest.TestCase):
+    """Tests for TileScheduler class."""
+
+    def test_tiles_centre_first(self):
+        """Tiles are generated centre-first within each sample pass."""
+        renderer = _small_renderer(width=64, height=64)
+        tiles = renderer.generate_tiles(16, 16, 2, 1)
+        self.assertEqual(len(tiles), 32)
+        self.assertEqual([tile['sample_ix'] for tile in tiles], [0] * 16 + [1] * 16)
+        for tile in tiles[:4]:
+            self.assertTrue(tile['x_range'] in [(16, 32), (32, 48)])
+            self.assertTrue(tile['y_range'] in [(16, 32), (32, 48)])
+        self.assertTrue(all(tiles[i]['dist_prio'] <= tiles[i + 1]['dist_prio']
+                            for i in range(15)))
+
+    def test_work_stealing(self):
+        """Idle workers steal sample chunks from the back of other queues."""
+        tiles = [make_tile((0, 4), (0, 4), 4, 0, 8, 8),
+                 make_tile((4, 8), (4, 8), 4, 0, 8, 8)]
+        scheduler = TileScheduler(tiles, 8, 8, 3)
+        first = scheduler.next_tile(0)
+        self.assertEqual(first['samples'], 4)
+        stolen = scheduler.next_tile(2)
+        self.assertEqual(stolen['samples'], 2)
+        self.assertEqual(stolen['sample_ix'], 2)
+        remaining = scheduler.next_tile(1)
+        self.assertEqual((remaining['samples'], remaining['sample_ix']), (2, 0))
+        self.assertTrue(scheduler.next_tile(1) is None)
+
+    def test_adaptive_split(self):
+        """Tiles estimated to be too expensive are split."""
+        tiles = [make_tile((0, 16), (0, 16), 1, 0, 32, 16),
+                 make_tile((16, 32), (0, 16), 1, 0, 32, 16)]
+        scheduler = TileScheduler(tiles, 32, 16, 1, target_tile_time=1.0)
+        tile = scheduler.next_tile(0)
+        scheduler.report(tile, 10.0)
+        tile = scheduler.next_tile(0)
+        self.assertEqual(tile['x_range'][1] - tile['x_range'][0], 4)
+        self.assertEqual(scheduler.pending_count(), 6)
+
+    def test_curve_order(self):
+        """Tiles are handed out along Hilbert curve within each sample pass."""
+        renderer = _small_renderer(width=64, height=64)
+        tiles = renderer.generate_tiles(16, 16, 2, 1)
+        scheduler = TileScheduler(tiles, 64, 64, 1, order='hilbert')
+        ordered = [scheduler.next_tile(0) for _ in range(32)]
+        self.assertTrue(scheduler.next_tile(0) is None)
+        self.assertEqual([tile['sample_ix'] for tile in ordered], [0] * 16 + [1] * 16)
+        self.assertEqual(ordered[0]['x_range'], (0, 16))
+        self.assertEqual(ordered[0]['y_range'], (0, 16))
+        for prev, tile in zip(ordered[:15], ordered[1:16]):
+            self.assertEqual(abs(tile['x_range'][0] - prev['x_range'][0]) +
+                             abs(tile['y_range'][0] - prev['y_range'][0]), 16)
+
+
+class TiledRenderingTests(unittest.TestCase):
+    """Tests for tiled rendering."""
+
+    def test_tiled_render(self):
+        """Tiled rendering (in a process pool) accumulates all samples and
+           publishes partial results."""
+        for cpus in [1, 2]:
+            renderer = _small_renderer(tiled=True, tile_size=4, max_cpus=cpus)
+            updates = []
+            output = renderer.render(update=lambda img, tile, tiles=updates: tiles.append(tile))
+            self.assertEqual(output.total_sample_count(), 8 * 6 * 2)
+            self.assertEqual(len(updates), 8)
+            self.assertGreater(output[4, 3][0], 0.0)
+
+    def test_seeded_reproducibility(self):
+        """Seeded renders do not depend on tiling, workers, orders or splitting
+           of tiles (driven by measured times)."""
+        params = {'width': 12, 'height': 8, 'samples_per_pixel': 3, 'seed': 5}
+        expected = _small_renderer(**params).render().colours()
+        for extra in [{'tiled': True, 'tile_size': 4, 'target_tile_time': 100.0},
+                      {'tiled': True, 'tile_size': 8, 'samples_per_tile': 3,
+                       'target_tile_time': 1e-5, 'pixel_order': 'hilbert'},
+                      {'max_cpus': 2, 'tile_size': 4, 'target_tile_time': 1e-5,
+                       'tile_order': 'morton'}]:
+            output = _small_renderer(**dict(params, **extra)).render()
+            self.assertTrue(np.all(output.sample_counts == 3))
+            self.assertTrue(np.allclose(output.colours(), expected, rtol=1e-12, atol=1e-12))
+
+    def test_pixel_orders(self):
+        """Pixels and tiles traversed along curves accumulate all samples."""
+        for tiled in [False, True]:
+            for order in ['morton', 'hilbert']:
+                renderer = _small_renderer(tiled=tiled, tile_size=4, pixel_order=order,
+                                           tile_order=order)
+                output = renderer.render()
+                self.assertTrue(np.all(output.sample_counts == 2))
+                self.assertGreater(output[4, 3][0], 0.0)
+
+
+class RenderingModesTests(unittest.TestCase):
+    """Tests for time-budgeted and quality-targeted rendering."""
+
+    def test_time_budget(self):
+        """Rendering stops when time budget would be exceeded."""
+        for tiled in [False, True]:
+            renderer = _small_renderer(samples_per_pixel=1000, time_budget=0.0, tiled=tiled)
+            output = renderer.render()
+            self.assertEqual(renderer.stats['stop_reason'], 'time_budget')
+            self.assertLess(output.total_sample_count(), 8 * 6 * 1000)
+            self.assertGreater(renderer.stats['samples_per_pixel'], 0)
+
+    def test_target_error(self):
+        """Rendering stops when estimated error meets the target."""
+        renderer = _small_renderer(samples_per_pixel=1000, target_error=1e6)
+        output = renderer.render()
+        self.assertEqual(renderer.stats['stop_reason'], 'target_error')
+        self.assertEqual(renderer.stats['samples_per_pixel'], 2)
+        self.assertEqual(output.total_sample_count(), 8 * 6 * 2)
+        self.assertLessEqual(renderer.stats['estimated_error'], 1e6)
+
+    def test_sample_limit(self):
+        """Rendering stops after given number of samples by default."""
+        renderer = _small_renderer(samples_per_pixel=3)
+        renderer.render()
+        self.assertEqual(renderer.stats['stop_reason'], 'samples')
+        self.assertEqual(renderer.stats['samples_per_pixel'], 3)
+        self.assertTrue(renderer.stats['estimated_error'] is None)
+
+
+class ProgressiveRenderingTests(unittest.TestCase):
+    """Tests for multi-resolution progressive rendering."""
+
+    def test_progressive_levels(self):
+        """Reduced resolution levels are emitted upsampled before full
+           resolution refinement."""
+        renderer = _small_renderer(width=16, height=8, progressive_levels=[8, 4])
+        emitted = []
+        output = renderer.render_progressive( \
+            lambda img, label: emitted.append((label, img.width, img.height,
+                                               img.total_sample_count())))
+        self.assertEqual(emitted[0], ('level8', 16, 8, 16 * 8))
+        self.assertEqual(emitted[1], ('level4', 16, 8, 16 * 8))
+        self.assertEqual([item[0] for item in emitted[2:]], ['progress', 'progress'])
+        self.assertEqual(output.total_sample_count(), 16 * 8 * 2)
+
+    def test_upsampling(self):
+        """Upsampling interpolates colours between pixel centres."""
+        img = AccumulableImage(2, 1)
+        img.add_samples(0, 0, Vec3(0, 0, 0), 1)
+        img.add_samples(1, 0, Vec3(1, 1, 1), 3)
+        big = img.upsampled(4, 2)
+        self.assertEqual(big[0, 0], Vec3())
+        self.assertEqual(big[1, 1], Vec3.full(0.25))
+        self.assertEqual(big[2, 0], Vec3.full(0.75))
+        self.assertEqual(big[3, 1], Vec3.full(1))
+        self.assertEqual(big.sample_count_at((3, 0)), 3)
+
+
+class AovRenderingTests(unittest.TestCase):
+    """Tests for vectorized AOV rendering."""
+
+    def test_aov_buffers(self):
+        """AOV buffers match scalar first hits."""
+        renderer = _small_renderer(width=12, height=10)
+        buffers = renderer.render_aov_buffers()
+        for x_pos in range(12):
+            for y_pos in range(10):
+                #pylint: disable=protected-access
+                ray = renderer.camera._ray_from_unit(2.0 * (x_pos + 0.5) / 12 - 1.0,
+                                                     2.0 * (y_pos + 0.5) / 10 - 1.0)
+                hit = renderer.scene.intersect_ex(ray)
+                if hit is None:
+                    self.assertEqual(buffers.primitive_id[x_pos, y_pos], -1)
+                    self.assertEqual(Vec3.from_array(buffers.albedo[x_pos, y_pos]),
+                                     renderer.scene.environment_colour)
+                    continue
+                self.assertEqual(Vec3.from_array(buffers.albedo[x_pos, y_pos]),
+                                 hit['material'].preview_colour())
+                self.assertEqual(Vec3.from_array(buffers.normal[x_pos, y_pos]),
+                                 hit['hit_record'].normal)
+                self.assertAlmostEqual(buffers.depth[x_pos, y_pos], hit['hit_record'].distance)
+        self.assertEqual(buffers.primitive_id[6, 5], 1)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            buffers.save_as_npz(os.path.join(tmpdir, 'aov.npz'))
+            loaded = AovBuffers.load_npz(os.path.join(tmpdir, 'aov.npz'))
+            self.assertTrue(np.array_equal(loaded.primitive_id, buffers.primitive_id))
+            buffers.save_as_pngs(os.path.join(tmpdir, 'aov'))
+            self.assertTrue(os.path.exists(os.path.join(tmpdir, 'aov_normal.png')))
+
+    def test_instance_albedo(self):
+        """Albedo of instances of meshes of many materials is resolved per
+           hit."""
+        desc = instanced_spheres(3, 0, 100)
+        desc.arrays.mesh_face_materials[0][::2] = 3
+        renderer = desc.create_renderer({'width': 16, 'height': 12, 'max_cpus': 1})
+        self.assertEqual([prim.material is None for prim in renderer.scene.primitives],
+                         [False, False, True, True, False])
+        buffers = renderer.render_aov_buffers()
+        colours = set()
+        for x_pos in range(16):
+            for y_pos in range(12):
+                if buffers.primitive_id[x_pos, y_pos] not in (2, 3):
+                    continue
+                #pylint: disable=protected-access
+                ray = renderer.camera._ray_from_unit(2.0 * (x_pos + 0.5) / 16 - 1.0,
+                                                     2.0 * (y_pos + 0.5) / 12 - 1.0)
+                hit = renderer.scene.intersect_ex(ray)
+                self.assertTrue(Vec3.from_array(buffers.albedo[x_pos, y_pos]).isclose( \
+                    hit['material'].preview_colour()))
+                colours.add(tuple(buffers.albedo[x_pos, y_pos]))
+        self.assertEqual(len(colours), 2)
+
+    def test_preview_render(self):
+        """Preview rendering accumulates albedo of first hits."""
+        renderer = _small_renderer(preview=True, samples_per_pixel=3)
+        output = renderer.render()
+        self.assertEqual(output.total_sample_count(), 8 * 6 * 3)
+        self.assertEqual(output[4, 3], Vec3(0.5, 0.2, 0.2))
+
+
+class DenoisingTests(unittest.TestCase):
+    """Tests for AOV-guided denoising."""
+
+    def test_denoise_synthetic(self):
+        """Denoising reduces noise without blurring across geometry edges."""
+        aovs = AovBuffers(32, 32)
+        aovs.albedo[:] = 0.5
+        aovs.normal[:16] = [0, 0, -1]
+        aovs.normal[16:] = [-1, 0, 0]
+        aovs.depth[:] = 5.0
+        aovs.primitive_id[:16] = 0
+        aovs.primitive_id[16:] = 1
+
+        truth = np.zeros((32, 32, 3))
+        truth[:16] = 0.5
+        truth[16:] = 0.1
+        noise_var = 0.01
+        noisy = truth + np.random.default_rng(0).normal(0, np.sqrt(noise_var), truth.shape)
+
+        result = denoise(noisy, np.full(truth.shape, noise_var), aovs)
+        self.assertLess(np.mean((result - truth) ** 2), np.mean((noisy - truth) ** 2) / 10)
+        self.assertAlmostEqual(np.mean(result[15]), 0.5, delta=0.05)
+        self.assertAlmostEqual(np.mean(result[16]), 0.1, delta=0.05)
+
+    def test_denoise_render(self):
+        """Renderer tracks variance for denoising."""
+        renderer = _small_renderer(denoise=True)
+        output = renderer.render()
+        result = denoise_image(output, renderer.render_aov_buffers())
+        self.assertEqual(result.shape, (8, 6, 3))
+        self.assertTrue(np.all(np.isfinite(result)))
+
+
+def _queue_worker(path, worker):
+    """Renders tiles from job queue at given path in a worker process."""
+    run_queue_worker(JobQueue(path), lambda _, params: _small_renderer(**params), worker)
+
+
+class JobQueueTests(unittest.TestCase):
+    """Tests for persistent render job queue."""
+
+    def test_submit_and_collect(self):
+        """Tiles of submitted jobs are claimed, rendered and merged."""
+        with tempfile.TemporaryDirectory() as path:
+            queue = JobQueue(os.path.join(path, 'jobs.db'), checkpoint_tiles=3)
+            job_id = queue.submit('small', _small_renderer(tile_size=4), 'out.png')
+            self.assertEqual(queue.job(job_id)['tiles'], 8)
+            self.assertEqual(run_queue_worker(queue, lambda _, p: _small_renderer(**p)), 8)
+            self.assertEqual(queue.job(job_id)['status'], 'done')
+            self.assertTrue(np.all(queue.result(job_id).sample_counts == 2))
+            self.assertTrue(queue.claim('worker') is None)
+            queue.close()
+
+    def test_expired_lease(self):
+        """Tiles with expired leases are re-issued and stale results are
+           discarded."""
+        with tempfile.TemporaryDirectory() as path:
+            queue = JobQueue(os.path.join(path, 'jobs.db'), lease_time=0.0)
+            renderer = _small_renderer(tile_size=8, samples_per_pixel=1)
+            job_id = queue.submit('small', renderer)
+            claimed = queue.claim('first')
+            time.sleep(0.01)
+            self.assertEqual(queue.claim('second')[:2], claimed[:2])
+            image = renderer.render_tile(claimed[2])
+            self.assertFalse(queue.complete('first', job_id, claimed[1], image))
+            self.assertTrue(queue.complete('second', job_id, claimed[1], image))
+            self.assertEqual(queue.result(job_id).total_sample_count(), 48)
+            queue.close()
+
+    def test_resume_after_kill(self):
+        """Rendering resumes after worker process is killed."""
+        with tempfile.TemporaryDirectory() as path:
+            db_path = os.path.join(path, 'jobs.db')
+            queue = JobQueue(db_path, checkpoint_tiles=2)
+            job_id = queue.submit('small', _small_renderer(tile_size=2, samples_per_pixel=4))
+            worker = Process(target=_queue_worker, args=(db_path, 'killed'))
+            worker.start()
+            while queue.job(job_id)['tiles_done'] < 5:
+                time.sleep(0.01)
+            os.kill(worker.pid, signal.SIGKILL)
+            worker.join()
+
+            run_queue_worker(queue, lambda _, p: _small_renderer(**p), 'killed')
+            self.assertEqual(queue.job(job_id)['status'], 'done')
+            self.assertTrue(np.all(queue.result(job_id).sample_counts == 4))
+            queue.close()
+
+
+def _service_factory(_, params):
+    """Creates renderer for render service tests."""
+    return _small_renderer(**params)
+
+async def _http_request(address, method, path, data=None):
+    """Sends HTTP request to given address and returns response headers and
+       body."""
+    reader, writer = await asyncio.open_connection(*address)
+    body = json.dumps(data).encode() if data is not None else b''
+    writer.write('{} {} HTTP/1.1\r\nContent-Length: {}\r\n\r\n'.format( \
+        method, path, len(body)).encode() + body)
+    response = await reader.read()
+    writer.close()
+    headers, body = response.split(b'\r\n\r\n', 1)
+    return headers.decode(), body
+
+
+class RenderServiceTests(unittest.TestCase):
+    """Tests for asyncio render service."""
+
+    _PARAMS = {'width': 8, 'height': 6, 'max_depth': 2, 'first_bounce_u_samples': 1,
+               'first_bounce_v_samples': 1}
+
+    def test_stream_render(self):
+        """Service streams png snapshot after each sampling pass."""
+        async def scenario():
+            service = RenderService(_service_factory, ['small'], 2)
+            address = await service.start()
+            headers, body = await _http_request( \
+                address, 'POST', '/render',
+                {'scene': 'small', 'params': dict(self._PARAMS, samples_per_pixel=3)})
+            _, scenes = await _http_request(address, 'GET', '/scenes')
+            bad_headers, _ = await _http_request(address, 'POST', '/render', {'scene': 'x'})
+            forbidden_headers, _ = await _http_request( \
+                address, 'POST', '/render',
+                {'scene': 'small', 'params': {'accumulation_path': '/tmp/ptrace'}})
+            await service.close()
+            return headers, body, json.loads(scenes), bad_headers + forbidden_headers
+
+        headers, body, scenes, bad_headers = asyncio.run(scenario())
+        self.assertTrue('multipart/x-mixed-replace' in headers)
+        self.assertEqual(body.count(b'\x89PNG'), 3)
+        self.assertTrue(b'X-Samples: 3' in body)
+        self.assertEqual(scenes, ['small'])
+        self.assertEqual(bad_headers.count('HTTP/1.1 400'), 2)
+
+    def test_seeded_render(self):
+        """Seeded requests stream the same snapshots, with passes seeded by
+           their indices."""
+        async def scenario():
+            service = RenderService(_service_factory, ['small'], 1)
+            address = await service.start()
+            bodies = []
+            for _ in range(2):
+                _, body = await _http_request( \
+                    address, 'POST', '/render',
+                    {'scene': 'small', 'params': dict(self._PARAMS, samples_per_pixel=2,
+                                                      seed=3)})
+                bodies.append(body)
+            await service.close()
+            return bodies
+
+        bodies = asyncio.run(scenario())
+        self.assertEqual(bodies[0], bodies[1])
+        snapshots = [part.split(b'\r\n\r\n', 1)[1] for part in bodies[0].split(b'--ptrace-frame')
+                     if b'\x89PNG' in part]
+        self.assertEqual(len(snapshots), 2)
+        self.assertNotEqual(snapshots[0], snapshots[1])
+
+    def test_client_params(self):
+        """Clients may set only listed parameters within their limits."""
+        params = client_params(dict(self._PARAMS, seed=3, time_budget=2.5))
+        self.assertEqual((params['width'], params['seed'], params['max_cpus']), (8, 3, 1))
+        for requested in [{'accumulation_path': '/tmp/x'}, {'bvh_cache_path': '/tmp/x'},
+                          {'max_cpus': 64}, {'width': 100000}, {'samples_per_pixel': 0},
+                          {'scene_size': 10 ** 9}, {'photon_count': 10 ** 9},
+                          {'width': True}, {'height': 6.0}, {'time_budget': float('nan')},
+                          {'precision': 'half'}, []]:
+            with self.assertRaises(ValueError):
+                client_params(requested)
+
+    def test_cancel_render(self):
+        """Render stops early once cancelled."""
+        async def scenario():
+            service = RenderService(_service_factory, ['small'], 1)
+            address = await service.start()
+            reader, writer = await asyncio.open_connection(*address)
+            body = json.dumps({'scene': 'small',
+                               'params': dict(self._PARAMS, samples_per_pixel=1000)}).encode()
+            writer.write('POST /render HTTP/1.1\r\nContent-Length: {}\r\n\r\n'.format( \
+                len(body)).encode() + body)
+            headers = (await reader.readuntil(b'\r\n\r\n')).decode()
+            render_id = headers.split('X-Render-Id: ')[1].split('\r\n')[0]
+            await reader.readuntil(b'\x89PNG')
+            _, renders = await _http_request(address, 'GET', '/renders')
+            await _http_request(address, 'DELETE', '/renders/' + render_id)
+            rest = await reader.read()
+            writer.close()
+            await service.close()
+            return json.loads(renders), rest
+
+        renders, rest = asyncio.run(scenario())
+        self.assertEqual(len(renders), 1)
+        self.assertTrue(rest.endswith(b'--ptrace-frame--\r\n'))
+        self.assertLess(rest.count(b'\x89PNG'), 10)
+
+
+class RenderCacheTests(unittest.TestCase):
+    """Tests for content-addressed render cache."""
+
+    def test_render_key(self):
+        """Render key depends on scene, camera and image parameters only."""
+        key = render_key(_small_renderer(seed=1))
+        self.assertEqual(render_key(_small_renderer(seed=1)), key)
+        self.assertEqual(render_key(_small_renderer(seed=1, samples_per_pixel=7, max_cpus=2)),
+                         key)
+        self.assertNotEqual(render_key(_small_renderer(seed=2)), key)
+        self.assertNotEqual(render_key(_small_renderer(seed=1, max_depth=3)), key)
+        guided = render_key(_small_renderer(seed=1, guiding_fraction=0.5))
+        self.assertNotEqual(render_key(_small_renderer(seed=1, guiding_fraction=0.5,
+                                                       tiled=True)), guided)
+        renderer = _small_renderer(seed=1)
+        renderer.scene.primitives[1].radius = 0.9
+        self.assertNotEqual(render_key(renderer), key)
+        renderer = _small_renderer(seed=1)
+        renderer.scene.primitives[1].centre = Vec3(0.1, 0, 0)
+        self.assertNotEqual(render_key(renderer), key)
+        renderer = _small_renderer(seed=1)
+        renderer.scene.primitives[1].material.material_data.diffuse = Vec3(0.1, 0.2, 0.2)
+        self.assertNotEqual(render_key(renderer), key)
+
+    def test_cache_hit_and_resume(self):
+        """Cached renders are reused and resumed to reproduce seeded renders."""
+        with tempfile.TemporaryDirectory() as path:
+            cache = RenderCache(path)
+            first = cache.render(_small_renderer(seed=3, samples_per_pixel=2))
+            renderer = _small_renderer(seed=3, samples_per_pixel=2)
+            self.assertTrue(np.array_equal(cache.render(renderer).image, first.image))
+            self.assertEqual(renderer.stats['stop_reason'], 'cache')
+
+            resumed = cache.render(_small_renderer(seed=3, samples_per_pixel=4))
+            fresh = _small_renderer(seed=3, samples_per_pixel=4).render()
+            self.assertTrue(np.all(resumed.sample_counts == 4))
+            self.assertTrue(np.allclose(resumed.image, fresh.image))
+
+    def test_lru_eviction(self):
+        """Least recently used entries are evicted once cache is too large."""
+        with tempfile.TemporaryDirectory() as path:
+            cache = RenderCache(path)
+            image = _small_renderer(preview=True, samples_per_pixel=1).render()
+            cache.put('a', image)
+            cache.max_size = cache.size() * 2
+            os.utime(os.path.join(path, 'a.npz'), (0, 0))
+            cache.put('b', image)
+            os.utime(os.path.join(path, 'b.npz'), (1, 1))
+            self.assertTrue(cache.get('a') is not None)
+            cache.put('c', image)
+            self.assertEqual(sorted(key for key, _, _ in cache.entries()), ['a', 'c'])
+
+
+def _batch_factory(_, params):
+    """Creates renderer for batch tests."""
+    return _small_renderer(**params)
+
+
+class BatchRenderingTests(unittest.TestCase):
+    """Tests for batch rendering of many jobs in a single process."""
+
+    def test_scene_cache(self):
+        """Scenes are reused for jobs differing in non-geometry parameters."""
+        created = []
+        def factory(name, params):
+            created.append(name)
+            return _batch_factory(name, params)
+        scenes = SceneCache(factory)
+        first = scenes.renderer('small', dict(_small_renderer().params))
+        second = scenes.renderer('small', dict(_small_renderer(width=16, height=4).params))
+        scenes.renderer('small', dict(_small_renderer(scene_size=3).params))
+        self.assertEqual(len(created), 2)
+        self.assertTrue(second.scene is first.scene)
+        self.assertEqual(second.camera.aspect_ratio, 4.0)
+        self.assertEqual(first.camera.aspect_ratio, 8 / 6)
+
+    def test_shared_pool(self):
+        """Tiles rendered on shared pool match tiles rendered on a new one."""
+        renderer = _small_renderer(seed=5, max_cpus=2, tile_size=4)
+        expected = renderer.render()
+        pool = RenderPool(_batch_factory, 2)
+        try:
+            pool.attach(renderer, 'small')
+            output = renderer.render()
+        finally:
+            pool.close()
+        self.assertTrue(np.array_equal(output.image, expected.image))
+
+    #pylint: disable=protected-access
+
+    def test_worker_renderer(self):
+        """Shared pool workers create renderer once for all tiles of a job."""
+        created = []
+        def factory(name, params):
+            created.append(name)
+            return _batch_factory(name, params)
+        self.addCleanup(setattr, batch, '_WORKER_RENDERER', None)
+        self.addCleanup(setattr, batch, '_WORKER_SCENES', None)
+        batch._init_pool_worker(factory)
+
+        params = _small_renderer().params
+        key = json.dumps(params, sort_keys=True)
+        tiles = [make_tile((0, 4), (0, 6), 1, 0, 8, 6), make_tile((4, 8), (0, 6), 1, 0, 8, 6)]
+        batch._render_pool_tile_job('small', key, tiles[0])
+        renderer = batch._WORKER_RENDERER[1]
+        batch._render_pool_tile_job('small', key, tiles[1])
+        self.assertTrue(batch._WORKER_RENDERER[1] is renderer)
+        batch._render_pool_tile_job('small', json.dumps(dict(params, seed=1)), tiles[0])
+        self.assertFalse(batch._WORKER_RENDERER[1] is renderer)
+        self.assertEqual(len(created), 1)
+
+    #pylint: enable=protected-access
+
+    def test_run_batch(self):
+        """Batch renders all jobs from manifest and reports their timings."""
+        with tempfile.TemporaryDirectory() as path:
+            with open(os.path.join(path, 'params.json'), 'w', encoding='utf-8') as jsonfile:
+                json.dump(_small_renderer().params, jsonfile)
+            manifest_path = os.path.join(path, 'batch.json')
+            with open(manifest_path, 'w', encoding='utf-8') as jsonfile:
+                json.dump([{'scene': 'small', 'params': 'params.json', 'output': 'a.png'},
+                           {'scene': 'small', 'params': dict(_small_renderer().params,
+                                                             max_cpus=2),
+                            'output': 'b.png'},
+                           {'scene': 'small', 'params': {'width': 'x'}, 'output': 'c.png'}],
+                          jsonfile)
+            with self.assertRaises(AssertionError):
+                load_manifest(manifest_path)
+
+            with open(manifest_path, 'w', encoding='utf-8') as jsonfile:
+                json.dump([{'scene': 'small', 'params': 'params.json', 'output': 'a.png'},
+                           {'scene': 'small', 'params': dict(_small_renderer().params,
+                                                             max_cpus=2),
+                            'output': 'b.png'}], jsonfile)
+            jobs = load_manifest(manifest_path)
+            outputs = []
+            summary = run_batch(jobs, _batch_factory,
+                                lambda renderer, path: outputs.append((renderer.render(), path)))
+        self.assertEqual([path for _, path in outputs], [job['output'] for job in jobs])
+        self.assertEqual(summary['worker_count'], 2)
+        self.assertEqual([entry['samples_per_pixel'] for entry in summary['jobs']], [2, 2])
+        self.assertTrue(all(entry['total_time'] >= entry['render_time']
+                            for entry in summary['jobs']))
+
+
+class AnimationTests(unittest.TestCase):
+    """Tests for keyframed animation and rendering of frame sequences."""
+
+    _DESC = {'frames': 3,
+             'camera': {'orbit': [[0, 0], [2, 90]]},
+             'objects': [{'primitives': [1], 'translate': [[0, [0, 0, 0]], [2, [0, 1, 0]]]},
+                         {'range': [0, 1], 'rotate': [[1, 0], [2, 90]], 'pivot': [2, 2, 0]}]}
+
+    def test_keyframes(self):
+        """Keyframes are interpolated linearly and held outside key range."""
+        keys = Keyframes([[4, [0, 2, 0]], [0, [1, 0, 0]]])
+        self.assertTrue(np.allclose(keys.at(1), [0.75, 0.5, 0]))
+        self.assertTrue(np.allclose(keys.at(9), [0, 2, 0]))
+        self.assertEqual(Keyframes([[0, 10], [2, 20]]).at(-1), 10.0)
+
+    def test_scene_animator(self):
+        """Animator poses camera and primitives and restores rest pose."""
+        renderer = _small_renderer()
+        eye = renderer.camera.position.copy()
+        animator = SceneAnimator(renderer, Animation.from_dict(self._DESC))
+        animator.set_frame(2)
+        prims = renderer.scene.primitives
+        self.assertTrue(prims[1].centre.isclose(Vec3(0, 1, 0)))
+        self.assertTrue(prims[0].centre.isclose(Vec3(1, 2, 0)))
+        self.assertTrue(renderer.camera.position.isclose(Vec3(-3.2, 0, 0)))
+        self.assertTrue(renderer.camera.basis.z_axis.isclose(Vec3(1, 0, 0)))
+        animator.set_frame(0)
+        self.assertTrue(prims[1].centre.isclose(Vec3()))
+        self.assertTrue(prims[0].centre.isclose(Vec3(2, 2, -1)))
+        self.assertTrue(renderer.camera.position.isclose(eye))
+
+    def test_render_sequence(self):
+        """Frames are rendered in parallel, split into tiles when there are
+           fewer frames than workers."""
+        for frames, max_cpus in ((range(3), 1), (range(3), 2), ([1], 2)):
+            renderer = _small_renderer(max_cpus=max_cpus, tile_size=4)
+            images = {}
+            render_sequence(renderer, Animation.from_dict(self._DESC),
+                            images.__setitem__, frames)
+            self.assertEqual(sorted(images), list(frames))
+            for image in images.values():
+                self.assertTrue(np.all(image.sample_counts == 2))
+
+    def test_seeded_sequence(self):
+        """Seeded frames are reproducible regardless of splitting into tiles
+           and workers, with noise differing between frames."""
+        animation = Animation.from_dict({'frames': 2})
+        results = []
+        for frames, max_cpus in ((range(2), 1), (range(2), 2), ([0, 1], 3)):
+            renderer = _small_renderer(max_cpus=max_cpus, tile_size=4, seed=5)
+            images = {}
+            render_sequence(renderer, animation, images.__setitem__, frames)
+            results.append([images[frame].colours() for frame in range(2)])
+        for result in results[1:]:
+            self.assertTrue(all(np.array_equal(image, expected)
+                                for image, expected in zip(result, results[0])))
+        self.assertFalse(np.array_equal(results[0][0], results[0][1]))
+
+
+class IrradianceCacheTests(unittest.TestCase):
+    """Tests for irradiance caching of diffuse indirect lighting."""
+
+    def test_records(self):
+        """Records are reused only near their position and for similar
+           normals, interpolated by their weights."""
+        cache = IrradianceCache(0.5, max_radius=1.0)
+        normal = Vec3(0, 1, 0)
+        cache.add(Vec3(0, 0, 0), normal, Vec3(1, 1, 1), 1.0)
+        cache.add(Vec3(0.2, 0, 0), normal, Vec3(3, 3, 3), 1.0)
+        self.assertTrue(cache.lookup(Vec3(0.1, 0, 0), normal).isclose(Vec3(2, 2, 2)))
+        self.assertTrue(cache.lookup(Vec3(-0.1, 0, 0), normal).isclose(Vec3(1.5, 1.5, 1.5)))
+        self.assertTrue(cache.lookup(Vec3(0.8, 0, 0), normal) is None)
+        self.assertTrue(cache.lookup(Vec3(0, 0, 0), Vec3(1, 0, 0)) is None)
+        # records in front of the point are not reused
+        self.assertTrue(cache.lookup(Vec3(0, -0.1, 0), normal) is None)
+        self.assertEqual(len(cache), 2)
+
+    def test_rendering(self):
+        """Renderer with irradiance cache reuses records at secondary
+           bounces, converging to similar image, and rendering again
+           (starting with empty caches) reproduces seeded image."""
+        plain, cached, output = _render_with_feature( \
+            self, {'irradiance_cache_error': 0.5, 'irradiance_cache_samples': 16})
+        self.assertTrue(plain.irradiance_caches is None)
+        records = sum(len(cache) for cache in cached.irradiance_caches.values())
+        self.assertGreater(records, 0)
+        self.assertLess(records, 16 * 12 * 8)
+        self.assertEqual(set(cached.irradiance_caches), {2, 3})
+        self.assertTrue(np.array_equal(cached.render().colours(), output.colours()))
+        self.assertEqual(sum(len(cache) for cache in cached.irradiance_caches.values()),
+                         records)
+
+
+class PhotonMapTests(unittest.TestCase):
+    """Tests for photon mapping of caustics."""
+
+    def test_lookup(self):
+        """KD-tree lookups find the same photons as brute force search, and
+           irradiance is estimated from photons arriving at the surface."""
+        rng = np.random.default_rng(0)
+        positions = rng.uniform(-1.0, 1.0, (1000, 3))
+        directions = np.tile([0.0, -1.0, 0.0], (1000, 1))
+        photon_map = PhotonMap(positions, directions, np.ones((1000, 3)))
+        self.assertEqual(len(photon_map), 1000)
+        for point in rng.uniform(-1.0, 1.0, (20, 3)):
+            expected = np.linalg.norm(photon_map.positions - point, axis=1) <= 0.3
+            self.assertEqual(sorted(photon_map.nearby(point, 0.3).tolist()),
+                             np.flatnonzero(expected).tolist())
+
+        flat = PhotonMap(np.array([[0.0, 0.0, 0.0], [0.1, 0.0, 0.0], [0.0, 0.3, 0.0]]),
+                         np.array([[0.0, -1.0, 0.0], [0.0, 1.0, 0.0], [0.0, -1.0, 0.0]]),
+                         np.ones((3, 3)))
+        # only the first photon arrives from above, close to the plane
+        self.assertTrue(flat.irradiance(Vec3(), Vec3(0, 1, 0), 0.5).isclose( \
+            Vec3(1, 1, 1) / (np.pi * 0.25)))
+        self.assertTrue(PhotonMap(np.zeros((0, 3)), np.zeros((0, 3)), np.zeros((0, 3))) \
+                        .irradiance(Vec3(), Vec3(0, 1, 0), 0.5).isclose(Vec3()))
+
+    def test_tracing(self):
+        """Photons reflected by mirror sphere carry power intercepted by it
+           from small light, and are stored only at diffuse surfaces."""
+        scb = SceneBuilder(Vec3())
+        scb.add_sphere(Vec3(0, 0, -3), 0.01, MaterialData.make_light(Vec3(1, 1, 1)))
+        scb.add_sphere(Vec3(), 1, MaterialData.make_reflective(Vec3(0.5, 0.5, 0.5), 1.0, 0.0))
+        scb.add_sphere(Vec3(), 10, MaterialData.make_diffuse(Vec3(0.5, 0.5, 0.5)))
+        photon_map = trace_photons(scb.scene, 20000, 4, np.random.default_rng(0))
+        # photons emitted into the light are dropped
+        self.assertGreater(len(photon_map), 9000)
+        self.assertTrue(np.allclose(np.linalg.norm(photon_map.positions, axis=1), 10.0))
+        power = 4.0 * np.pi ** 2 * 0.01 ** 2
+        expected = power * (1.0 - np.sqrt(1.0 - 1.0 / 9.0)) / 2.0
+        self.assertTrue(np.allclose(photon_map.powers.sum(axis=0), expected, rtol=0.02))
+
+        # no caustics without specular primitives
+        scb = SceneBuilder(Vec3())
+        scb.add_sphere(Vec3(0, 0, -3), 0.5, MaterialData.make_light(Vec3(1, 1, 1)))
+        scb.add_sphere(Vec3(), 1, MaterialData.make_diffuse(Vec3(0.5, 0.5, 0.5)))
+        self.assertEqual(len(trace_photons(scb.scene, 1000, 4)), 0)
+
+    def test_rendering(self):
+        """Renderer with photon map renders caustics of the scene."""
+        params = {'width': 12, 'height': 9, 'preview': False, 'samples_per_pixel': 2,
+                  'max_cpus': 1, 'max_depth': 3, 'first_bounce_u_samples': 1,
+                  'first_bounce_v_samples': 1, 'seed': 1}
+        desc = caustic_cup(8)
+        self.assertTrue(desc.create_renderer(params).photon_map is None)
+        renderer = desc.create_renderer(dict(params, photon_count=20000, photon_radius=0.1))
+        self.assertGreater(len(renderer.photon_map), 1000)
+        colours = renderer.render().colours()
+        self.assertTrue(np.all(np.isfinite(colours)))
+        self.assertGreater(colours.mean(), 0.0)
+
+
+class PathGuidingTests(unittest.TestCase):
+    """Tests for online path guiding."""
+
+    def test_distributions(self):
+        """Learned distributions are normalised densities concentrated around
+           directions of recorded radiance, and cells with many records are
+           split."""
+        guide = PathGuide((np.full(3, -1.0), np.full(3, 1.0)), 8, 100)
+        position = Vec3(0.5, 0.5, 0.5)
+        cell = guide.cell(position)
+        self.assertFalse(guide.is_guiding(cell))
+        bright = Vec3(0, 1, 1).normalised()
+        rng = np.random.default_rng(0)
+        for direction in rng.normal(size=(150, 3)):
+            guide.record(cell, Vec3(arr=direction / np.linalg.norm(direction)), 0.1)
+            guide.record(cell, bright, 10.0)
+        guide.update()
+        self.assertEqual(len(guide), 2)
+        cell = guide.cell(position)
+        self.assertTrue(guide.is_guiding(cell))
+        self.assertNotEqual(guide.cell(Vec3(-0.5, 0, 0)), cell)
+
+        # density integrates to one over the sphere (bins of equal area)
+        directions = rng.normal(size=(4000, 3))
+        pdfs = [guide.pdf(cell, Vec3(arr=direction / np.linalg.norm(direction)))
+                for direction in directions]
+        self.assertAlmostEqual(np.mean(pdfs) * 4.0 * np.pi, 1.0, delta=0.1)
+        samples = [guide.sample(cell, *rng.random(2)) for _ in range(200)]
+        self.assertTrue(all(abs(sample.length() - 1.0) < 1e-9 for sample in samples))
+        self.assertGreater(np.mean([sample.dot(bright) > 0.7 for sample in samples]), 0.8)
+
+    def test_rendering(self):
+        """Guided renderer learns distributions across passes, converging to
+           similar image, and once trained lowers variance of samples of the
+           same seeded passes."""
+        plain, guided, _ = _render_with_feature( \
+            self, {'guiding_fraction': 0.5, 'guiding_split_records': 200})
+        self.assertTrue(plain.path_guide is None)
+        self.assertGreater(len(guided.path_guide), 1)
+        self.assertTrue(any(guided.path_guide.is_guiding(cell)
+                            for cell in range(len(guided.path_guide))))
+
+        variances = []
+        for renderer in (plain, guided):
+            renderer.reset_learned_state()
+            for sample_ix in range(8):
+                renderer.render_pass(AccumulableImage(16, 12), sample_ix=sample_ix)
+            output = AccumulableImage(16, 12, track_variance=True)
+            for sample_ix in range(8, 24):
+                renderer.render_pass(output, sample_ix=sample_ix)
+            variances.append(output.variances().mean())
+        self.assertLess(variances[1], 0.8 * variances[0])
+
+
+class PrimaryHitCacheTests(unittest.TestCase):
+    """Tests for reusing cached primary hits across sampling passes."""
+
+    def test_cached_hits(self):
+        """Cached hits of camera rays match scalar intersections, with
+           materials of instanced meshes resolved, and hits cached for tiles
+           match those of the whole image."""
+        params = {'width': 12, 'height': 9, 'preview': False, 'max_cpus': 1,
+                  'primary_hit_strata': 2, 'seed': 1}
+        renderer = instanced_spheres(6, 0, 50).create_renderer(params)
+        rays, hits, material_ids, materials = renderer.cached_primary_hits(5)
+        self.assertTrue(renderer.cached_primary_hits(1)[0] is rays)
+        self.assertEqual(sorted(renderer.primary_hits), [(1, 0, 12, 0, 9)])
+        self.assertEqual(len(rays), 12 * 9)
+        self.assertGreater(np.count_nonzero(hits.hit_mask()), 12 * 9 // 2)
+        self.assertTrue(np.array_equal(material_ids >= 0, hits.hit_mask()))
+        for index in range(len(rays)):
+            hit = renderer.scene.intersect_ex(Ray(Vec3(arr=rays.origins[index].copy()),
+                                                  Vec3(arr=rays.directions[index].copy())))
+            if hit is not None:
+                self.assertAlmostEqual(hit['hit_record'].distance, hits.distances[index])
+                self.assertTrue(hit['material'] is materials[material_ids[index]])
+
+        tile_rays, tile_hits, _, _ = renderer.cached_primary_hits(5, (4, 8), (3, 9))
+        indices = [x_pos * 9 + y_pos for x_pos in range(4, 8) for y_pos in range(3, 9)]
+        self.assertTrue(np.allclose(tile_rays.directions, rays.directions[indices]))
+        self.assertTrue(np.allclose(tile_hits.distances, hits.distances[indices]))
+
+    @staticmethod
+    def _camera_ray_count(renderer):
+        """Renders again with given renderer, returning number of scene
+           intersections of rays starting at the camera."""
+        scene = renderer.scene
+        intersect_ex = scene.intersect_ex
+        count = [0]
+
+        def counting_intersect_ex(ray):
+            count[0] += ray.origin.isclose(renderer.camera.position)
+            return intersect_ex(ray)
+
+        scene.intersect_ex = counting_intersect_ex
+        try:
+            renderer.render()
+        finally:
+            del scene.intersect_ex
+        return count[0]
+
+    def test_rendering(self):
+        """Replaying primary hits converges to similar image, both in regular
+           and tiled rendering, without intersecting camera rays again."""
+        for extra in [{}, {'tiled': True, 'tile_size': 8}]:
+            plain, cached, output = _render_with_feature( \
+                self, dict({'primary_hit_strata': 2}, **extra), max_depth=3)
+            self.assertTrue(plain.primary_hits is None)
+            self.assertTrue(np.all(output.sample_counts == 8))
+            self.assertEqual(sorted({key[0] for key in cached.primary_hits}), [0, 1, 2, 3])
+            # tiles trace (and cache) hits of their own pixels only
+            self.assertEqual(len(cached.primary_hits), 16 if extra else 4)
+            self.assertEqual(sum(len(entry[0]) for entry in cached.primary_hits.values()),
+                             16 * 12 * 4)
+            self.assertEqual([self._camera_ray_count(renderer) for renderer in (plain, cached)],
+                             [16 * 12 * 8, 0])
+
+
+class AutoTuningTests(unittest.TestCase):
+    """Tests for auto-tuning of performance parameters."""
+
+    def test_tune(self):
+        """Tuning picks fastest candidates for all tuned parameters."""
+        renderer = _small_renderer(width=16, height=12)
+        tuned = tune(renderer, batch_sizes=(16, 64), tile_sizes=(4, 8), worker_counts=[1])
+        self.assertEqual(sorted(tuned), ['max_cpus', 'ray_batch_size', 'tile_size'])
+        self.assertTrue(tuned['ray_batch_size'] in (16, 64))
+        self.assertTrue(tuned['tile_size'] in (4, 8))
+        self.assertEqual(tuned['max_cpus'], 1)
+        tuned = tune(renderer, batch_sizes=(16,), tile_sizes=(4, 8), worker_counts=[1, 2])
+        self.assertTrue(tuned['max_cpus'] in (1, 2))
+
+    def test_tuning_cache(self):
+        """Tuned parameters are stored by host and scene class, and applied
+           unless given explicitly."""
+        renderer = _small_renderer()
+        self.assertEqual(scene_class('data/scene.json', renderer), 'scene:1e0')
+        self.assertEqual(scene_class('sphere_field', sphere_field(150, 0).create_renderer()),
+                         'sphere_field:1e2')
+        with tempfile.TemporaryDirectory() as path:
+            cache = TuningCache(os.path.join(path, 'tuning', 'tuning.json'))
+            self.assertTrue(cache.get('scene:1e0') is None)
+            cache.put('scene:1e0', {'ray_batch_size': 256, 'tile_size': 8, 'max_cpus': 2,
+                                    'seed': 3})
+            cache.put('scene:1e0', {'ray_batch_size': 512}, host='other')
+            self.assertEqual(cache.get('scene:1e0'),
+                             {'ray_batch_size': 256, 'tile_size': 8, 'max_cpus': 2})
+            self.assertEqual(apply_tuning(renderer, 'scene:1e0', {'max_cpus'}, cache),
+                             {'ray_batch_size': 256, 'tile_size': 8})
+            self.assertEqual((renderer.params['tile_size'], renderer.params['max_cpus']), (8, 1))
+            self.assertEqual(apply_tuning(renderer, 'scene:1e3', (), cache), {})
+            for contents in ('{"host": {"scene:1e0": ', '[1, 2]'):
+                with open(cache.path, 'w', encoding='utf-8') as jsonfile:
+                    jsonfile.write(contents)
+                with self.assertWarns(UserWarning):
+                    self.assertEqual(apply_tuning(renderer, 'scene:1e0', (), cache), {})
+            with self.assertWarns(UserWarning):
+                cache.put('scene:1e0', {'tile_size': 16})
+            self.assertEqual(cache.get('scene:1e0'), {'tile_size': 16})
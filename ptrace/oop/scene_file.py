@@ -0,0 +1,456 @@
+"""Loading of scenes from declarative json description files and their compact
+   binary (npz) form.
+
+   Json scene file contains:
+     "camera": {"eye": [x, y, z], "look_at": [x, y, z], "up": [x, y, z],
+                "vertical_fov": degrees,
+                "focus": {"point": [x, y, z], "aperture_radius": r}}
+     "environment": [r, g, b]
+     "materials": {name: {"emission": [r, g, b], "diffuse": [r, g, b],
+                          "refraction_index": n, "reflectivity": r,
+                          "reflection_cone_angle": radians}}
+     "spheres": [{"centre": [x, y, z], "radius": r, "material": name}]
+     "triangles": [{"vertices": [[x, y, z] * 3], "normals": [[x, y, z] * 3],
+                    "material": name}]
+     "meshes": [{"path": "mesh.obj", "material": name,
+                 "translate": [x, y, z], "scale": s}]
+     "instances": [{"path": "mesh.obj", "material": name,
+                    "transform": [[x, x, x, x], [y, y, y, y], [z, z, z, z]]}]
+   where materials of primitives may be given by name or inline, normals of
+   triangles are optional and mesh paths (wavefront obj files or binary mesh
+   files) are relative to the scene file. Meshes are transformed into scene
+   triangles, while instances of the same mesh file share its arrays,
+   placed by affine transform given by 3x4 matrix.
+
+   Binary form stores camera, environment and materials as json header and
+   all primitives as arrays (triangles as indexed vertex and normal arrays),
+   so that large scenes load without parsing text per primitive.
+
+   Binary mesh file is a single (versioned) npy byte array holding header
+   (magic, version and counts) followed by vertex, normal and face arrays.
+   It is loaded memory-mapped, so that meshes open without parsing. Arrays
+   of instanced meshes stay memory-mapped in the scene (see Mesh), so worker
+   processes forked from the loading one share their pages. Obj meshes
+   referenced by scene files are converted into binary mesh files stored
+   next to them (and used as long as they are newer than the obj file)."""
+
+import json
+import os
+import tempfile
+import zipfile
+
+import numpy as np
+
+from .vector import Vec3
+from .scene_settings import MaterialData
+from .oop_material import material_from_data
+from .oop_primitives import Sphere, Triangle
+from .oop_scene import Scene, Mesh, Instance
+from .camera import Camera
+from .oop_renderer import Renderer, DEFAULT_RENDERER_PARAMS
+
+
+SCENE_FILE_EXTS = ('.json', '.npz')
+
+MESH_FILE_EXT = '.mesh'
+MESH_FILE_VERSION = 1
+
+_MESH_FILE_MAGIC = b'PTMESH\0\0'
+# magic followed by version, vertex, normal and face counts
+_MESH_HEADER_SIZE = len(_MESH_FILE_MAGIC) + 4 * 8
+
+# per mesh arrays of instanced meshes (stored in binary scene files with mesh
+# index suffixes)
+_MESH_ARRAYS = ('mesh_vertices', 'mesh_normals', 'mesh_faces', 'mesh_face_materials')
+
+_MATERIAL_FIELDS = ('emission', 'diffuse', 'refraction_index', 'reflectivity',
+                    'reflection_cone_angle')
+
+
+def is_scene_file(path):
+    """Checks whether given path names existing scene file (binary scene files
+       are recognised by contents, as they may be saved under any name)."""
+    return os.path.isfile(path) and \
+           (os.path.splitext(path)[1] in SCENE_FILE_EXTS or zipfile.is_zipfile(path))
+
+def material_data_from_dict(desc):
+    """Creates material data from its json description."""
+    assert set(desc) <= set(_MATERIAL_FIELDS), "Unknown material field"
+    kwargs = dict(desc)
+    for name in ('emission', 'diffuse'):
+        if name in kwargs:
+            kwargs[name] = Vec3(*kwargs[name])
+    return MaterialData(**kwargs)
+
+def load_obj_mesh(path):
+    """Loads triangle mesh from wavefront obj file (polygons are split into
+       triangle fans). Returns arrays of vertices, normals (empty if not all
+       faces have them) and faces (vertex index triples)."""
+    positions = []
+    obj_normals = []
+    corners = []
+    with open(path, 'r', encoding='utf-8') as objfile:
+        for line in objfile:
+            parts = line.split()
+            if not parts:
+                continue
+            if parts[0] == 'v':
+                positions.append([float(val) for val in parts[1:4]])
+            elif parts[0] == 'vn':
+                obj_normals.append([float(val) for val in parts[1:4]])
+            elif parts[0] == 'f':
+                refs = []
+                for part in parts[1:]:
+                    indices = part.split('/')
+                    pos_ix = int(indices[0])
+                    nrm_ix = int(indices[2]) if len(indices) > 2 and indices[2] else 0
+                    refs.append((pos_ix - 1 if pos_ix > 0 else len(positions) + pos_ix,
+                                 nrm_ix - 1 if nrm_ix > 0 else
+                                 (len(obj_normals) + nrm_ix if nrm_ix < 0 else -1)))
+                for i in range(1, len(refs) - 1):
+                    corners.extend([refs[0], refs[i], refs[i + 1]])
+
+    positions = np.array(positions, dtype='double').reshape(-1, 3)
+    corners = np.array(corners, dtype='int64').reshape(-1, 2)
+    if len(corners) == 0 or np.any(corners[:, 1] < 0):
+        return positions, np.zeros((0, 3)), corners[:, 0].reshape(-1, 3).astype('int32')
+
+    # vertices with distinct position and normal pairs
+    pairs, faces = np.unique(corners, axis=0, return_inverse=True)
+    obj_normals = np.array(obj_normals, dtype='double').reshape(-1, 3)
+    return positions[pairs[:, 0]], obj_normals[pairs[:, 1]], \
+           faces.reshape(-1, 3).astype('int32')
+
+def save_mesh_file(path, vertices, normals, faces):
+    """Saves mesh arrays (as returned by load_obj_mesh) into binary mesh file
+       (replacing it atomically)."""
+    vertices = np.ascontiguousarray(vertices, dtype='<f8').reshape(-1, 3)
+    normals = np.ascontiguousarray(normals, dtype='<f8').reshape(-1, 3)
+    faces = np.ascontiguousarray(faces, dtype='<i4').reshape(-1, 3)
+    header = np.array([MESH_FILE_VERSION, len(vertices), len(normals), len(faces)], dtype='<i8')
+
+    handle, temp_path = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(path) or '.')
+    os.close(handle)
+    try:
+        data = np.lib.format.open_memmap(temp_path, mode='w+', dtype='uint8', shape=( \
+            _MESH_HEADER_SIZE + vertices.nbytes + normals.nbytes + faces.nbytes,))
+        offset = 0
+        for part in (np.frombuffer(_MESH_FILE_MAGIC, dtype='uint8'), header, vertices,
+                     normals, faces):
+            data[offset:offset + part.nbytes] = part.reshape(-1).view('uint8')
+            offset += part.nbytes
+        data.flush()
+        del data
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+def load_mesh_file(path):
+    """Loads mesh arrays from binary mesh file. Returned arrays are read-only
+       views of memory-mapped file."""
+    data = np.load(path, mmap_mode='r')
+    magic_size = len(_MESH_FILE_MAGIC)
+    assert data.dtype == np.uint8 and data.ndim == 1 and \
+           data[:magic_size].tobytes() == _MESH_FILE_MAGIC, "Not a binary mesh file"
+    version, vertex_count, normal_count, face_count = \
+        data[magic_size:_MESH_HEADER_SIZE].view('<i8').tolist()
+    assert version == MESH_FILE_VERSION, "Unsupported mesh file version"
+
+    arrays = []
+    offset = _MESH_HEADER_SIZE
+    for count, dtype in ((vertex_count, '<f8'), (normal_count, '<f8'), (face_count, '<i4')):
+        size = count * 3 * np.dtype(dtype).itemsize
+        arrays.append(data[offset:offset + size].view(dtype).reshape(count, 3))
+        offset += size
+    assert offset == len(data), "Truncated mesh file"
+    return tuple(arrays)
+
+def load_mesh(path):
+    """Loads mesh arrays from obj or binary mesh file. Obj meshes are cached
+       as binary mesh files next to them (if they can be written)."""
+    if path.endswith(MESH_FILE_EXT):
+        return load_mesh_file(path)
+    cache_path = path + MESH_FILE_EXT
+    if os.path.isfile(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(path):
+        try:
+            return load_mesh_file(cache_path)
+        except (AssertionError, ValueError):
+            pass
+    mesh = load_obj_mesh(path)
+    try:
+        save_mesh_file(cache_path, *mesh)
+    except OSError:
+        pass
+    return mesh
+
+
+#pylint: disable=too-many-instance-attributes
+
+class SceneArrays():
+    """Array representation of scene primitives, i.e. spheres (centres, radii)
+       and indexed triangle meshes (vertices, per vertex normals and faces)
+       with material indices. Normals of vertices of meshes without normals
+       are NaNs (such triangles use their face normals).
+
+       Instanced meshes are not part of the scene themselves, but of its
+       instances (given by mesh indices, transforms and material indices, -1
+       for materials of the mesh). Their arrays are kept in per mesh lists as
+       given (e.g. memory-mapped), without copying."""
+
+    sphere_centres = None
+    sphere_radii = None
+    sphere_materials = None
+    vertices = None
+    normals = None
+    faces = None
+    face_materials = None
+    mesh_vertices = None
+    mesh_normals = None
+    mesh_faces = None
+    mesh_face_materials = None
+    instance_meshes = None
+    instance_transforms = None
+    instance_materials = None
+
+    def __init__(self):
+        """Creates empty scene arrays."""
+        self.sphere_centres = np.zeros((0, 3))
+        self.sphere_radii = np.zeros(0)
+        self.sphere_materials = np.zeros(0, dtype='int32')
+        self.vertices = np.zeros((0, 3))
+        self.normals = np.zeros((0, 3))
+        self.faces = np.zeros((0, 3), dtype='int32')
+        self.face_materials = np.zeros(0, dtype='int32')
+        self.mesh_vertices = []
+        self.mesh_normals = []
+        self.mesh_faces = []
+        self.mesh_face_materials = []
+        self.instance_meshes = np.zeros(0, dtype='int32')
+        self.instance_transforms = np.zeros((0, 3, 4))
+        self.instance_materials = np.zeros(0, dtype='int32')
+
+    def add_spheres(self, centres, radii, materials):
+        """Adds spheres with given centres, radii and material indices."""
+        self.sphere_centres = np.concatenate([self.sphere_centres, centres])
+        self.sphere_radii = np.concatenate([self.sphere_radii, radii])
+        self.sphere_materials = np.concatenate([self.sphere_materials,
+                                                materials]).astype('int32')
+
+    def add_mesh(self, vertices, normals, faces, materials):
+        """Adds triangle mesh with given vertices, normals (array of the same
+           shape, or empty), faces and their material indices."""
+        if len(normals) != len(vertices):
+            normals = np.full(vertices.shape, np.nan)
+        self.faces = np.concatenate([self.faces, faces + len(self.vertices)]).astype('int32')
+        self.vertices = np.concatenate([self.vertices, vertices])
+        self.normals = np.concatenate([self.normals, normals])
+        self.face_materials = np.concatenate([self.face_materials,
+                                              materials]).astype('int32')
+
+    def add_instanced_mesh(self, vertices, normals, faces, materials):
+        """Adds triangle mesh (as in add_mesh, keeping given arrays) to be
+           placed in the scene by instances. Returns index of the mesh."""
+        self.mesh_vertices.append(vertices)
+        self.mesh_normals.append(normals if len(normals) == len(vertices)
+                                 else np.full(vertices.shape, np.nan))
+        self.mesh_faces.append(faces)
+        self.mesh_face_materials.append(np.asarray(materials, dtype='int32'))
+        return len(self.mesh_faces) - 1
+
+    def add_instances(self, meshes, transforms, materials):
+        """Adds instances of meshes with given indices, transforms (3x4
+           matrices) and material indices (-1 for materials of the mesh)."""
+        self.instance_meshes = np.concatenate([self.instance_meshes, meshes]).astype('int32')
+        self.instance_transforms = np.concatenate( \
+            [self.instance_transforms, np.asarray(transforms).reshape(-1, 3, 4)])
+        self.instance_materials = np.concatenate([self.instance_materials,
+                                                  materials]).astype('int32')
+
+#pylint: enable=too-many-instance-attributes
+
+
+class SceneDescription():
+    """Scene loaded from a file: its header (camera, environment colour and
+       materials descriptions) and primitive arrays."""
+
+    header = None
+    arrays = None
+
+    def __init__(self, header, arrays):
+        """Creates scene description of given header and arrays."""
+        self.header = header
+        self.arrays = arrays
+
+    @staticmethod
+    def load(path):
+        """Loads scene description from json or binary scene file (any file
+           not named as json one)."""
+        if path.endswith('.json'):
+            return SceneDescription.load_json(path)
+        return SceneDescription.load_binary(path)
+
+    #pylint: disable=too-many-locals
+
+    @staticmethod
+    def load_json(path):
+        """Loads scene description from json scene file."""
+        with open(path, 'r', encoding='utf-8') as jsonfile:
+            desc = json.load(jsonfile)
+        assert 'camera' in desc, "Missing scene camera"
+
+        materials = []
+        material_ixs = {}
+
+        def material_index(ref):
+            if isinstance(ref, str):
+                assert ref in desc.get('materials', {}), "Unknown material name"
+                if ref not in material_ixs:
+                    material_ixs[ref] = len(materials)
+                    materials.append(desc['materials'][ref])
+                return material_ixs[ref]
+            materials.append(ref)
+            return len(materials) - 1
+
+        arrays = SceneArrays()
+        spheres = desc.get('spheres', [])
+        arrays.add_spheres(np.array([sphere['centre'] for sphere in spheres],
+                                    dtype='double').reshape(-1, 3),
+                           np.array([sphere['radius'] for sphere in spheres], dtype='double'),
+                           [material_index(sphere['material']) for sphere in spheres])
+
+        triangles = desc.get('triangles', [])
+        nan_normals = np.full((3, 3), np.nan)
+        arrays.add_mesh(np.array([tri['vertices'] for tri in triangles],
+                                 dtype='double').reshape(-1, 3),
+                        np.array([tri.get('normals', nan_normals) for tri in triangles],
+                                 dtype='double').reshape(-1, 3),
+                        np.arange(3 * len(triangles)).reshape(-1, 3),
+                        [material_index(tri['material']) for tri in triangles])
+
+        for mesh in desc.get('meshes', []):
+            vertices, normals, faces = load_mesh( \
+                os.path.join(os.path.dirname(path), mesh['path']))
+            vertices = vertices * mesh.get('scale', 1.0) + \
+                       np.array(mesh.get('translate', [0.0, 0.0, 0.0]))
+            arrays.add_mesh(vertices, normals, faces,
+                            np.full(len(faces), material_index(mesh['material'])))
+
+        mesh_ixs = {}
+        for instance in desc.get('instances', []):
+            material = material_index(instance['material'])
+            if instance['path'] not in mesh_ixs:
+                vertices, normals, faces = load_mesh( \
+                    os.path.join(os.path.dirname(path), instance['path']))
+                mesh_ixs[instance['path']] = (arrays.add_instanced_mesh( \
+                    vertices, normals, faces, np.full(len(faces), material)), material)
+            mesh_ix, mesh_material = mesh_ixs[instance['path']]
+            arrays.add_instances([mesh_ix], [instance['transform']],
+                                 [-1 if material == mesh_material else material])
+
+        header = { \
+            'camera': desc['camera'],
+            'environment': desc.get('environment', [0.0, 0.0, 0.0]),
+            'materials': materials}
+        return SceneDescription(header, arrays)
+
+    #pylint: enable=too-many-locals
+
+    @staticmethod
+    def load_binary(path):
+        """Loads scene description from binary scene file."""
+        with np.load(path) as data:
+            header = json.loads(bytes(data['header']).decode('utf-8'))
+            arrays = SceneArrays()
+            for name in vars(arrays):
+                if name in data:
+                    setattr(arrays, name, data[name])
+            mesh_count = sum(1 for name in data.files if name.startswith('mesh_faces_'))
+            for name in _MESH_ARRAYS:
+                setattr(arrays, name, [data['{}_{}'.format(name, index)]
+                                       for index in range(mesh_count)])
+        return SceneDescription(header, arrays)
+
+    def save_binary(self, path):
+        """Saves scene description as binary scene file."""
+        header = np.frombuffer(json.dumps(self.header).encode('utf-8'), dtype='uint8')
+        arrays = {name: value for name, value in vars(self.arrays).items()
+                  if name not in _MESH_ARRAYS}
+        for name in _MESH_ARRAYS:
+            for index, value in enumerate(getattr(self.arrays, name)):
+                arrays['{}_{}'.format(name, index)] = value
+        # saved through file handle, as numpy appends npz suffix to other names
+        with open(path, 'wb') as npzfile:
+            np.savez(npzfile, header=header, **arrays)
+
+    def create_camera(self, width, height):
+        """Creates camera for image of given dimensions."""
+        desc = self.header['camera']
+        camera = Camera(Vec3(*desc['eye']), Vec3(*desc['look_at']), Vec3(*desc['up']),
+                        width, height, desc['vertical_fov'])
+        if 'focus' in desc:
+            camera.set_focus(Vec3(*desc['focus']['point']), desc['focus']['aperture_radius'])
+        return camera
+
+    def create_scene(self):
+        """Creates scene with primitives of the description (sharing material
+           objects between primitives made of the same material, and meshes
+           backed by arrays of the description between their instances)."""
+        materials = [material_from_data(material_data_from_dict(desc))
+                     for desc in self.header['materials']]
+        scene = Scene(Vec3(*self.header['environment']))
+        arrays = self.arrays
+
+        centres = arrays.sphere_centres.astype('double')
+        for index, radius in enumerate(arrays.sphere_radii.tolist()):
+            scene.add(Sphere(Vec3.from_array(centres[index]), radius,
+                             materials[arrays.sphere_materials[index]]))
+
+        for triangle in self._triangles(materials):
+            scene.add(triangle)
+
+        meshes = []
+        for mesh_arrays in zip(*[getattr(arrays, name) for name in _MESH_ARRAYS]):
+            meshes.append(Mesh(*mesh_arrays, materials))
+            meshes[-1].build_bvh()
+        for mesh_ix, transform, material in zip(arrays.instance_meshes.tolist(),
+                                                arrays.instance_transforms,
+                                                arrays.instance_materials.tolist()):
+            scene.add(Instance(meshes[mesh_ix], transform,
+                               materials[material] if material >= 0 else None))
+        return scene
+
+    def _triangles(self, materials):
+        """Creates triangles of faces of the scene (not of instanced meshes)."""
+        arrays = self.arrays
+        faces = arrays.faces
+        corners = arrays.vertices.astype('double')[faces]
+        normals = arrays.normals.astype('double')[faces]
+        face_normals = np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0])
+        face_normals /= np.linalg.norm(face_normals, axis=1)[:, np.newaxis]
+        missing = ~np.all(np.isfinite(normals), axis=(1, 2))
+        normals[missing] = face_normals[missing][:, np.newaxis, :]
+        return [Triangle([Vec3(arr=vertex) for vertex in corners[index]], materials[material],
+                         [Vec3(arr=normal) for normal in normals[index]])
+                for index, material in enumerate(arrays.face_materials.tolist())]
+
+    def create_renderer(self, params=None):
+        """Creates renderer of described scene with given parameters."""
+        params = dict(DEFAULT_RENDERER_PARAMS, **params) if params is not None \
+                 else DEFAULT_RENDERER_PARAMS
+        return Renderer(self.create_scene(), self.create_camera(params['width'],
+                                                                params['height']), params)
+
+
+def load_scene_file(path, params=None):
+    """Creates renderer of scene loaded from given json or binary scene file
+       with given parameters."""
+    return SceneDescription.load(path).create_renderer(params)
+
+def convert_scene_file(json_path, binary_path):
+    """Converts json scene file (with referenced meshes) into binary one, or
+       obj mesh file into binary mesh file."""
+    if json_path.endswith('.obj'):
+        save_mesh_file(binary_path, *load_obj_mesh(json_path))
+        return
+    SceneDescription.load_json(json_path).save_binary(binary_path)
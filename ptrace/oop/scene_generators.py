@@ -0,0 +1,190 @@
+"""Procedural generators of parametric scenes of arbitrary size, used as
+   workloads for measuring scaling of rendering."""
+
+import math
+
+import numpy as np
+
+from .vector import rotation_matrix
+from .scene_file import SceneArrays, SceneDescription
+
+
+_LIGHT_MATERIAL = {'emission': [8.0, 8.0, 8.0]}
+_GROUND_MATERIAL = {'diffuse': [0.4, 0.4, 0.4]}
+_ENVIRONMENT = [0.05, 0.05, 0.1]
+
+
+def _camera(eye, look_at):
+    """Returns camera description looking from given eye position at given
+       point."""
+    return {'eye': list(eye), 'look_at': list(look_at), 'up': [0.0, 1.0, 0.0],
+            'vertical_fov': 40}
+
+def sphere_grid(size):
+    """Generates scene with size x size grid of unit spaced spheres (in xy
+       plane) of alternating matte and shiny materials, lit by a large
+       spherical light."""
+    assert size > 0
+    coords = np.arange(size) - (size - 1) / 2.0
+    grid_x, grid_y = np.meshgrid(coords, coords, indexing='ij')
+    centres = np.stack([grid_x.ravel(), grid_y.ravel(), np.zeros(size * size)], axis=1)
+
+    materials = [_LIGHT_MATERIAL,
+                 {'diffuse': [0.6, 0.2, 0.2]},
+                 {'diffuse': [0.2, 0.6, 0.2], 'reflectivity': 0.5,
+                  'reflection_cone_angle': 0.05}]
+    arrays = SceneArrays()
+    arrays.add_spheres(np.array([[size, size, -2.0 * size]]), np.array([size / 2.0]), [0])
+    arrays.add_spheres(centres, np.full(size * size, 0.4),
+                       1 + (np.arange(size * size) + np.arange(size * size) // size) % 2)
+
+    header = { \
+        'camera': _camera([0.0, 0.0, -1.5 * size - 2.0], [0.0, 0.0, 0.0]),
+        'environment': _ENVIRONMENT,
+        'materials': materials}
+    return SceneDescription(header, arrays)
+
+def sphere_field(count, seed=0):
+    """Generates scene with given number of randomly placed and sized spheres
+       (reproducible from given seed) standing on large ground sphere. Their
+       materials are randomly matte, shiny (reflective) or glossy."""
+    assert count > 0
+    rng = np.random.default_rng(seed)
+    extent = max(2.0, math.sqrt(count))
+    radii = rng.uniform(0.1, 0.3, count)
+    centres = np.stack([rng.uniform(-extent, extent, count), radii - 1.0,
+                        rng.uniform(-extent, extent, count)], axis=1)
+
+    kinds = rng.choice(3, count, p=[0.6, 0.25, 0.15])
+    colours = rng.uniform(0.1, 0.9, (count, 3)).round(3)
+    materials = [_LIGHT_MATERIAL, _GROUND_MATERIAL]
+    for kind, colour in zip(kinds.tolist(), colours.tolist()):
+        if kind == 0:
+            materials.append({'diffuse': colour})
+        elif kind == 1:
+            materials.append({'diffuse': colour, 'reflectivity': 0.8,
+                              'reflection_cone_angle': 0.02})
+        else:
+            materials.append({'diffuse': colour, 'refraction_index': 1.5,
+                              'reflection_cone_angle': 0.1})
+
+    arrays = SceneArrays()
+    arrays.add_spheres(np.array([[0.0, 4.0 * extent, -extent], [0.0, -1001.0, 0.0]]),
+                       np.array([extent, 1000.0]), [0, 1])
+    arrays.add_spheres(centres, radii, np.arange(count) + 2)
+
+    header = { \
+        'camera': _camera([0.0, 0.5 * extent, -2.5 * extent], [0.0, -1.0, 0.0]),
+        'environment': _ENVIRONMENT,
+        'materials': materials}
+    return SceneDescription(header, arrays)
+
+def caustic_cup(segments=48):
+    """Generates scene with cylindrical mirror wall (of given number of flat
+       segments) and glass-like sphere standing on ground sphere, lit by small
+       bright spherical light just above the rim of the wall. Floor inside the
+       wall is lit mostly by caustics (light focused by specular reflections)."""
+    assert segments > 0
+    materials = [{'emission': [80.0, 80.0, 80.0]}, _GROUND_MATERIAL,
+                 {'diffuse': [0.1, 0.1, 0.1], 'reflectivity': 0.95},
+                 {'diffuse': [0.1, 0.3, 0.6], 'refraction_index': 1.5,
+                  'reflection_cone_angle': 0.02}]
+    arrays = SceneArrays()
+    arrays.add_spheres(np.array([[0.0, 0.2, -3.0], [0.0, -1001.0, 0.0], [1.8, -0.6, -0.5]]),
+                       np.array([0.15, 1000.0, 0.4]), [0, 1, 3])
+
+    # wall of the mirror with normals facing its axis
+    angles = np.linspace(0.0, 2.0 * math.pi, segments + 1)
+    normals = np.stack([-np.cos(angles), np.zeros(segments + 1), -np.sin(angles)], axis=1)
+    vertices = np.concatenate([normals * -1.2 + [0.0, -1.0, 0.0],
+                               normals * -1.2 + [0.0, -0.5, 0.0]])
+    bottom = np.arange(segments)
+    top = bottom + segments + 1
+    faces = np.concatenate([np.stack([bottom, bottom + 1, top + 1], axis=1),
+                            np.stack([bottom, top + 1, top], axis=1)])
+    arrays.add_mesh(vertices, np.concatenate([normals, normals]), faces,
+                    np.full(len(faces), 2))
+
+    header = { \
+        'camera': _camera([0.0, 3.0, -2.5], [0.0, -1.0, 0.2]),
+        'environment': [0.3, 0.3, 0.35],
+        'materials': materials}
+    return SceneDescription(header, arrays)
+
+def uv_sphere_mesh(triangle_count):
+    """Returns vertices (equal to normals) and faces of unit UV sphere mesh of
+       about given number of triangles."""
+    # mesh has 4 * stacks * (stacks - 1) (non degenerate) triangles
+    stacks = max(2, int(round((1.0 + math.sqrt(1.0 + triangle_count)) / 2.0)))
+    slices = 2 * stacks
+
+    theta = np.linspace(0.0, math.pi, stacks + 1)
+    phi = np.linspace(0.0, 2.0 * math.pi, slices + 1)
+    theta, phi = np.meshgrid(theta, phi, indexing='ij')
+    normals = np.stack([np.sin(theta) * np.cos(phi), np.cos(theta),
+                        np.sin(theta) * np.sin(phi)], axis=-1).reshape(-1, 3)
+
+    ring = np.arange(stacks)[:, np.newaxis] * (slices + 1) + np.arange(slices)[np.newaxis, :]
+    ring = ring.ravel()
+    quads = np.stack([ring, ring + 1, ring + slices + 2, ring + slices + 1], axis=1)
+    faces = np.concatenate([quads[:, [0, 1, 2]], quads[:, [0, 2, 3]]])
+    # skip degenerate triangles at the poles
+    faces = faces[np.linalg.norm(np.cross(normals[faces[:, 1]] - normals[faces[:, 0]],
+                                          normals[faces[:, 2]] - normals[faces[:, 0]]),
+                                 axis=1) > 1e-12]
+    return normals, faces
+
+def tessellated_sphere(triangle_count):
+    """Generates scene with unit sphere approximated by UV sphere mesh (with
+       smooth per vertex normals) of about given number of triangles, standing
+       on large ground sphere."""
+    normals, faces = uv_sphere_mesh(triangle_count)
+
+    materials = [_LIGHT_MATERIAL, _GROUND_MATERIAL,
+                 {'diffuse': [0.3, 0.5, 0.8], 'refraction_index': 1.5,
+                  'reflection_cone_angle': 0.05}]
+    arrays = SceneArrays()
+    arrays.add_spheres(np.array([[4.0, 6.0, -4.0], [0.0, -1001.0, 0.0]]),
+                       np.array([2.0, 1000.0]), [0, 1])
+    arrays.add_mesh(normals, normals, faces, np.full(len(faces), 2))
+
+    header = { \
+        'camera': _camera([0.0, 0.5, -4.0], [0.0, 0.0, 0.0]),
+        'environment': _ENVIRONMENT,
+        'materials': materials}
+    return SceneDescription(header, arrays)
+
+def instanced_spheres(count, seed=0, triangle_count=500):
+    """Generates scene with given number of instances of single tessellated
+       sphere mesh of about given number of triangles, randomly rotated,
+       scaled and placed (reproducible from given seed) above large ground
+       sphere. Every third instance overrides material of the mesh."""
+    assert count > 0
+    rng = np.random.default_rng(seed)
+    extent = max(2.0, math.sqrt(count))
+    normals, faces = uv_sphere_mesh(triangle_count)
+
+    transforms = np.zeros((count, 3, 4))
+    for index in range(count):
+        axis = rng.normal(size=3)
+        scale = rng.uniform(0.15, 0.35)
+        transforms[index, :, :3] = scale * rotation_matrix(axis, rng.uniform(0.0, 360.0))
+        transforms[index, :, 3] = [rng.uniform(-extent, extent), scale - 1.0,
+                                   rng.uniform(-extent, extent)]
+
+    materials = [_LIGHT_MATERIAL, _GROUND_MATERIAL,
+                 {'diffuse': [0.3, 0.5, 0.8]},
+                 {'diffuse': [0.8, 0.6, 0.2], 'reflectivity': 0.8,
+                  'reflection_cone_angle': 0.02}]
+    arrays = SceneArrays()
+    arrays.add_spheres(np.array([[0.0, 4.0 * extent, -extent], [0.0, -1001.0, 0.0]]),
+                       np.array([extent, 1000.0]), [0, 1])
+    mesh = arrays.add_instanced_mesh(normals, normals, faces, np.full(len(faces), 2))
+    arrays.add_instances(np.full(count, mesh), transforms,
+                         np.where(np.arange(count) % 3 == 2, 3, -1))
+
+    header = { \
+        'camera': _camera([0.0, 0.5 * extent, -2.5 * extent], [0.0, -1.0, 0.0]),
+        'environment': _ENVIRONMENT,
+        'materials': materials}
+    return SceneDescription(header, arrays)
@@ -0,0 +1,296 @@
+"""Scheduling of tiled rendering jobs onto a pool of worker processes."""
+
+import functools
+import random
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import numpy as np
+
+from .ray_order import TILE_ORDERS, curve_codes
+
+
+#pylint: disable=too-many-arguments
+
+def make_tile(x_range, y_range, samples, sample_ix, width, height):
+    """Creates description of a tile job covering given ranges of pixels with
+       given number of samples (starting at given sample index), prioritised
+       by its distance from the centre of image of given dimensions."""
+    x_mid = (x_range[0] + x_range[1]) // 2
+    y_mid = (y_range[0] + y_range[1]) // 2
+    dist_sqr = int(((x_mid - width / 2) ** 2) + ((y_mid - height / 2) ** 2))
+    return { \
+        'x_range': x_range,
+        'y_range': y_range,
+        'samples': samples,
+        'sample_ix': sample_ix,
+        'dist_prio': dist_sqr,
+        'rand_prio': random.random()}
+
+#pylint: enable=too-many-arguments
+
+def tile_priority(tile):
+    """Returns sorting key of a tile (lower keys are rendered first)."""
+    return (tile['sample_ix'], tile['dist_prio'], tile['rand_prio'])
+
+def tile_pixel_samples(tile):
+    """Returns total number of pixel samples of given tile."""
+    return (tile['x_range'][1] - tile['x_range'][0]) * \
+           (tile['y_range'][1] - tile['y_range'][0]) * tile['samples']
+
+
+# number of recent tiles used to estimate time of rendering a tile
+_RECENT_TILE_COUNT = 16
+
+
+#pylint: disable=too-many-instance-attributes
+
+class TileScheduler():
+    """Hands out tiles to worker slots in priority order.
+
+       Each worker has its own queue of tiles, initially filled round-robin
+       from tiles sorted by priority (centre-first, or along Morton or
+       Hilbert curve of their corners within each sampling pass). Idle
+       workers steal half of the sample chunk at the back of the longest
+       queue. Measured rendering costs are stored per image region and tiles
+       whose estimated cost exceeds twice the target time are split into
+       quadrants (or sample chunks)."""
+
+    width = None
+    height = None
+    queues = None
+    target_tile_time = None
+    min_tile_size = None
+    cost_map = None
+    cell_size = None
+    tile_times = None
+    order = None
+
+    #pylint: disable=too-many-arguments
+
+    def __init__(self, tiles, width, height, worker_count,
+                 target_tile_time=0.5, min_tile_size=4, order='centre'):
+        """Creates scheduler of given tiles of image with given dimensions for
+           given number of workers, handed out in given order (one of
+           TILE_ORDERS)."""
+        assert worker_count > 0
+        assert order in TILE_ORDERS, "Unknown tile order"
+        self.width = width
+        self.height = height
+        self.order = order
+        self.target_tile_time = target_tile_time
+        self.min_tile_size = min_tile_size
+        self.queues = [deque() for _ in range(worker_count)]
+        for index, tile in enumerate(self._sorted(tiles)):
+            self.queues[index % worker_count].append(tile)
+
+        self.tile_times = []
+        self.cell_size = min_tile_size
+        self.cost_map = np.full((-(-width // min_tile_size), -(-height // min_tile_size)),
+                                np.nan)
+
+    #pylint: enable=too-many-arguments
+
+    def pending_count(self):
+        """Returns number of tiles that have not been handed out yet."""
+        return sum(len(queue) for queue in self.queues)
+
+    def first_pass_pending(self):
+        """Checks whether any tile of the first sampling pass has not been
+           handed out yet."""
+        return any(tile['sample_ix'] == 0 for queue in self.queues for tile in queue)
+
+    def next_tile(self, worker):
+        """Returns next tile to be rendered by given worker (or None if there is
+           no work left)."""
+        queue = self.queues[worker]
+        if queue:
+            return self._adapt(queue.popleft(), queue)
+
+        victim = max(self.queues, key=len)
+        if not victim:
+            return None
+        tile = victim.pop()
+        if tile['samples'] > 1:
+            kept, tile = self._split_samples(tile)
+            victim.append(kept)
+        return self._adapt(tile, queue)
+
+    def requeue(self, tile, worker=0):
+        """Puts back tile that was handed out but not rendered (e.g. due to
+           worker failure) at the front of given worker's queue."""
+        self.queues[worker].appendleft(tile)
+
+    def report(self, tile, elapsed):
+        """Records time spent on rendering given tile."""
+        cost = elapsed / max(1, tile_pixel_samples(tile))
+        self.cost_map[self._cells(tile)] = cost
+        self.tile_times.append(elapsed)
+
+    def mean_tile_time(self):
+        """Returns mean time of rendering recently reported tiles."""
+        recent = self.tile_times[-_RECENT_TILE_COUNT:]
+        return sum(recent) / len(recent) if recent else 0.0
+
+    def estimate(self, tile):
+        """Returns estimated time of rendering given tile (or None if there is
+           no measurement available yet)."""
+        costs = self.cost_map[self._cells(tile)]
+        if np.all(np.isnan(costs)):
+            if np.all(np.isnan(self.cost_map)):
+                return None
+            return np.nanmean(self.cost_map) * tile_pixel_samples(tile)
+        return np.nanmean(costs) * tile_pixel_samples(tile)
+
+    def _cells(self, tile):
+        """Returns index of cost map cells covered by given tile."""
+        size = self.cell_size
+        return (slice(tile['x_range'][0] // size, -(-tile['x_range'][1] // size)),
+                slice(tile['y_range'][0] // size, -(-tile['y_range'][1] // size)))
+
+    def _sorted(self, tiles):
+        """Returns given tiles sorted in order of the scheduler."""
+        if self.order == 'centre':
+            return sorted(tiles, key=tile_priority)
+        codes = curve_codes([tile['x_range'][0] for tile in tiles],
+                            [tile['y_range'][0] for tile in tiles],
+                            self.order, max(self.width, self.height)).tolist()
+        indices = sorted(range(len(tiles)), key=lambda ix: (tiles[ix]['sample_ix'], codes[ix]))
+        return [tiles[ix] for ix in indices]
+
+    def _adapt(self, tile, queue):
+        """Splits given tile if it is estimated to be too expensive, putting
+           remaining parts at the front of given queue."""
+        estimate = self.estimate(tile)
+        if estimate is None or estimate <= 2.0 * self.target_tile_time:
+            return tile
+
+        parts = self._split_area(tile)
+        if len(parts) == 1 and tile['samples'] > 1:
+            parts = list(self._split_samples(tile))
+        if len(parts) == 1:
+            return tile
+        for part in reversed(parts[1:]):
+            queue.appendleft(part)
+        return self._adapt(parts[0], queue)
+
+    def _split_area(self, tile):
+        """Splits tile into (up to) four quadrants sorted in order of the
+           scheduler."""
+        x_beg, x_end = tile['x_range']
+        y_beg, y_end = tile['y_range']
+        x_splits = [x_beg, x_end]
+        y_splits = [y_beg, y_end]
+        if x_end - x_beg >= 2 * self.min_tile_size:
+            x_splits.insert(1, (x_beg + x_end) // 2)
+        if y_end - y_beg >= 2 * self.min_tile_size:
+            y_splits.insert(1, (y_beg + y_end) // 2)
+        parts = [make_tile((x_splits[i], x_splits[i + 1]), (y_splits[j], y_splits[j + 1]),
+                           tile['samples'], tile['sample_ix'], self.width, self.height)
+                 for i in range(len(x_splits) - 1) for j in range(len(y_splits) - 1)]
+        return self._sorted(parts)
+
+    @staticmethod
+    def _split_samples(tile):
+        """Splits tile into two chunks with halves of its samples."""
+        first = dict(tile, samples=tile['samples'] // 2)
+        second = dict(tile, samples=tile['samples'] - first['samples'],
+                      sample_ix=tile['sample_ix'] + first['samples'])
+        return first, second
+
+#pylint: enable=too-many-instance-attributes
+
+
+_WORKER_RENDERER = None
+
+def _init_worker(renderer):
+    """Initializes worker process with given renderer."""
+    global _WORKER_RENDERER #pylint: disable=global-statement
+    _WORKER_RENDERER = renderer
+    random.seed()
+    np.random.seed()
+
+def _render_tile_job(tile):
+    """Renders given tile in worker process, returning rendered image block and
+       time elapsed."""
+    start_time = time.time()
+    block = _WORKER_RENDERER.render_tile(tile)
+    return block, time.time() - start_time
+
+def _warm_up_job():
+    """Does nothing (submitted to start worker processes)."""
+
+def start_tile_pool(renderer, worker_count):
+    """Starts pool of given number of worker processes rendering tiles with
+       given renderer (waiting until they are all running). Returns the pool
+       and function submitting tiles to it (as taken by run_scheduler)."""
+    pool = ProcessPoolExecutor(worker_count, initializer=_init_worker, initargs=(renderer,))
+    for future in [pool.submit(_warm_up_job) for _ in range(worker_count)]:
+        future.result()
+    return pool, functools.partial(pool.submit, _render_tile_job)
+
+
+#pylint: disable=too-many-arguments
+#pylint: disable=too-many-locals
+
+def run_scheduler(renderer, scheduler, output, worker_count, update=None, should_stop=None,
+                  submit_tile=None):
+    """Renders tiles handed out by given scheduler using given renderer (in a
+       pool of worker processes if more than one worker is requested) and
+       accumulates them into output image.
+
+       Update function (if given) is called with output image and tile after
+       each tile is accumulated. No more tiles are handed out once stop
+       predicate (if given) returns true. If tile submitting function is
+       given (returning future of rendered block and time elapsed), tiles are
+       rendered with it (e.g. on shared pool) instead of a new pool."""
+
+    def next_tile(worker):
+        if should_stop is not None and should_stop():
+            return None
+        return scheduler.next_tile(worker)
+
+    def merge(tile, block, elapsed):
+        scheduler.report(tile, elapsed)
+        output.add_image_block(tile['x_range'][0], tile['y_range'][0], block)
+        if update is not None:
+            update(output, tile)
+
+    if worker_count == 1 and submit_tile is None:
+        tile = next_tile(0)
+        while tile is not None:
+            start_time = time.time()
+            block = renderer.render_tile(tile)
+            merge(tile, block, time.time() - start_time)
+            tile = next_tile(0)
+        return output
+
+    pool = None
+    if submit_tile is None:
+        pool = ProcessPoolExecutor(worker_count, initializer=_init_worker,
+                                   initargs=(renderer,))
+        submit_tile = functools.partial(pool.submit, _render_tile_job)
+    try:
+        running = {}
+
+        def submit(worker):
+            tile = next_tile(worker)
+            if tile is not None:
+                running[submit_tile(tile)] = (worker, tile)
+
+        for worker in range(worker_count):
+            submit(worker)
+        while running:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                worker, tile = running.pop(future)
+                merge(tile, *future.result())
+                submit(worker)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    return output
+
+#pylint: enable=too-many-locals
+#pylint: enable=too-many-arguments
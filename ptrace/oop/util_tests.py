@@ -2,12 +2,15 @@
 
 import unittest
 import math
+import os
+import tempfile
 import numpy as np
+from PIL import Image
 
 from .vector import Vec3
 
-from .utils import isiter, rad2deg, deg2rad, colour2bytes
-from .image_output import AccumulableImage
+from .utils import isiter, rad2deg, deg2rad, colour2bytes, check_params
+from .image_output import AccumulableImage, MappedAccumulableImage
 from .scene_settings import MaterialData
 
 class UtilsTests(unittest.TestCase):
@@ -55,6 +58,17 @@ class UtilsTests(unittest.TestCase):
         self.assertTrue(np.allclose(colour2bytes(Vec3(-1, -1, -1)), \
                                     np.array([0, 0, 0], dtype='uint8')))
 
+    def test_util_check_params(self):
+        """Tests validation of rendering parameters."""
+        params = {'width': 8, 'height': 6, 'preview': False, 'samples_per_pixel': 2,
+                  'max_depth': 2, 'first_bounce_u_samples': 1, 'first_bounce_v_samples': 1}
+        check_params(params)
+        check_params(dict(params, max_cpus=2))
+        for invalid in (dict(params, max_cpus='2'), dict(params, tile_size=None),
+                        {key: value for key, value in params.items() if key != 'width'}):
+            with self.assertRaises(AssertionError):
+                check_params(invalid)
+
 
 class AccumulableImageTests(unittest.TestCase):
     """Tests for AccumulableImage class."""
@@ -96,6 +110,84 @@ class AccumulableImageTests(unittest.TestCase):
             self.assertEqual(img.sample_counts[pos[0], pos[1]], samples)
             self.assertEqual(img2.sample_counts[pos[0], pos[1]], samples * 2)
 
+    def test_accimg_single_precision(self):
+        """Tests accumulation in single precision buffers."""
+        img = AccumulableImage(4, 3, 'single')
+        self.assertEqual(img.image.nbytes, AccumulableImage(4, 3).image.nbytes // 2)
+        img.add_samples(1, 2, Vec3(0.1, 0.5, 0.9), 3)
+        self.assertEqual(img[1, 2], Vec3(0.1, 0.5, 0.9))
+        self.assertEqual(img.colours().dtype, np.dtype('single'))
+
+    def test_accimg_variance(self):
+        """Tests variance tracking and error estimation."""
+        img = AccumulableImage(2, 2, track_variance=True)
+        self.assertEqual(img.estimated_error(), float('inf'))
+        for pos in [(i, j) for i in range(2) for j in range(2)]:
+            img.add_samples(pos[0], pos[1], Vec3(1, 1, 1), 1)
+            img.add_samples(pos[0], pos[1], Vec3(3, 3, 3), 1)
+        self.assertTrue(np.allclose(img.variances(), 2.0))
+        self.assertAlmostEqual(img.estimated_error(), 1.0 / 2.01)
+
+        block = AccumulableImage(1, 2, track_variance=True)
+        block.add_samples(0, 0, Vec3(2, 2, 2), 2)
+        img.add_image_block(1, 0, block)
+        self.assertTrue(np.allclose(img.variances()[1, 0], 2.0 / 3.0))
+
+
+class MappedAccumulableImageTests(unittest.TestCase):
+    """Tests for MappedAccumulableImage class."""
+
+    def test_mapped_accimg_matches_in_memory(self):
+        """Tests that memory-mapped image accumulates and exports the same data
+           as in-memory one."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            ref = AccumulableImage(13, 7)
+            img = MappedAccumulableImage(13, 7, os.path.join(tmpdir, 'acc'), tile_size=4)
+
+            for pos in [(i, j) for i in range(13) for j in range(7)]:
+                colour = Vec3(pos[0] / 13, pos[1] / 7, 0.5)
+                ref.add_samples(pos[0], pos[1], colour, pos[0] + 1)
+                img.add_samples(pos[0], pos[1], colour, pos[0] + 1)
+
+            block = np.full((3, 5, 6), 0.25)
+            counts = np.ones((5, 6), dtype='int')
+            ref.add_block(3, 1, block, counts)
+            img.add_block(3, 1, block, counts)
+
+            for pos in [(i, j) for i in range(13) for j in range(7)]:
+                self.assertEqual(img[pos], ref[pos])
+                self.assertEqual(img.sample_count_at(pos), ref.sample_count_at(pos))
+            self.assertEqual(img.total_sample_count(), ref.total_sample_count())
+
+            ref.save_as_png(os.path.join(tmpdir, 'ref.png'))
+            img.save_as_png(os.path.join(tmpdir, 'img.png'))
+            with Image.open(os.path.join(tmpdir, 'ref.png')) as ref_png, \
+                 Image.open(os.path.join(tmpdir, 'img.png')) as img_png:
+                self.assertTrue(np.array_equal(np.asarray(ref_png), np.asarray(img_png)))
+
+            img.save_as_npy(os.path.join(tmpdir, 'img.npy'))
+            self.assertTrue(np.allclose(np.load(os.path.join(tmpdir, 'img.npy')),
+                                        ref.colours()))
+
+    def test_mapped_accimg_reopen(self):
+        """Tests reopening and merging of memory-mapped images."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'acc')
+            img = MappedAccumulableImage(6, 5, path, tile_size=4)
+            img.add_samples(5, 4, Vec3(1, 2, 3), 2)
+            img.flush()
+            del img
+
+            img = MappedAccumulableImage.open(path)
+            self.assertEqual((img.width, img.height), (6, 5))
+            self.assertEqual(img[5, 4], Vec3(1, 2, 3))
+
+            other = AccumulableImage(6, 5)
+            other.add_samples(5, 4, Vec3(3, 2, 1), 2)
+            img += other
+            self.assertEqual(img[5, 4], Vec3(2, 2, 2))
+            self.assertEqual(img.sample_count_at((5, 4)), 4)
+
 
 class MaterialDataTests(unittest.TestCase):
     """Tests for MaterialData class."""
@@ -2,6 +2,8 @@
 
 import math
 import json
+import random
+import zlib
 import numpy as np
 
 def isiter(obj):
@@ -16,27 +18,82 @@ def rad2deg(angle):
     """Converts value in radians to degrees."""
     return angle * 180.0 / math.pi
 
+def derive_seed(seed, *keys):
+    """Returns integer seed derived deterministically from given seed combined
+       with given keys (e.g. frame index)."""
+    return zlib.crc32(':'.join(str(key) for key in (seed,) + keys).encode())
+
+def seed_random(seed, *keys):
+    """Seeds both python and numpy random generators deterministically with
+       given seed combined with given keys (e.g. sample and tile indices)."""
+    random.seed(':'.join(str(key) for key in (seed,) + keys))
+    np.random.seed(derive_seed(seed, *keys))
+
 _COLOUR2BYTE_CONV_EXP = 1.0 / 2.2
 
 def colour2bytes(colour):
     """Converts colour (as Vec3) to equivalent array of bytes.
 
        Note taht values between 0 and 1 are not scaled linearly."""
-    return np.floor(np.power(np.clip(colour.data(), 0.0, 1.0), \
+    return colours2bytes(colour.data())
+
+def colours2bytes(colours):
+    """Converts numpy array of colours (with RGB components in the last
+       dimension) to equivalent array of bytes of the same shape."""
+    return np.floor(np.power(np.clip(colours, 0.0, 1.0), \
                              _COLOUR2BYTE_CONV_EXP) * 255.0).astype('uint8')
 
+_OPTIONAL_PARAM_TYPES = { \
+    'max_cpus': int,
+    'accumulation_path': (str, type(None)),
+    'accumulation_tile_size': int,
+    'precision': str,
+    'tiled': bool,
+    'tile_size': int,
+    'samples_per_tile': int,
+    'target_tile_time': (int, float),
+    'time_budget': (int, float, type(None)),
+    'target_error': (int, float, type(None)),
+    'progressive': bool,
+    'progressive_levels': list,
+    'progressive_level_samples': int,
+    'ray_batch_size': int,
+    'denoise': bool,
+    'seed': (int, type(None)),
+    'scene_size': (int, type(None)),
+    'scene_seed': int,
+    'bvh_min_primitives': (int, type(None)),
+    'bvh_leaf_size': int,
+    'bvh_cache_path': (str, type(None)),
+    'irradiance_cache_error': (int, float, type(None)),
+    'irradiance_cache_samples': int,
+    'photon_count': (int, type(None)),
+    'photon_radius': (int, float),
+    'guiding_fraction': (int, float, type(None)),
+    'guiding_resolution': int,
+    'guiding_split_records': int,
+    'primary_hit_strata': (int, type(None)),
+    'pixel_order': str,
+    'tile_order': str}
+
 def load_params(filename):
     """Loads rendering parameters from json file."""
     with open(filename, 'r', encoding='utf-8') as jsonfile:
         result = json.load(jsonfile)
+    check_params(result)
+    return result
 
+def check_params(result):
+    """Asserts that given dictionary holds valid rendering parameters."""
     assert 'width' in result and isinstance(result['width'], int)
     assert 'height' in result and isinstance(result['height'], int)
     assert 'samples_per_pixel' in result and isinstance(result['samples_per_pixel'], int)
-    assert 'max_cpus' in result and isinstance(result['max_cpus'], int)
     assert 'max_depth' in result and isinstance(result['max_depth'], int)
     assert 'first_bounce_u_samples' in result and isinstance(result['first_bounce_u_samples'], int)
     assert 'first_bounce_v_samples' in result and isinstance(result['first_bounce_v_samples'], int)
     assert 'preview' in result and isinstance(result['preview'], bool)
 
-    return result
+    for key, types in _OPTIONAL_PARAM_TYPES.items():
+        assert key not in result or isinstance(result[key], types), \
+            "Invalid type of parameter '{}'".format(key)
+    assert result.get('precision', 'double') in ('double', 'single')
@@ -1,28 +1,36 @@
-"""Basic vector wrapper class, representation of orthonormal basis, and
-   functions for sampling direction vectors from cone and hemisphere."""
+"""Basic vector wrapper class, representation of orthonormal basis,
+   functions for sampling direction vectors from cone and hemisphere, and
+   construction of transformation matrices."""
 
 
 import math
 import numpy as np
 
+FLOAT_DTYPES = ('double', 'single')
+
 class Vec3():
-    """Represents basic 3D vector of doubles."""
+    """Represents basic 3D vector of doubles (or single precision floats)."""
 
     _arr = None
 
-    def __init__(self, xxx=0.0, yyy=0.0, zzz=0.0, arr=None):
+    def __init__(self, xxx=0.0, yyy=0.0, zzz=0.0, arr=None, dtype='double'):
         """Initializes 3D vector with given values (zeros by default)
-           or length 3 numpy array of doubles."""
+           or length 3 numpy array of doubles or single precision floats."""
         if arr is not None:
-            assert arr.shape == (3,) and arr.dtype == 'double'
+            assert arr.shape == (3,) and arr.dtype in FLOAT_DTYPES
             self._arr = arr
         else:
-            self._arr = np.array([xxx, yyy, zzz], dtype='double')
+            assert dtype in FLOAT_DTYPES
+            self._arr = np.array([xxx, yyy, zzz], dtype=dtype)
 
     def copy(self):
         """Creates a copy of a 3D Vector."""
         return Vec3.from_array(self._arr.copy())
 
+    def astype(self, dtype):
+        """Creates a copy of a 3D Vector with components of given type."""
+        return Vec3.from_array(self._arr.astype(dtype))
+
     @staticmethod
     def from_array(nparr):
         """Factory method creating 3D Vector from length 3 nparray of doubles."""
@@ -285,3 +293,14 @@ def sample_hemisphere(basis, u_pos, v_pos):
                  math.sin(random_angle) * radius, \
                  math.sqrt(1.0 - radius_sqr))
     return basis.transform(raw_v).normalised()
+
+def rotation_matrix(axis, angle):
+    """Returns matrix of rotation by given angle (in degrees) around given
+       axis."""
+    axis = np.asarray(axis, dtype='double')
+    axis = axis / np.linalg.norm(axis)
+    angle = math.radians(angle)
+    cross = np.array([[0.0, -axis[2], axis[1]],
+                      [axis[2], 0.0, -axis[0]],
+                      [-axis[1], axis[0], 0.0]])
+    return np.eye(3) + math.sin(angle) * cross + (1.0 - math.cos(angle)) * (cross @ cross)
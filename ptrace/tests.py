@@ -4,6 +4,8 @@ import unittest
 from oop.math_tests import *
 from oop.util_tests import *
 from oop.oop_tests import *
+from oop.render_tests import *
+from oop.distributed_tests import *
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,9 +1,14 @@
 """Executable script for path tracing renderer module."""
 
+import os
 import sys
 import time
 
-from ptrace.core import create_renderer, render_to_png
+from ptrace.core import create_renderer, render_to_png, save_aovs, render_batch, \
+                        render_animation
+from ptrace.oop.render_cache import RenderCache
+from ptrace.oop.scene_file import convert_scene_file
+from ptrace.oop.distributed import Coordinator, generate_authkey, parse_address, run_worker
 
 
 if __name__ == '__main__':
@@ -11,6 +16,16 @@ if __name__ == '__main__':
     params = None
     verbose = False
     output_path = None
+    progress_path = None
+    aov_path = None
+    coordinator_address = None
+    worker_address = None
+    authkey = None
+    cache_path = None
+    binary_path = None
+    batch = False
+    animation_path = None
+    overrides = {}
 
     if len(sys.argv) > 1:
         scene_name = sys.argv[1]
@@ -21,12 +36,57 @@ if __name__ == '__main__':
                 verbose = True
             elif arg.startswith('-o'):
                 output_path = arg.strip().split('=', 1)[1]
+            elif arg.startswith('-u'):
+                progress_path = arg.strip().split('=', 1)[1]
+            elif arg.startswith('-t'):
+                overrides['time_budget'] = float(arg.strip().split('=', 1)[1])
+            elif arg.startswith('-a'):
+                aov_path = arg.strip().split('=', 1)[1]
+            elif arg.startswith('-d'):
+                overrides['denoise'] = True
+            elif arg.startswith('-g'):
+                overrides['progressive'] = True
+            elif arg.startswith('-e'):
+                overrides['target_error'] = float(arg.strip().split('=', 1)[1])
+            elif arg.startswith('-c'):
+                coordinator_address = parse_address(arg.strip().split('=', 1)[1])
+            elif arg.startswith('-w'):
+                worker_address = parse_address(arg.strip().split('=', 1)[1])
+            elif arg.startswith('-r'):
+                cache_path = arg.strip().split('=', 1)[1]
+            elif arg.startswith('-s'):
+                overrides['seed'] = int(arg.strip().split('=', 1)[1])
+            elif arg.startswith('-n'):
+                overrides['scene_size'] = int(arg.strip().split('=', 1)[1])
+            elif arg.startswith('-x'):
+                binary_path = arg.strip().split('=', 1)[1]
+            elif arg.startswith('-m'):
+                animation_path = arg.strip().split('=', 1)[1]
+            elif arg.startswith('-b'):
+                batch = True
+            elif arg.startswith('-k'):
+                authkey = arg.strip().split('=', 1)[1].encode()
             else:
                 assert False, 'Unknown command line argument.'
+    if worker_address:
+        if not authkey:
+            sys.exit("Worker requires authentication key of the coordinator (-k=key).")
+        run_worker(worker_address, authkey, verbose)
+        sys.exit(0)
+
+    if batch:
+        render_batch(scene_name, output_path or os.path.splitext(scene_name)[0] + '_summary.json',
+                     verbose)
+        sys.exit(0)
+
+    if binary_path:
+        convert_scene_file(scene_name, binary_path)
+        sys.exit(0)
+
     if not output_path:
-        output_path = './' + scene_name + '.png'
+        output_path = './' + os.path.splitext(os.path.basename(scene_name))[0] + '.png'
 
-    renderer = create_renderer(scene_name, params)
+    renderer = create_renderer(scene_name, params, overrides)
 
     if verbose:
         print("Rendering scene '{}' ({}x{}) to: {}".format(scene_name,
@@ -35,7 +95,24 @@ if __name__ == '__main__':
                                                            output_path))
         start_time = time.time()
 
-    render_to_png(renderer, output_path, verbose)
+    if aov_path:
+        save_aovs(renderer, aov_path, verbose)
+
+    if animation_path:
+        render_animation(renderer, animation_path, output_path, verbose)
+        sys.exit(0)
+
+    coordinator = None
+    if coordinator_address:
+        # distributed rendering runs code sent over the link, so it must only
+        # be used on trusted networks with a secret key
+        if not authkey:
+            authkey = generate_authkey()
+            print("Coordinator authentication key (pass to workers with -k): {}".format( \
+                authkey.decode()))
+        coordinator = Coordinator(renderer, coordinator_address, authkey)
+    cache = RenderCache(cache_path) if cache_path else None
+    render_to_png(renderer, output_path, verbose, progress_path, coordinator, cache)
 
     if verbose:
         print("Time elapsed: {} s.".format(time.time() - start_time))
@@ -0,0 +1,46 @@
+"""Executable script running path tracing render service over HTTP.
+
+   Usage:
+     serve.py [-a=host:port] [-n=worker_processes] [-v]"""
+
+import asyncio
+import sys
+
+from ptrace.core import SCENES, create_renderer
+from ptrace.oop.distributed import parse_address
+from ptrace.oop.render_service import RenderService
+
+
+def _renderer_factory(scene_name, params):
+    """Creates renderer of given scene with given parameters."""
+    return create_renderer(scene_name, None, params)
+
+async def _serve(address, worker_count, verbose):
+    """Runs render service until interrupted."""
+    service = RenderService(_renderer_factory, SCENES, worker_count, verbose)
+    await service.start(*address)
+    try:
+        await service.serve_forever()
+    finally:
+        await service.close()
+
+
+if __name__ == '__main__':
+    service_address = ('localhost', 8080)
+    workers = 1
+    verbose = False
+
+    for arg in sys.argv[1:]:
+        if arg.startswith('-a'):
+            service_address = parse_address(arg.strip().split('=', 1)[1])
+        elif arg.startswith('-n'):
+            workers = int(arg.strip().split('=', 1)[1])
+        elif arg.startswith('-v'):
+            verbose = True
+        else:
+            assert False, 'Unknown command line argument.'
+
+    try:
+        asyncio.run(_serve(service_address, workers, verbose))
+    except KeyboardInterrupt:
+        pass
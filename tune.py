@@ -0,0 +1,48 @@
+"""Executable script tuning performance parameters (ray batch size, tile size
+   and number of worker processes) of rendering given scene on this host.
+
+   Usage:
+     tune.py <scene> [-p=params.json] [-n=scene_size] [-f=tuning.json] [-r=repeats] [-v]
+
+   Fastest parameters found in short calibration renders are stored in
+   tuning file (by default in user's home directory) under host name and
+   class of the scene, and are used by later renders of scenes of the same
+   class, unless given explicitly in their parameters."""
+
+import sys
+
+from ptrace.core import create_renderer
+from ptrace.oop.autotune import DEFAULT_TUNING_PATH, TuningCache, host_name, scene_class, tune
+
+
+if __name__ == '__main__':
+    assert len(sys.argv) > 1, 'Missing scene name.'
+    scene_name = sys.argv[1]
+    params = None
+    tuning_path = DEFAULT_TUNING_PATH
+    repeats = 1
+    verbose = False
+    overrides = {}
+
+    for arg in sys.argv[2:]:
+        if arg.startswith('-p'):
+            params = arg.strip().split('=', 1)[1]
+        elif arg.startswith('-n'):
+            overrides['scene_size'] = int(arg.strip().split('=', 1)[1])
+        elif arg.startswith('-f'):
+            tuning_path = arg.strip().split('=', 1)[1]
+        elif arg.startswith('-r'):
+            repeats = int(arg.strip().split('=', 1)[1])
+        elif arg.startswith('-v'):
+            verbose = True
+        else:
+            assert False, 'Unknown command line argument.'
+
+    renderer = create_renderer(scene_name, params, overrides, tuning_path=None)
+    scene_cls = scene_class(scene_name, renderer)
+    tuned = tune(renderer, repeats=repeats, verbose=verbose)
+    TuningCache(tuning_path).put(scene_cls, tuned)
+    print("Tuned parameters for scene class '{}' on host '{}': {}".format( \
+        scene_cls, host_name(), ', '.join('{}={}'.format(key, value)
+                                          for key, value in sorted(tuned.items()))))
+    print("Saved to: {}".format(tuning_path))